@@ -0,0 +1,50 @@
+import time
+import numpy as np
+import pandas as pd
+from model_registry import load_version
+from forest_engine import export_forest
+from recommender import EXPECTED_COLS, FEATURE_INDEX
+
+# เทียบ FlatForest กับ model.predict (DataFrame) แบบที่ /submit เคยเรียก
+BATCH_SIZES = [10, 50, 200, 500, 2000, 10000]
+REPEAT = 20
+
+
+def make_batch(n, rng):
+    X = np.zeros((n, len(EXPECTED_COLS)))
+    X[:, FEATURE_INDEX['user_valence']] = rng.integers(1, 6) / 5
+    X[:, FEATURE_INDEX['user_arousal']] = rng.integers(2, 11) / 10
+    X[:, FEATURE_INDEX['user_genre_Drama']] = 1
+    X[:, FEATURE_INDEX['movie_valence']] = rng.random(n).round(3)
+    X[:, FEATURE_INDEX['movie_arousal']] = rng.random(n).round(3)
+    movie_genre_cols = [FEATURE_INDEX[c] for c in EXPECTED_COLS if c.startswith('movie_genre_')]
+    X[np.arange(n), rng.choice(movie_genre_cols, n)] = 1
+    return X
+
+
+def best_time(fn, repeat=REPEAT):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+if __name__ == '__main__':
+    model_version = load_version()
+    model = model_version.model
+    forest = model_version.forest or export_forest(model)
+    if forest is None:
+        raise SystemExit(f"Model {type(model).__name__} cannot be exported to FlatForest")
+    print(f"model {model_version.model_id}: {forest.n_trees} trees, {len(forest.feature)} nodes, max depth {forest.max_depth}")
+
+    rng = np.random.default_rng(0)
+    print(f"{'rows':>6} {'sklearn ms':>11} {'flat ms':>9} {'speedup':>8} {'max |diff|':>11}")
+    for n in BATCH_SIZES:
+        X = make_batch(n, rng)
+        df = pd.DataFrame(X, columns=EXPECTED_COLS)
+        diff = np.abs(model.predict(df) - forest.predict(X)).max()
+        sklearn_ms = best_time(lambda: model.predict(df))
+        flat_ms = best_time(lambda: forest.predict(X))
+        print(f"{n:>6} {sklearn_ms:>11.2f} {flat_ms:>9.2f} {sklearn_ms / flat_ms:>7.2f}x {diff:>11.2e}")
@@ -0,0 +1,38 @@
+import csv
+import time
+from pathlib import Path
+from nlp_ml.nlp_synopsis import analyze_va, analyze_va_batch
+
+# เทียบ analyze_va ทีละเรื่อง (word_tokenize) กับ analyze_va_batch บน synopsis ของ movies_500.csv
+MOVIES_CSV = Path(__file__).resolve().parent.parent / 'movies_500.csv'
+COPIES = [1, 4, 20]
+REPEAT = 5
+
+
+def load_synopses():
+    with open(MOVIES_CSV, 'r', encoding='utf-8') as f:
+        return [row['overview'] for row in csv.DictReader(f)]
+
+
+def best_time(fn, repeat=REPEAT):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+if __name__ == '__main__':
+    synopses = load_synopses()
+    expected = [analyze_va(text) for text in synopses]
+    actual = analyze_va_batch(synopses)
+    mismatches = sum(a != b for a, b in zip(expected, actual))
+    print(f"{len(synopses)} synopses from {MOVIES_CSV.name}, {mismatches} differ from analyze_va")
+
+    print(f"{'texts':>6} {'analyze_va ms':>14} {'batch ms':>9} {'speedup':>8}")
+    for copies in COPIES:
+        texts = synopses * copies
+        single_ms = best_time(lambda: [analyze_va(text) for text in texts])
+        batch_ms = best_time(lambda: analyze_va_batch(texts))
+        print(f"{len(texts):>6} {single_ms:>14.1f} {batch_ms:>9.1f} {single_ms / batch_ms:>7.2f}x")
@@ -0,0 +1,348 @@
+import json
+import asyncio
+import threading
+import time
+import logging
+import numpy as np
+from catalog_snapshot import snapshot_key, unpack_snapshot, StringColumn, ListColumn, STRING_COLUMNS, SNAPSHOT_CHUNK_BYTES
+
+log = logging.getLogger(__name__)
+
+# pointer ไปยัง generation ปัจจุบันของ catalog (sync_db.py เปลี่ยนค่าหลังเขียน generation ใหม่เสร็จ)
+CATALOG_VERSION_KEY = "catalog:version"
+# ตัวนับสำหรับสร้าง id ของ generation ใหม่
+CATALOG_VERSION_SEQ_KEY = "catalog:version_seq"
+# ถ้ายังไม่มี version key (sync_db รุ่นเก่า) ให้ rebuild ตามเวลาแทน
+CATALOG_REFRESH_SECONDS = 300
+
+
+def manifest_key(version):
+    """hash ของ generation หนึ่ง: movie_id -> content hash ของหนังเรื่องนั้น"""
+    return f"catalog:{version}:movies"
+
+
+def movie_key(movie_id, content_hash):
+    # หนังที่ข้อมูลไม่เปลี่ยนใช้ key เดิมข้าม generation ได้
+    return f"movie:{movie_id}:{content_hash}"
+
+
+def _parse_json_list(s):
+    try:
+        value = json.loads(s) if s else []
+        return value if isinstance(value, list) else []
+    except (TypeError, ValueError):
+        return []
+
+
+class MovieCatalog:
+    """ข้อมูลหนังทั้งหมดในรูป numpy array สร้างครั้งเดียวจาก Redis hash หรือจาก binary snapshot"""
+
+    def __init__(self, version, movie_ids, rows):
+        self.version = version
+        self.built_at = time.monotonic()
+        n = len(rows)
+
+        self.movie_ids = np.array(movie_ids, dtype=object)
+        self.index_of = {movie_id: i for i, movie_id in enumerate(movie_ids)}
+        self.names = np.empty(n, dtype=object)
+        self.posters = np.empty(n, dtype=object)
+        self.synopses = np.empty(n, dtype=object)
+        self.links = np.empty(n, dtype=object)
+        self.genres_list = np.empty(n, dtype=object)
+        self.valence = np.zeros(n, dtype=np.float64)
+        self.arousal = np.zeros(n, dtype=np.float64)
+        # ข้อมูลสำหรับ log feedback ใน /vote (genre ตัวพิมพ์เดิม, หนังที่มีค่า emotion)
+        self.genres_original = np.empty(n, dtype=object)
+        self.has_emotion = np.zeros(n, dtype=bool)
+
+        # genre แรกของหนัง (lowercase) เก็บเป็น index เข้า genre_vocab, -1 = ไม่มี genre
+        self.genre_vocab = []
+        vocab_index = {}
+        self.genre_codes = np.full(n, -1, dtype=np.int32)
+        # inverted index: genre (lowercase) -> index ของหนังทุกเรื่องที่มี genre นั้น
+        genre_members = {}
+
+        for i, movie in enumerate(rows):
+            self.names[i] = movie.get("name", "Unknown")
+            self.posters[i] = movie.get("poster", "")
+            self.synopses[i] = movie.get("synopsis", "")
+            self.links[i] = _parse_json_list(movie.get("link"))
+
+            emotion = _parse_json_list(movie.get("emotion"))
+            if len(emotion) >= 2:
+                self.valence[i] = float(emotion[0])
+                self.arousal[i] = float(emotion[1])
+                self.has_emotion[i] = True
+
+            genres = [str(g) for g in _parse_json_list(movie.get("gerne"))]
+            self.genres_original[i] = genres
+            self.genres_list[i] = [g.lower() for g in genres]
+            for g in set(self.genres_list[i]):
+                genre_members.setdefault(g, []).append(i)
+            if genres:
+                first = genres[0].lower()
+                if first not in vocab_index:
+                    vocab_index[first] = len(self.genre_vocab)
+                    self.genre_vocab.append(first)
+                self.genre_codes[i] = vocab_index[first]
+
+        self.genre_index = {g: np.array(ids, dtype=np.intp) for g, ids in genre_members.items()}
+        self._empty = np.empty(0, dtype=np.intp)
+
+    @classmethod
+    def from_snapshot(cls, version, data):
+        """สร้างจาก snapshot ที่ sync_db.py publish ไว้ (ดู catalog_snapshot.py)
+
+        column ตัวเลขชี้เข้า data ตรง ๆ ส่วน string และ list decode เฉพาะเรื่องที่ถูกอ่าน
+        snapshot ไม่มี synopsis (synopses = None) ใช้ fetch_synopses_async แทน
+        """
+        header, arrays = unpack_snapshot(data)
+        catalog = cls.__new__(cls)
+        catalog.version = version
+        catalog.built_at = time.monotonic()
+        n = header["count"]
+
+        catalog.movie_ids = arrays["ids"].astype(str).astype(object)
+        catalog.index_of = dict(zip(catalog.movie_ids.tolist(), range(n)))
+        names = {column: StringColumn(arrays["strings"], arrays["string_offsets"], column) for column in STRING_COLUMNS}
+        catalog.names = names["name"]
+        catalog.posters = names["poster"]
+        catalog.synopses = None
+        catalog.links = ListColumn(arrays["link_offsets"], arrays["link_items"], header["links"])
+        catalog.valence = arrays["valence"]
+        catalog.arousal = arrays["arousal"]
+        catalog.has_emotion = arrays["has_emotion"].view(bool)
+
+        genres = header["genres"]
+        catalog.genres_original = ListColumn(arrays["genre_offsets"], arrays["genre_items"], genres)
+        catalog.genres_list = ListColumn(arrays["genre_offsets"], arrays["genre_items"], [g.lower() for g in genres])
+        catalog.genre_vocab = header["genre_vocab"]
+        catalog.genre_codes = arrays["genre_codes"]
+
+        # inverted index: คู่ (genre lowercase, หนัง) ไม่ซ้ำ เรียงตาม genre แล้วตาม index หนัง
+        lower_vocab = sorted({g.lower() for g in genres})
+        lower_index = {g: code for code, g in enumerate(lower_vocab)}
+        lower_code = np.array([lower_index[g.lower()] for g in genres], dtype=np.int64)
+        rows = np.repeat(np.arange(n, dtype=np.int64), np.diff(arrays["genre_offsets"]))
+        pairs = np.unique(lower_code[arrays["genre_items"]] * max(n, 1) + rows)
+        pair_genres, pair_rows = np.divmod(pairs, max(n, 1))
+        bounds = np.searchsorted(pair_genres, np.arange(len(lower_vocab) + 1))
+        catalog.genre_index = {
+            g: pair_rows[bounds[code]:bounds[code + 1]].astype(np.intp)
+            for code, g in enumerate(lower_vocab) if bounds[code] < bounds[code + 1]
+        }
+        catalog._empty = np.empty(0, dtype=np.intp)
+        return catalog
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def movies_in_genre(self, genre):
+        """index ของหนังที่มี genre นี้ (lookup จาก inverted index ไม่ต้อง scan ทั้ง catalog)"""
+        return self.genre_index.get(genre.lower(), self._empty)
+
+    def movie_features(self, movie_id):
+        """(valence, arousal, genre list) ของหนังสำหรับ log feedback
+
+        คืน None ถ้าไม่มีหนังเรื่องนี้ใน catalog หรือหนังไม่มีค่า emotion
+        """
+        i = self.index_of.get(str(movie_id))
+        if i is None or not self.has_emotion[i]:
+            return None
+        return float(self.valence[i]), float(self.arousal[i]), self.genres_original[i]
+
+    def map_genres(self, known_genres, default_genre):
+        """แปลง genre แรกของหนังทุกเรื่องเป็นค่าที่ encoder รู้จัก (เหมือน safe_parse_genre)"""
+        mapped = np.array(
+            [g if g in known_genres else default_genre for g in self.genre_vocab] + [default_genre],
+            dtype=object,
+        )
+        # code -1 จะชี้ไปที่ช่องสุดท้าย (default_genre)
+        return mapped[self.genre_codes]
+
+
+def _build_catalog(version, keys, results):
+    movie_ids, rows = [], []
+    for key, movie in zip(keys, results):
+        if movie:
+            movie_ids.append(key.split(":")[1])
+            rows.append(movie)
+    return MovieCatalog(version, movie_ids, rows)
+
+
+def _is_legacy_movie_key(key):
+    # movie:* ครอบ movie:{id}:{hash} ของ generation ใหม่ด้วย รุ่นเก่ามีแค่ movie:{id}
+    return key.count(":") == 1
+
+
+_binary_clients = {}
+
+
+def _binary_client(r):
+    # snapshot เป็น binary อ่านผ่าน client ที่ใช้ connection เดียวกันแต่ไม่ decode response
+    client = _binary_clients.get(id(r))
+    if client is None:
+        pool = r.connection_pool
+        binary_pool = type(pool)(
+            connection_class=pool.connection_class,
+            max_connections=pool.max_connections,
+            **{**pool.connection_kwargs, "decode_responses": False}
+        )
+        client = _binary_clients[id(r)] = type(r)(connection_pool=binary_pool)
+    return client
+
+
+def _read_snapshot(r, version):
+    # อ่านทีละ chunk ด้วย GETRANGE ไม่ให้ reply ก้อนเดียวขนาดทั้ง snapshot block Redis
+    client = _binary_client(r)
+    key = snapshot_key(version)
+    data = bytearray(client.strlen(key))
+    for start in range(0, len(data), SNAPSHOT_CHUNK_BYTES):
+        chunk = client.getrange(key, start, start + SNAPSHOT_CHUNK_BYTES - 1)
+        if not chunk:
+            # generation ถูกลบระหว่างอ่าน
+            return None
+        data[start:start + len(chunk)] = chunk
+    return data
+
+
+async def _read_snapshot_async(r, version):
+    client = _binary_client(r)
+    key = snapshot_key(version)
+    data = bytearray(await client.strlen(key))
+    for start in range(0, len(data), SNAPSHOT_CHUNK_BYTES):
+        chunk = await client.getrange(key, start, start + SNAPSHOT_CHUNK_BYTES - 1)
+        if not chunk:
+            return None
+        data[start:start + len(chunk)] = chunk
+    return data
+
+
+def load_catalog_from_redis(r, version=None):
+    """อ่านหนังทุกเรื่องของ generation ที่ระบุจาก Redis แล้วสร้าง MovieCatalog
+
+    ใช้ binary snapshot ถ้ามี ไม่งั้นอ่านทีละ hash ตาม manifest
+    ถ้าไม่มี manifest (ข้อมูลจาก sync_db รุ่นเก่า) ใช้ SCAN movie:* แทน
+    """
+    if version is not None:
+        data = _read_snapshot(r, version)
+        if data:
+            try:
+                return MovieCatalog.from_snapshot(version, data)
+            except ValueError as e:
+                log.warning(f"Catalog snapshot unreadable, loading from manifest: {e}")
+    manifest = r.hgetall(manifest_key(version)) if version is not None else {}
+    if manifest:
+        keys = [movie_key(movie_id, content_hash) for movie_id, content_hash in manifest.items()]
+    else:
+        keys = [key for key in r.scan_iter("movie:*") if _is_legacy_movie_key(key)]
+    pipe = r.pipeline()
+    for key in keys:
+        pipe.hgetall(key)
+    results = pipe.execute()
+    return _build_catalog(version, keys, results)
+
+
+async def load_catalog_from_redis_async(r, version=None):
+    """เหมือน load_catalog_from_redis แต่ใช้ redis.asyncio และสร้าง array ใน thread แยก"""
+    if version is not None:
+        data = await _read_snapshot_async(r, version)
+        if data:
+            try:
+                return await asyncio.to_thread(MovieCatalog.from_snapshot, version, data)
+            except ValueError as e:
+                log.warning(f"Catalog snapshot unreadable, loading from manifest: {e}")
+    manifest = await r.hgetall(manifest_key(version)) if version is not None else {}
+    if manifest:
+        keys = [movie_key(movie_id, content_hash) for movie_id, content_hash in manifest.items()]
+    else:
+        keys = [key async for key in r.scan_iter("movie:*") if _is_legacy_movie_key(key)]
+    pipe = r.pipeline()
+    for key in keys:
+        pipe.hgetall(key)
+    results = await pipe.execute()
+    return await asyncio.to_thread(_build_catalog, version, keys, results)
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+_catalog_async_lock = asyncio.Lock()
+
+
+def _is_stale(catalog, version):
+    if catalog is None:
+        return True
+    if version is None:
+        return catalog.version is not None or time.monotonic() - catalog.built_at > CATALOG_REFRESH_SECONDS
+    return catalog.version != version
+
+
+def _log_rebuilt(catalog, start):
+    log.info(
+        f"Catalog rebuilt: {len(catalog)} movies, version={catalog.version}, "
+        f"took {time.perf_counter() - start:.3f}s"
+    )
+
+
+async def fetch_movie_async(r, movie_id):
+    """hash ของหนังหนึ่งเรื่องใน generation ปัจจุบัน (ใช้ตอนหนังยังไม่อยู่ใน catalog ของ worker)"""
+    version = await r.get(CATALOG_VERSION_KEY)
+    content_hash = await r.hget(manifest_key(version), movie_id) if version is not None else None
+    if content_hash:
+        return await r.hgetall(movie_key(movie_id, content_hash))
+    return await r.hgetall(f"movie:{movie_id}")
+
+
+async def fetch_synopses_async(r, catalog, indices):
+    """synopsis ของหนังตาม index ใน catalog
+
+    catalog จาก snapshot ไม่มี synopsis จึงอ่านจาก hash ของ generation นั้นเฉพาะเรื่องที่จะแสดง
+    """
+    if catalog.synopses is not None:
+        return [str(catalog.synopses[i]) for i in indices]
+    movie_ids = [str(catalog.movie_ids[i]) for i in indices]
+    if not movie_ids:
+        return []
+    hashes = await r.hmget(manifest_key(catalog.version), movie_ids)
+    pipe = r.pipeline()
+    for movie_id, content_hash in zip(movie_ids, hashes):
+        pipe.hget(movie_key(movie_id, content_hash) if content_hash else f"movie:{movie_id}", "synopsis")
+    return [synopsis or "" for synopsis in await pipe.execute()]
+
+
+def current_catalog():
+    """catalog ที่โหลดไว้แล้วใน worker นี้ (ไม่ถาม Redis) หรือ None ถ้ายังไม่เคยโหลด"""
+    return _catalog
+
+
+def get_catalog(r):
+    """คืน catalog ของ worker นี้ rebuild ใหม่เฉพาะตอน catalog:version เปลี่ยน"""
+    global _catalog
+    version = r.get(CATALOG_VERSION_KEY)
+    catalog = _catalog
+    if not _is_stale(catalog, version):
+        return catalog
+
+    with _catalog_lock:
+        # thread อื่นอาจ rebuild ไปแล้วระหว่างรอ lock
+        if _is_stale(_catalog, version):
+            start = time.perf_counter()
+            _catalog = load_catalog_from_redis(r, version)
+            _log_rebuilt(_catalog, start)
+        return _catalog
+
+
+async def get_catalog_async(r):
+    """get_catalog สำหรับ async endpoint (r เป็น redis.asyncio client)"""
+    global _catalog
+    version = await r.get(CATALOG_VERSION_KEY)
+    catalog = _catalog
+    if not _is_stale(catalog, version):
+        return catalog
+
+    async with _catalog_async_lock:
+        if _is_stale(_catalog, version):
+            start = time.perf_counter()
+            _catalog = await load_catalog_from_redis_async(r, version)
+            _log_rebuilt(_catalog, start)
+        return _catalog
@@ -0,0 +1,248 @@
+import json
+import struct
+import tempfile
+from array import array
+import numpy as np
+
+# รูปแบบไฟล์: MAGIC, uint32 ความยาว header, header (JSON), แล้วตามด้วย section ที่เป็น array ต่อกัน
+# ทุก section เริ่มที่ offset หาร 8 ลงตัว อ่านด้วย np.frombuffer ได้โดยไม่ต้อง copy
+SNAPSHOT_MAGIC = b"CSNAP002"
+_HEADER_LEN = struct.Struct("<I")
+_ALIGN = 8
+# ลำดับของ string ของแต่ละเรื่องใน string table (synopsis ไม่อยู่ใน snapshot อ่านจาก hash เฉพาะเรื่องที่แสดง)
+STRING_COLUMNS = ("name", "poster")
+# ขนาดต่อคำสั่งตอนเขียน/อ่าน snapshot กับ Redis (APPEND/GETRANGE) ไม่ให้คำสั่งเดียว block Redis นาน
+SNAPSHOT_CHUNK_BYTES = 4 * 1024 * 1024
+# section ที่สะสมใน memory เกินนี้จะถูกเขียนต่อท้าย temp file
+_SPILL_BYTES = 1024 * 1024
+
+
+def snapshot_key(version):
+    """catalog ทั้ง generation ในรูป binary ก้อนเดียว"""
+    return f"catalog:{version}:snapshot"
+
+
+class _Table:
+    """ค่าที่ซ้ำกันบ่อย (genre, streaming service) เก็บครั้งเดียวแล้วอ้างด้วย index"""
+
+    def __init__(self):
+        self.values = []
+        self._index = {}
+
+    def code(self, value):
+        code = self._index.get(value)
+        if code is None:
+            code = self._index[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class _Section:
+    """array ของ section หนึ่ง สะสมใน buffer เล็ก ๆ แล้วเขียนต่อท้าย temp file"""
+
+    def __init__(self, typecode, dtype):
+        self.dtype = dtype
+        self.count = 0
+        self._buffer = array(typecode)
+        self._file = tempfile.TemporaryFile()
+
+    @property
+    def nbytes(self):
+        return self.count * np.dtype(self.dtype).itemsize
+
+    def append(self, value):
+        self._buffer.append(value)
+        self.count += 1
+        self._maybe_spill()
+
+    def extend(self, values):
+        n = len(self._buffer)
+        self._buffer.extend(values)
+        self.count += len(self._buffer) - n
+        self._maybe_spill()
+
+    def frombytes(self, data):
+        self._buffer.frombytes(data)
+        self.count += len(data)
+        self._maybe_spill()
+
+    def _maybe_spill(self):
+        if len(self._buffer) * self._buffer.itemsize >= _SPILL_BYTES:
+            self._spill()
+
+    def _spill(self):
+        self._file.write(np.asarray(self._buffer, dtype=self.dtype).tobytes())
+        del self._buffer[:]
+
+    def chunks(self, size):
+        self._spill()
+        self._file.seek(0)
+        while True:
+            data = self._file.read(size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self._file.close()
+
+
+class SnapshotBuilder:
+    """สะสมหนังทีละเรื่องเป็น array แบบ columnar แล้วเขียน snapshot ออกทีละ chunk
+
+    แต่ละ section พักไว้ใน temp file ไม่ใช่ใน memory หน่วยความจำจึงไม่โตตามขนาด catalog
+    """
+
+    def __init__(self):
+        self.ids = _Section("q", "<i8")
+        self.valence = _Section("d", "<f8")
+        self.arousal = _Section("d", "<f8")
+        self.has_emotion = _Section("B", "|u1")
+        # genre แรกของหนัง (lowercase) เป็น index เข้า genre_vocab, -1 = ไม่มี genre
+        self.genre_codes = _Section("i", "<i4")
+        self.genre_vocab = _Table()
+        # genre ทั้งหมดของหนังแต่ละเรื่อง (ตัวพิมพ์เดิม) แบบ CSR: genre_items[genre_offsets[i]:genre_offsets[i+1]]
+        self.genres = _Table()
+        self.genre_offsets = _Section("q", "<i8")
+        self.genre_items = _Section("i", "<i4")
+        self.links = _Table()
+        self.link_offsets = _Section("q", "<i8")
+        self.link_items = _Section("i", "<i4")
+        # string table: name, poster ของทุกเรื่องต่อกันใน strings
+        # string ที่ k อยู่ที่ strings[string_offsets[k]:string_offsets[k+1]] (เรื่องที่ i คือ k = 2i, 2i+1)
+        self.string_offsets = _Section("q", "<i8")
+        self.strings = _Section("B", "|u1")
+        for offsets in (self.genre_offsets, self.link_offsets, self.string_offsets):
+            offsets.append(0)
+
+    def __len__(self):
+        return self.ids.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _sections(self):
+        return [
+            ("ids", self.ids),
+            ("valence", self.valence),
+            ("arousal", self.arousal),
+            ("has_emotion", self.has_emotion),
+            ("genre_codes", self.genre_codes),
+            ("genre_offsets", self.genre_offsets),
+            ("genre_items", self.genre_items),
+            ("link_offsets", self.link_offsets),
+            ("link_items", self.link_items),
+            ("string_offsets", self.string_offsets),
+            ("strings", self.strings),
+        ]
+
+    def _add_string(self, value):
+        self.strings.frombytes(value.encode("utf-8"))
+        self.string_offsets.append(self.strings.count)
+
+    def add(self, movie_id, name, genres, links, emotion, poster):
+        self.ids.append(int(movie_id))
+        if emotion is not None and len(emotion) >= 2:
+            self.valence.append(float(emotion[0]))
+            self.arousal.append(float(emotion[1]))
+            self.has_emotion.append(1)
+        else:
+            self.valence.append(0.0)
+            self.arousal.append(0.0)
+            self.has_emotion.append(0)
+
+        genres = [str(g) for g in genres or []]
+        self.genre_codes.append(self.genre_vocab.code(genres[0].lower()) if genres else -1)
+        self.genre_items.extend([self.genres.code(g) for g in genres])
+        self.genre_offsets.append(self.genre_items.count)
+        self.link_items.extend([self.links.code(link) for link in links or []])
+        self.link_offsets.append(self.link_items.count)
+
+        self._add_string(name or "")
+        self._add_string(poster or "")
+
+    def _header(self):
+        layout = {}
+        offset = 0
+        for name, section in self._sections():
+            layout[name] = [offset, section.dtype, section.count]
+            offset += section.nbytes + (-section.nbytes) % _ALIGN
+
+        header = json.dumps({
+            "count": len(self),
+            "genre_vocab": self.genre_vocab.values,
+            "genres": self.genres.values,
+            "links": self.links.values,
+            "sections": layout,
+        }).encode("utf-8")
+        header += b" " * ((-(len(SNAPSHOT_MAGIC) + _HEADER_LEN.size + len(header))) % _ALIGN)
+        return SNAPSHOT_MAGIC + _HEADER_LEN.pack(len(header)) + header, offset
+
+    @property
+    def nbytes(self):
+        header, body = self._header()
+        return len(header) + body
+
+    def chunks(self, size=SNAPSHOT_CHUNK_BYTES):
+        """bytes ของ snapshot ทีละชิ้น (ไม่เกิน size) ต่อกันแล้วได้ snapshot ทั้งก้อน"""
+        header, _ = self._header()
+        yield header
+        for _, section in self._sections():
+            yield from section.chunks(size)
+            if section.nbytes % _ALIGN:
+                yield b"\0" * ((-section.nbytes) % _ALIGN)
+
+    def close(self):
+        for _, section in self._sections():
+            section.close()
+
+
+def unpack_snapshot(data):
+    """คืน (header, {ชื่อ section: numpy array}) โดย array ชี้เข้า data ตรง ๆ ไม่ copy"""
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError("Not a catalog snapshot")
+    start = len(SNAPSHOT_MAGIC)
+    (header_len,) = _HEADER_LEN.unpack_from(data, start)
+    start += _HEADER_LEN.size
+    header = json.loads(bytes(data[start:start + header_len]))
+    base = start + header_len
+    arrays = {
+        name: np.frombuffer(data, dtype=dtype, count=count, offset=base + offset)
+        for name, (offset, dtype, count) in header["sections"].items()
+    }
+    return header, arrays
+
+
+class StringColumn:
+    """string column หนึ่งใน string table decode เฉพาะเรื่องที่ถูกอ่าน"""
+
+    def __init__(self, strings, offsets, column):
+        self._strings = memoryview(strings)
+        self._offsets = offsets
+        self._column = STRING_COLUMNS.index(column)
+
+    def __len__(self):
+        return (len(self._offsets) - 1) // len(STRING_COLUMNS)
+
+    def __getitem__(self, i):
+        k = int(i) * len(STRING_COLUMNS) + self._column
+        return str(self._strings[self._offsets[k]:self._offsets[k + 1]], "utf-8")
+
+
+class ListColumn:
+    """list ของค่าจาก table ต่อเรื่อง (CSR: items[offsets[i]:offsets[i+1]])"""
+
+    def __init__(self, offsets, items, table):
+        self._offsets = offsets
+        self._items = items
+        self._table = table
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        i = int(i)
+        return [self._table[code] for code in self._items[self._offsets[i]:self._offsets[i + 1]]]
@@ -1,13 +1,228 @@
 import os
-import psycopg2 
+import time
+import threading
+import logging
+import asyncio
+import asyncpg
+import psycopg2
+from psycopg2 import pool, extensions
+from contextlib import contextmanager, asynccontextmanager
 from dotenv import load_dotenv , find_dotenv
 load_dotenv()
-def get_connection():
-        return psycopg2.connect(
-            dbname = os.getenv('PG_DBNAME'),
-            user =  os.getenv('PG_USER'),
-            password = os.getenv('PG_PASSWORD'),
-            host =  os.getenv('PG_HOST'),
-            port = os.getenv('PG_PORT')
-            
-    )
+
+log = logging.getLogger(__name__)
+
+PG_POOL_MIN = int(os.getenv('PG_POOL_MIN', 1))
+# จำนวน connection สูงสุดต่อ worker รวมทั้ง psycopg2 pool และ asyncpg pool
+PG_POOL_MAX = int(os.getenv('PG_POOL_MAX', 10))
+# ส่วนของ asyncpg (default ครึ่งหนึ่ง) ที่เหลือเป็นของ psycopg2 pool
+PG_ASYNC_POOL_MAX = int(os.getenv('PG_ASYNC_POOL_MAX', max(1, PG_POOL_MAX // 2)))
+PG_SYNC_POOL_MAX = max(1, PG_POOL_MAX - PG_ASYNC_POOL_MAX)
+# รอ connection ว่างได้นานสุดกี่วินาที
+PG_POOL_TIMEOUT = float(os.getenv('PG_POOL_TIMEOUT', 10))
+# connection ที่ว่างนานกว่านี้จะถูก SELECT 1 ก่อนส่งให้ผู้ใช้
+PG_POOL_HEALTHCHECK_SECONDS = float(os.getenv('PG_POOL_HEALTHCHECK_SECONDS', 30))
+
+def connection_params():
+    return {
+        'dbname': os.getenv('PG_DBNAME'),
+        'user': os.getenv('PG_USER'),
+        'password': os.getenv('PG_PASSWORD'),
+        'host': os.getenv('PG_HOST'),
+        'port': os.getenv('PG_PORT'),
+    }
+
+
+class PoolTimeout(pool.PoolError):
+    pass
+
+
+class ConnectionPool:
+    """pool ของ psycopg2 connection ที่รอได้เมื่อ connection เต็ม และเช็ค connection ที่ว่างนาน"""
+
+    def __init__(self, minconn, maxconn, timeout, healthcheck_seconds):
+        self._pool = pool.ThreadedConnectionPool(minconn, maxconn, **connection_params())
+        # ThreadedConnectionPool โยน error ทันทีเมื่อเต็ม จึงใช้ semaphore ให้รอแทน
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+        self._stats_lock = threading.Lock()
+        self.timeout = timeout
+        self.healthcheck_seconds = healthcheck_seconds
+        self.maxconn = maxconn
+        self.stats = {
+            "checkouts": 0,
+            "in_use": 0,
+            "timeouts": 0,
+            "discarded": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+        }
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        idle = time.monotonic() - self._last_used.get(id(conn), 0)
+        if idle < self.healthcheck_seconds:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def acquire(self):
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._stats_lock:
+                self.stats["timeouts"] += 1
+            raise PoolTimeout(f"No free database connection after {self.timeout}s")
+        wait_ms = (time.perf_counter() - start) * 1000
+
+        try:
+            conn = self._pool.getconn()
+            while not self._is_healthy(conn):
+                log.warning("Discarding broken pooled database connection")
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                with self._stats_lock:
+                    self.stats["discarded"] += 1
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._stats_lock:
+            self.stats["checkouts"] += 1
+            self.stats["in_use"] += 1
+            self.stats["wait_ms_total"] += wait_ms
+            self.stats["wait_ms_max"] = max(self.stats["wait_ms_max"], wait_ms)
+        return conn
+
+    def release(self, conn):
+        try:
+            broken = conn.closed
+            if not broken and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                # ไม่ส่ง connection ที่ค้าง transaction กลับเข้า pool
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            if broken:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn, close=broken)
+        finally:
+            with self._stats_lock:
+                self.stats["in_use"] -= 1
+            self._slots.release()
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["max_size"] = self.maxconn
+        stats["wait_ms_avg"] = stats["wait_ms_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        return stats
+
+    def close(self):
+        self._pool.closeall()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """สร้าง pool ครั้งแรกที่ใช้ (import db.py จะไม่ต่อ database ทันที)"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    min(PG_POOL_MIN, PG_SYNC_POOL_MAX), PG_SYNC_POOL_MAX, PG_POOL_TIMEOUT, PG_POOL_HEALTHCHECK_SECONDS
+                )
+    return _pool
+
+@contextmanager
+def db_connection():
+    """ยืม connection จาก pool แล้วคืนให้อัตโนมัติเมื่อจบ with (rollback ถ้ายังไม่ commit)"""
+    db_pool = get_pool()
+    conn = db_pool.acquire()
+    try:
+        yield conn
+    finally:
+        db_pool.release(conn)
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+# --- async (asyncpg) สำหรับ endpoint ที่เป็น async def ---
+
+_async_pool = None
+_async_pool_lock = asyncio.Lock()
+# ตัวนับเดียวกับ ConnectionPool.stats (ใช้ใน event loop ของ worker เท่านั้น จึงไม่ต้องมี lock)
+_async_stats = {
+    "checkouts": 0,
+    "in_use": 0,
+    "timeouts": 0,
+    "wait_ms_total": 0.0,
+    "wait_ms_max": 0.0,
+}
+
+async def get_async_pool():
+    """สร้าง asyncpg pool ครั้งแรกที่ใช้ใน event loop ของ worker"""
+    global _async_pool
+    if _async_pool is None:
+        async with _async_pool_lock:
+            if _async_pool is None:
+                params = connection_params()
+                _async_pool = await asyncpg.create_pool(
+                    database=params['dbname'],
+                    user=params['user'],
+                    password=params['password'],
+                    host=params['host'],
+                    port=int(params['port']) if params['port'] else None,
+                    min_size=min(PG_POOL_MIN, PG_ASYNC_POOL_MAX),
+                    max_size=PG_ASYNC_POOL_MAX,
+                    max_inactive_connection_lifetime=PG_POOL_HEALTHCHECK_SECONDS * 10,
+                )
+    return _async_pool
+
+@asynccontextmanager
+async def async_db_connection():
+    """ยืม asyncpg connection จาก pool (query ใช้ $1, $2 แทน %s)"""
+    db_pool = await get_async_pool()
+    start = time.perf_counter()
+    try:
+        conn = await db_pool.acquire(timeout=PG_POOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        _async_stats["timeouts"] += 1
+        raise
+    wait_ms = (time.perf_counter() - start) * 1000
+    _async_stats["checkouts"] += 1
+    _async_stats["in_use"] += 1
+    _async_stats["wait_ms_total"] += wait_ms
+    _async_stats["wait_ms_max"] = max(_async_stats["wait_ms_max"], wait_ms)
+    try:
+        yield conn
+    finally:
+        _async_stats["in_use"] -= 1
+        await db_pool.release(conn)
+
+def get_async_pool_stats():
+    stats = dict(_async_stats)
+    stats["max_size"] = PG_ASYNC_POOL_MAX
+    stats["wait_ms_avg"] = stats["wait_ms_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+    return stats
+
+async def close_async_pool():
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
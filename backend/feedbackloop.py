@@ -1,39 +1,57 @@
 import pandas as pd
+import numpy as np
 import joblib
 import os
+import io
+import json
+import time
 import logging
-from sklearn.ensemble import RandomForestRegressor
+from sklearn.ensemble import RandomForestRegressor, HistGradientBoostingRegressor
+from sklearn.model_selection import train_test_split
+from sklearn.metrics import mean_absolute_error, mean_squared_error
 from sklearn.preprocessing import OneHotEncoder # แม้จะโหลด แต่ก็ควร import ไว้
-from db import get_connection
+from db import db_connection
+from model_registry import publish_model, ModelVersion, REGISTRY_DIR
+from forest_engine import export_forest
+from recommender import EXPECTED_COLS
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
 
 
-MODEL_PATH = "./nlp_ml/ml_model/cinesense_model.pkl"
-OLD_MODEL_PATH = "./nlp_ml/ml_model/cinesense_model_old.pkl"
 ENCODER_PATH = "./nlp_ml/ml_model/encoder.pkl"
 MOCK_DATA_PATH = "./nlp_ml/ml_model/mock_dataset_v3.csv" 
+SELECTION_REPORT_PATH = os.path.join(REGISTRY_DIR, "last_selection_report.json")
 
-def get_feedback_data():
-    if not get_connection:
-        log.error("ฟังก์ชัน get_connection ไม่พร้อมใช้งาน")
-        return pd.DataFrame(), 0
+# งบที่ model ต้องผ่านก่อนจะ promote (predict candidate ของ genre ที่ใหญ่สุด 1 batch ผ่าน ModelVersion.predict / ขนาดไฟล์ pickle)
+MAX_PREDICT_MS = float(os.getenv("MODEL_MAX_PREDICT_MS", 50))
+MAX_ARTIFACT_MB = float(os.getenv("MODEL_MAX_ARTIFACT_MB", 20))
+DEFAULT_CATALOG_SIZE = 10000
+LATENCY_REPEAT = 5
 
-    conn = None
+# model ที่จะลองเทรนแล้วเทียบกัน
+CANDIDATE_MODELS = {
+    "rf_default": lambda: RandomForestRegressor(random_state=0, n_jobs=-1),
+    "rf_100_depth12": lambda: RandomForestRegressor(n_estimators=100, max_depth=12, random_state=0, n_jobs=-1),
+    "rf_50_depth10": lambda: RandomForestRegressor(n_estimators=50, max_depth=10, random_state=0, n_jobs=-1),
+    "rf_30_depth8": lambda: RandomForestRegressor(n_estimators=30, max_depth=8, random_state=0, n_jobs=-1),
+    "hist_gb": lambda: HistGradientBoostingRegressor(max_iter=200, random_state=0),
+}
+
+def get_feedback_data():
     try:
-        conn = get_connection()
-        cur = conn.cursor()
-        
-        # ดึงข้อมูลที่จำเป็นสำหรับการเทรน
-        cur.execute("""
-            SELECT user_valence, user_arousal, user_genre, 
-                   movie_valence, movie_arousal, movie_genre, vote AS matching_rate
-            FROM feedback
-        """)
-        data = cur.fetchall()
-        count = len(data)
+        with db_connection() as conn:
+            cur = conn.cursor()
+            
+            # ดึงข้อมูลที่จำเป็นสำหรับการเทรน
+            cur.execute("""
+                SELECT user_valence, user_arousal, user_genre, 
+                       movie_valence, movie_arousal, movie_genre, vote AS matching_rate
+                FROM feedback
+            """)
+            data = cur.fetchall()
+            cur.close()
 
         columns = [
             'user_valence', 'user_arousal', 'user_genre',
@@ -52,13 +70,7 @@ def get_feedback_data():
     
     except Exception as e:
         log.error(f"เกิดข้อผิดพลาดในการดึงข้อมูลจาก PostgreSQL: {e}")
-        if conn:
-            conn.rollback()
         return pd.DataFrame(), 0
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
 
 def preprocess_data(df, encoder_path):
     try:
@@ -87,24 +99,118 @@ def preprocess_data(df, encoder_path):
         log.error(f"เกิดข้อผิดพลาดระหว่าง Preprocessing: {e}")
         return None, None
 
-def train_and_save_model(X, y, model_path, old_model_path):
+def get_candidate_sizes():
+    """จำนวนหนังต่อ genre ใน catalog จริง (= ขนาด candidate set ที่ /submit ส่งให้ model) ใช้เป็นขนาด batch ตอนวัด latency"""
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT COUNT(DISTINCT movie_id)
+                FROM movies, unnest(movie_genre) AS genre
+                GROUP BY lower(genre)
+            """)
+            sizes = sorted({count for (count,) in cur.fetchall()})
+            cur.close()
+        return sizes or [DEFAULT_CATALOG_SIZE]
+    except Exception as e:
+        log.warning(f"นับจำนวนหนังต่อ genre ไม่ได้ ({e}) ใช้ค่า default {DEFAULT_CATALOG_SIZE}")
+        return [DEFAULT_CATALOG_SIZE]
+
+def measure_candidate(name, model, encoder, X_train, y_train, X_test, y_test, batches):
+    model.fit(X_train, y_train)
+    preds = model.predict(X_test)
+
+    buf = io.BytesIO()
+    joblib.dump(model, buf)
+    artifact_mb = buf.tell() / (1024 * 1024)
+
+    # วัดผ่าน ModelVersion.predict แบบเดียวกับตอน serve (FlatForest สำหรับ batch เล็ก, sklearn สำหรับ batch ใหญ่)
+    version = ModelVersion(name, model, encoder, {}, export_forest(model))
+    batch_ms = {}
+    for X_batch in batches:
+        times = []
+        for _ in range(LATENCY_REPEAT):
+            start = time.perf_counter()
+            version.predict(X_batch)
+            times.append(time.perf_counter() - start)
+        batch_ms[len(X_batch)] = round(min(times) * 1000, 3)
+    predict_ms = max(batch_ms.values())
+
+    result = {
+        "name": name,
+        "params": {k: v for k, v in model.get_params().items() if isinstance(v, (int, float, str, bool, type(None)))},
+        "holdout_mae": float(mean_absolute_error(y_test, preds)),
+        "holdout_rmse": float(np.sqrt(mean_squared_error(y_test, preds))),
+        "artifact_mb": round(artifact_mb, 3),
+        "predict_ms": round(predict_ms, 3),
+        "batch_ms": batch_ms,
+    }
+    result["within_budget"] = predict_ms <= MAX_PREDICT_MS and artifact_mb <= MAX_ARTIFACT_MB
+    log.info(
+        f"{name}: MAE={result['holdout_mae']:.4f} RMSE={result['holdout_rmse']:.4f} "
+        f"size={result['artifact_mb']}MB predict={result['predict_ms']}ms within_budget={result['within_budget']}"
+    )
+    return result
+
+def select_model(X, y, encoder):
+    """เทรน candidate ทุกตัวบน train split แล้วเลือกตัวที่ error ต่ำสุดในบรรดาตัวที่ผ่านงบ"""
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=0)
+    candidate_sizes = get_candidate_sizes()
+    batches = [
+        X.sample(n=size, replace=True, random_state=0)[EXPECTED_COLS].to_numpy(dtype=np.float64)
+        for size in candidate_sizes
+    ]
+
+    results = []
+    for name, factory in CANDIDATE_MODELS.items():
+        try:
+            results.append(measure_candidate(name, factory(), encoder, X_train, y_train, X_test, y_test, batches))
+        except Exception as e:
+            log.error(f"เทรน candidate {name} ไม่สำเร็จ: {e}")
+
+    passed = [r for r in results if r["within_budget"]]
+    selected = min(passed, key=lambda r: r["holdout_mae"]) if passed else None
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "budget": {"max_predict_ms": MAX_PREDICT_MS, "max_artifact_mb": MAX_ARTIFACT_MB},
+        "candidate_sizes": candidate_sizes,
+        "train_rows": len(X_train),
+        "test_rows": len(X_test),
+        "candidates": results,
+        "selected": selected["name"] if selected else None,
+    }
+    return selected, report
+
+def write_selection_report(report):
+    os.makedirs(REGISTRY_DIR, exist_ok=True)
+    with open(SELECTION_REPORT_PATH, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    log.info(f"เขียนรายงานเปรียบเทียบ model ที่: {SELECTION_REPORT_PATH}")
+
+def train_and_save_model(X, y, encoder_path):
 
     try:
-        log.info("กำลังเริ่มต้นการเทรนโมเดล (RandomForestRegressor)...")
-        model = RandomForestRegressor(random_state=0, n_jobs=-1)
+        log.info(f"กำลังเทียบ candidate model {len(CANDIDATE_MODELS)} แบบ...")
+        selected, report = select_model(X, y, joblib.load(encoder_path))
+        write_selection_report(report)
+
+        if selected is None:
+            log.error("ไม่มี model ที่ผ่านงบ latency/ขนาดไฟล์. ไม่ promote model ใหม่")
+            return
+
+        # เทรนตัวที่เลือกใหม่ด้วยข้อมูลทั้งหมดก่อนบันทึก
+        log.info(f"กำลังเทรน {selected['name']} ด้วยข้อมูลทั้งหมด...")
+        model = CANDIDATE_MODELS[selected["name"]]()
         model.fit(X, y)
         log.info("เทรนโมเดลสำเร็จ")
 
-        if os.path.exists(model_path):
-            if os.path.exists(old_model_path):
-                os.remove(old_model_path)
-                log.info(f"ลบไฟล์เก่าทิ้ง: {old_model_path}")
-                
-            os.rename(model_path, old_model_path)
-            log.info(f"ย้ายโมเดลเก่าไปที่: {old_model_path}")
-            
-        joblib.dump(model, model_path)
-        log.info(f"เซฟโมเดลใหม่สำเร็จที่: {model_path}")
+        # บันทึกเป็น version ใหม่ใน registry, worker ของ API จะสลับไปใช้เองโดยไม่ต้อง restart
+        model_id = publish_model(
+            model, encoder_path, X.columns,
+            n_rows=len(X), model_type=type(model).__name__,
+            report=report, candidate=selected["name"]
+        )
+        log.info(f"เซฟโมเดลใหม่สำเร็จ version: {model_id}")
         
     except Exception as e:
         log.error(f"เกิดข้อผิดพลาดระหว่างเทรนหรือเซฟโมเดล: {e}")
@@ -144,7 +250,7 @@ def run_feedback_loop():
         log.error("ไม่สามารถเตรียมข้อมูลได้. ยกเลิกการเทรน")
         return
 
-    train_and_save_model(X, y, MODEL_PATH, OLD_MODEL_PATH)
+    train_and_save_model(X, y, ENCODER_PATH)
     
     log.info("--- Feedback Loop เสร็จสิ้น ---")
 
@@ -1,18 +1,63 @@
-import requests
 import asyncio
 import aiohttp
 import csv
+import sys
+import time
+import resource
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 import os
 from dotenv import load_dotenv
-from db import get_connection
-from nlp_ml.nlp_synopsis import analyze_va
+from db import db_connection
+from http_cache import response_cache
+from rate_limit import AdaptiveRateLimiter, parse_retry_after, backoff_delay
+from nlp_ml.nlp_synopsis import analyze_va_batch
 from psycopg2.extras import execute_values
 
 load_dotenv()
 
-#Fetch ข้อมูลจาก TMDB
-url = os.getenv('URL')
+#Fetch ข้อมูลจาก TMDB (เปลี่ยน TMDB_BASE_URL ไปที่ stub server ตอนทดสอบได้)
+TMDB_BASE_URL = os.getenv('TMDB_BASE_URL', 'https://api.themoviedb.org/3').rstrip('/')
+url = os.getenv('URL', f"{TMDB_BASE_URL}/discover/movie")
+
+# เกณฑ์หนังที่เก็บเข้า catalog (เหมือน params ของ discover)
+MIN_VOTE_AVERAGE = 6
+MIN_VOTE_COUNT = 300
+# TMDB /movie/changes ขอช่วงวันที่ได้ไม่เกิน 14 วันต่อ request
+CHANGES_WINDOW_DAYS = 14
+# หนังที่เพิ่งผ่านเกณฑ์ส่วนใหญ่เป็นหนังใหม่ โหมด incremental ค้น discover เฉพาะหนังที่ออกฉายในช่วงนี้
+NEW_RELEASE_LOOKBACK_DAYS = int(os.getenv('NEW_RELEASE_LOOKBACK_DAYS', 180))
+WATERMARK_NAME = 'tmdb_movies'
+
+# rate เริ่มต้น/ต่ำสุด/สูงสุด (request ต่อวินาที) และจำนวน request ที่ค้างพร้อมกันได้สูงสุด
+TMDB_RATE_LIMIT = float(os.getenv('TMDB_RATE_LIMIT', 40))
+TMDB_MIN_RATE = float(os.getenv('TMDB_MIN_RATE', 1))
+TMDB_MAX_RATE = float(os.getenv('TMDB_MAX_RATE', 50))
+TMDB_MAX_CONCURRENCY = int(os.getenv('TMDB_MAX_CONCURRENCY', 20))
+# retry เมื่อโดน 429, 5xx หรือ network error (backoff แบบ exponential + jitter)
+TMDB_MAX_RETRIES = int(os.getenv('TMDB_MAX_RETRIES', 5))
+TMDB_BACKOFF_BASE = float(os.getenv('TMDB_BACKOFF_BASE', 0.5))
+TMDB_BACKOFF_MAX = float(os.getenv('TMDB_BACKOFF_MAX', 30))
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# ขนาดคิวระหว่าง stage ของ pipeline (จำกัดหน่วยความจำ: หนังที่ค้างอยู่ในคิวมีไม่เกินนี้ต่อคิว)
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', 500))
+# จำนวนหนังต่อ batch ของ VA scoring และ upsert
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 100))
+# จำนวน coroutine ที่ดึง discover page พร้อมกัน (rate จริงคุมโดย limiter)
+DISCOVER_WORKERS = 4
+# process ที่ใช้รัน analyze_va_batch (ใช้ CPU ล้วน)
+VA_WORKERS = int(os.getenv('VA_WORKERS', min(4, os.cpu_count() or 1)))
+
+# ตัวเลขของรอบนี้ requests ไม่นับที่อ่านจาก cache, failures = request ที่ retry ครบแล้วยังไม่สำเร็จ
+request_stats = {"requests": 0, "retries": 0, "failures": 0, "skipped_pages": 0, "skipped_movies": 0}
+
+limiter = AdaptiveRateLimiter(TMDB_RATE_LIMIT, TMDB_MIN_RATE, TMDB_MAX_RATE, TMDB_MAX_CONCURRENCY)
+
+
+class TMDBRequestFailed(Exception):
+    pass
 
 headers = {
     "accept": "application/json",
@@ -20,70 +65,94 @@ headers = {
 }
 
 
-async def async_get_movie_page(session, page_num):
+async def async_get_movie_page(session, page_num, **filters):
     # ใช้ params เดียวกัน แต่ส่ง page_num เข้าไป
-    url = os.getenv('URL') 
-    headers = {
-        "accept": "application/json",
-        "Authorization": os.getenv('API_KEY')
-    }
     params = {
         "language": "en-US",
         "sort_by": "vote_average.desc",
-        "vote_average.gte": 6, 
-        "vote_count.gte": 300,
-        "page": page_num
+        "vote_average.gte": MIN_VOTE_AVERAGE, 
+        "vote_count.gte": MIN_VOTE_COUNT,
+        "page": page_num,
+        **filters
     }
-    async with session.get(url, headers=headers, params=params) as response:
-        return await response.json()
+    return await fetch_json(session, url, params)
 
-async def async_get_movie_from_tmdb(num_pages=500, concurrency=20):
-    all_movies = []
-    pages_to_fetch = list(range(1, num_pages + 1)) 
-    
-    semaphore = asyncio.Semaphore(concurrency)
+async def produce_discover_movies(session, out_queue, num_pages=500, limit=10000):
+    """ส่งหนังจาก discover ทีละหน้าเข้าคิว (หยุดเมื่อครบ limit เรื่อง หรือหมดหน้า)"""
+    pages = iter(range(1, num_pages + 1))
+    state = {"emitted": 0, "total_pages": num_pages}
 
-    async with aiohttp.ClientSession() as session:
-        async def sem_task(page):
-            async with semaphore:
-                return await async_get_movie_page(session, page)
-
-        tasks = [sem_task(page) for page in pages_to_fetch]
-        
-        for i, task in enumerate(asyncio.as_completed(tasks), 1):
-            data = await task
-            if "results" in data and data["results"]:
-                all_movies.extend(data["results"])
-            
-            if i % 50 == 0:
-                print(f"Fetched {i} pages...")
-
-    return all_movies[:10000]
-
-
-def get_genre_map():
-    url = "https://api.themoviedb.org/3/genre/movie/list"
-    params = {"language": "en-US"}
-    response = requests.get(url, headers=headers, params=params)
-    data = response.json()
-    return {genre['id']: genre['name'] for genre in data['genres']}
+    async def page_worker():
+        # ทุก worker ดึงเลขหน้าจาก iterator เดียวกัน
+        for page in pages:
+            if state["emitted"] >= limit or page > state["total_pages"]:
+                return
+            try:
+                data = await async_get_movie_page(session, page)
+            except TMDBRequestFailed as e:
+                request_stats["skipped_pages"] += 1
+                print(f"Skipping discover page {page}: {e}")
+                continue
+            state["total_pages"] = min(num_pages, data.get("total_pages", num_pages))
+            for movie in data.get("results") or []:
+                if state["emitted"] >= limit:
+                    return
+                state["emitted"] += 1
+                await out_queue.put(movie)
+
+    await asyncio.gather(*(page_worker() for _ in range(DISCOVER_WORKERS)))
 
-genre_map = get_genre_map()
 
 #ใช้ async ในการ fetch directorname , streaming link เพื่อความเร็ว
-async def fetch_json(session, url):
-    async with session.get(url, headers=headers) as response:
-        return await response.json()
+async def request_json(session, url, params=None):
+    """GET ผ่าน limiter พร้อม retry คืน (status, body) หรือ raise TMDBRequestFailed เมื่อ retry ครบ"""
+    error = None
+    for attempt in range(TMDB_MAX_RETRIES + 1):
+        await limiter.acquire()
+        throttled, retry_after = False, None
+        try:
+            request_stats["requests"] += 1
+            async with session.get(url, headers=headers, params=params) as response:
+                if response.status not in RETRYABLE_STATUSES:
+                    return response.status, await response.json(content_type=None)
+                throttled = response.status == 429
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                error = f"HTTP {response.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            await limiter.release(throttled, retry_after)
 
-async def get_director_name(movie_id, session):
-    url = f"https://api.themoviedb.org/3/movie/{movie_id}/credits"
-    data = await fetch_json(session, url)
-    directors = [member['name'] for member in data.get('crew', []) if member['job'] == 'Director']
+        if attempt < TMDB_MAX_RETRIES:
+            request_stats["retries"] += 1
+            delay = retry_after if retry_after is not None else backoff_delay(attempt, TMDB_BACKOFF_BASE, TMDB_BACKOFF_MAX)
+            await asyncio.sleep(delay)
+
+    request_stats["failures"] += 1
+    raise TMDBRequestFailed(f"{url} failed after {TMDB_MAX_RETRIES + 1} attempts ({error})")
+
+async def fetch_json(session, url, params=None):
+    data = await response_cache.get_async(url, params)
+    if data is not None:
+        return data
+    status, data = await request_json(session, url, params)
+    # เก็บเฉพาะ response ที่สำเร็จ error จะถูกถามใหม่ในรอบหน้า
+    if status == 200:
+        await response_cache.put_async(url, params, data)
+    return data
+
+async def get_genre_map(session):
+    """id -> ชื่อ genre ของ TMDB (ผ่าน cache, limiter และ retry เหมือน request อื่น)"""
+    data = await fetch_json(session, f"{TMDB_BASE_URL}/genre/movie/list", {"language": "en-US"})
+    if "genres" not in data:
+        raise TMDBRequestFailed(f"Genre list unavailable: {data}")
+    return {genre['id']: genre['name'] for genre in data['genres']}
+
+def director_names(credits):
+    directors = [member['name'] for member in credits.get('crew', []) if member['job'] == 'Director']
     return directors if directors else ['N/A']
 
-async def get_streaming_link(movie_id, session, region="TH"):
-    url = f"https://api.themoviedb.org/3/movie/{movie_id}/watch/providers"
-    data = await fetch_json(session, url)
+def streaming_links(data, region="TH"):
     provider_list = []
     if 'results' in data and region in data['results']:
         region_data = data['results'][region]
@@ -93,7 +162,15 @@ async def get_streaming_link(movie_id, session, region="TH"):
         provider_list = list(set(provider_list))
     return provider_list if provider_list else ['N/A']
 
-async def process_movie(movie, session):
+async def get_director_name(movie_id, session):
+    url = f"{TMDB_BASE_URL}/movie/{movie_id}/credits"
+    return director_names(await fetch_json(session, url))
+
+async def get_streaming_link(movie_id, session, region="TH"):
+    url = f"{TMDB_BASE_URL}/movie/{movie_id}/watch/providers"
+    return streaming_links(await fetch_json(session, url), region)
+
+async def process_movie(movie, session, genre_map):
     movie_id = movie['id']
     director_task = get_director_name(movie_id, session)
     link_task = get_streaming_link(movie_id, session)
@@ -101,7 +178,7 @@ async def process_movie(movie, session):
     return {
         "id": movie_id,
         "title": movie['title'],
-        "genre_ids": movie.get("genre_ids", []),
+        "genres": [genre_map.get(gid, "N/A") for gid in movie.get("genre_ids", [])],
         "rating": movie.get("vote_average"),
         "synopsis": movie.get("overview"),
         "poster_path": movie.get("poster_path"),
@@ -109,85 +186,404 @@ async def process_movie(movie, session):
         "link": link
     }
 
-async def fetch_all_movies_parallel(movies, concurrency=20):
-    semaphore = asyncio.Semaphore(concurrency)
-    results = []
+async def get_movie_details(movie_id, session):
+    """รายละเอียด + credits + watch providers ของหนังหนึ่งเรื่องใน request เดียว (append_to_response)
 
-    async with aiohttp.ClientSession() as session:
-        async def sem_task(movie):
-            async with semaphore:
-                return await process_movie(movie, session)
-
-        tasks = [sem_task(m) for m in movies]
-        for i, task in enumerate(asyncio.as_completed(tasks), 1):
-            movie_data = await task
-            results.append(movie_data)
-            if i % 100 == 0:
-                print(f"Processed {i} movies...")
+    คืน None ถ้าหนังถูกลบจาก TMDB แล้ว
+    """
+    url = f"{TMDB_BASE_URL}/movie/{movie_id}"
+    data = await fetch_json(session, url, {"language": "en-US", "append_to_response": "credits,watch/providers"})
+    if "id" not in data:
+        return None
+    return {
+        "id": data["id"],
+        "title": data.get("title"),
+        "genres": [genre["name"] for genre in data.get("genres", [])],
+        "rating": data.get("vote_average"),
+        "vote_count": data.get("vote_count", 0),
+        "synopsis": data.get("overview"),
+        "poster_path": data.get("poster_path"),
+        "director": director_names(data.get("credits", {})),
+        "link": streaming_links(data.get("watch/providers", {}))
+    }
+
+async def fetch_all_pages(session, fetch_page):
+    """ดึงหน้าแรกเพื่อรู้ total_pages แล้วดึงหน้าที่เหลือพร้อมกัน คืน results ทั้งหมด
+
+    หน้าไหนดึงไม่สำเร็จจะ raise TMDBRequestFailed (ข้อมูลไม่ครบ ห้ามเลื่อน watermark)
+    """
+    first = await fetch_page(1)
+    results = list(first.get("results", []))
+    pages = await asyncio.gather(*(fetch_page(page) for page in range(2, first.get("total_pages", 1) + 1)))
+    for data in pages:
+        results.extend(data.get("results", []))
     return results
 
+def changes_windows(since, until):
+    """แบ่งช่วง since..until เป็นช่วงละไม่เกิน CHANGES_WINDOW_DAYS วัน"""
+    start = since
+    while start < until:
+        end = min(start + timedelta(days=CHANGES_WINDOW_DAYS), until)
+        yield start, end
+        start = end
 
-async def main_async():
-    print("Fetching movie list from TMDB...")
-    tmdb_movies = await async_get_movie_from_tmdb()
-    print(f"Total movies fetched: {len(tmdb_movies)}")
-
-    print("Fetching directors and streaming links in parallel...")
-    movies_with_details = await fetch_all_movies_parallel(tmdb_movies, concurrency=15)
-
-    #ใช้ batch insert
-    data_list = []
-    for movie in movies_with_details:
-        movie_id = movie["id"]
-        movie_name = movie["title"]
-        movie_genres = [genre_map.get(gid, "N/A") for gid in movie["genre_ids"]]
-        movie_rating = movie["rating"]
-        movie_synopsis = movie["synopsis"]
-        movie_poster = f"https://www.themoviedb.org/t/p/w1280{movie['poster_path']}" if movie["poster_path"] else None
-        movie_direct = movie["director"]
-        movie_link = movie["link"]
-        emotion_va = analyze_va(movie_synopsis)
-
-        data_list.append((
-            movie_id, movie_name, movie_genres, movie_rating, movie_synopsis,
-            movie_link, movie_direct, emotion_va, movie_poster
-        ))
-
-
-    pgconn = get_connection()
-    if not pgconn:
-        print("Cannot connect to database")
-        return
+async def get_changed_movie_ids(session, since, until):
+    """id ของหนังที่ TMDB รายงานว่ามีการแก้ไขตั้งแต่ since"""
+    changed = set()
+    for start, end in changes_windows(since, until):
+        async def fetch_page(page):
+            return await fetch_json(session, f"{TMDB_BASE_URL}/movie/changes", {
+                "start_date": start.strftime("%Y-%m-%d"),
+                "end_date": end.strftime("%Y-%m-%d"),
+                "page": page
+            })
+        changed.update(movie["id"] for movie in await fetch_all_pages(session, fetch_page))
+    return changed
+
+async def get_recent_movie_ids(session, since):
+    """id ของหนังที่ผ่านเกณฑ์และออกฉายหลัง since (ใช้หาหนังใหม่โดยไม่ต้องไล่ discover ทั้ง 500 หน้า)"""
+    async def fetch_page(page):
+        return await async_get_movie_page(session, page, **{"primary_release_date.gte": since.strftime("%Y-%m-%d")})
+    return {movie["id"] for movie in await fetch_all_pages(session, fetch_page)}
+
+def get_watermark(pgconn):
+    with pgconn.cursor() as cur:
+        cur.execute("SELECT watermark FROM ingest_state WHERE name = %s", (WATERMARK_NAME,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+def set_watermark(pgconn, watermark):
+    with pgconn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO ingest_state (name, watermark) VALUES (%s, %s)
+            ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark
+        """, (WATERMARK_NAME, watermark))
+    pgconn.commit()
+
+def get_stored_movies(pgconn, movie_ids=None):
+    """{movie_id: (synopsis, emotion)} ของหนังที่มีอยู่แล้ว ใช้ข้ามการวิเคราะห์ VA ของเรื่องที่ synopsis ไม่เปลี่ยน"""
+    with pgconn.cursor() as cur:
+        if movie_ids is None:
+            cur.execute("SELECT movie_id, movie_synopsis, movie_emotion FROM movies")
+        else:
+            cur.execute(
+                "SELECT movie_id, movie_synopsis, movie_emotion FROM movies WHERE movie_id = ANY(%s)",
+                (list(movie_ids),)
+            )
+        return {movie_id: (synopsis, emotion) for movie_id, synopsis, emotion in cur.fetchall()}
+
+
+def movie_row(movie, emotion_va):
+    movie_id = movie["id"]
+    movie_name = movie["title"]
+    movie_genres = movie["genres"]
+    movie_rating = movie["rating"]
+    movie_synopsis = movie["synopsis"]
+    movie_poster = f"https://www.themoviedb.org/t/p/w1280{movie['poster_path']}" if movie["poster_path"] else None
+    movie_direct = movie["director"]
+    movie_link = movie["link"]
+    return (
+        movie_id, movie_name, movie_genres, movie_rating, movie_synopsis,
+        movie_link, movie_direct, emotion_va, movie_poster
+    )
+
+
+def upsert_movies(pgconn, batch):
+    """upsert หนังหนึ่ง batch แถวที่ข้อมูลเหมือนเดิมจะไม่ถูกเขียนซ้ำ คืนจำนวนแถวที่เขียนจริง"""
+    cur = pgconn.cursor()
+    insert_query = """
+        INSERT INTO movies (movie_id, movie_name, movie_genre, movie_rating, movie_synopsis,
+                            movie_link, movie_direct, movie_emotion, movie_poster)
+        VALUES %s
+        ON CONFLICT (movie_id) DO UPDATE SET
+            movie_name = EXCLUDED.movie_name,
+            movie_genre = EXCLUDED.movie_genre,
+            movie_rating = EXCLUDED.movie_rating,
+            movie_synopsis = EXCLUDED.movie_synopsis,
+            movie_link = EXCLUDED.movie_link,
+            movie_direct = EXCLUDED.movie_direct,
+            movie_emotion = EXCLUDED.movie_emotion,
+            movie_poster = EXCLUDED.movie_poster
+        WHERE (movies.movie_name, movies.movie_genre, movies.movie_rating, movies.movie_synopsis,
+               movies.movie_link, movies.movie_direct, movies.movie_emotion, movies.movie_poster)
+            IS DISTINCT FROM
+              (EXCLUDED.movie_name, EXCLUDED.movie_genre, EXCLUDED.movie_rating, EXCLUDED.movie_synopsis,
+               EXCLUDED.movie_link, EXCLUDED.movie_direct, EXCLUDED.movie_emotion, EXCLUDED.movie_poster)
+        RETURNING movie_id;
+    """
+    written = len(execute_values(cur, insert_query, batch, page_size=len(batch), fetch=True))
+    pgconn.commit()
+    return written
+
+
+class StageStats:
+    """ตัวนับของ stage หนึ่งใน pipeline: จำนวนที่ทำเสร็จ และเวลาที่ใช้ทำงานจริง (ไม่นับเวลารอคิว)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.max_queue = 0
 
+    def record(self, items, started):
+        self.items += items
+        self.busy_seconds += time.perf_counter() - started
+
+    def summary(self, elapsed):
+        return (
+            f"{self.name}: {self.items} ({self.items / elapsed if elapsed else 0:.1f}/s), "
+            f"busy {self.busy_seconds:.1f}s, max queue {self.max_queue}"
+        )
+
+
+async def _put(queue, item, stats):
+    await queue.put(item)
+    stats.max_queue = max(stats.max_queue, queue.qsize())
+
+
+async def run_ingest_pipeline(produce, fetch_details, keep=None):
+    """pipeline แบบ stream: produce -> ดึงรายละเอียด -> วิเคราะห์ VA -> upsert ทีละ batch
+
+    produce(queue) ใส่ของที่จะส่งให้ fetch_details(item) ลงคิว, fetch_details คืน dict ของหนังหรือ None
+    ทุก stage ทำงานซ้อนกันและเชื่อมด้วยคิวขนาดจำกัด คืน (จำนวนหนังที่ดึงได้, แถวที่เขียน, stats ของแต่ละ stage)
+    """
+    loop = asyncio.get_running_loop()
+    source_queue = asyncio.Queue(INGEST_QUEUE_SIZE)
+    detail_queue = asyncio.Queue(INGEST_QUEUE_SIZE)
+    row_queue = asyncio.Queue(max(1, INGEST_QUEUE_SIZE // INGEST_BATCH_SIZE))
+    stats = {name: StageStats(name) for name in ("source", "details", "va", "write")}
+    result = {"written": 0, "failed_batches": 0, "analyzed": 0}
+    va_pool = ProcessPoolExecutor(max_workers=VA_WORKERS)
+
+    class _CountingQueue:
+        # ให้ produce ใส่ของผ่าน put() ตามปกติ แต่นับจำนวนและขนาดคิวให้ด้วย
+        async def put(self, item):
+            stats["source"].items += 1
+            await _put(source_queue, item, stats["source"])
+
+    async def source_stage():
+        started = time.perf_counter()
+        try:
+            await produce(_CountingQueue())
+        finally:
+            stats["source"].busy_seconds += time.perf_counter() - started
+        for _ in range(TMDB_MAX_CONCURRENCY):
+            await source_queue.put(None)
+
+    async def detail_worker():
+        while (item := await source_queue.get()) is not None:
+            started = time.perf_counter()
+            try:
+                movie = await fetch_details(item)
+            except (TMDBRequestFailed, KeyError, TypeError, ValueError) as e:
+                # ดึงไม่สำเร็จหรือ response ของเรื่องนั้นผิดรูปแบบ จะไม่ upsert เรื่องนั้น (ไม่เขียน 'N/A' ทับข้อมูลเดิม)
+                request_stats["skipped_movies"] += 1
+                print(f"Skipping movie {item.get('id') if isinstance(item, dict) else item}: {type(e).__name__}: {e}")
+                continue
+            stats["details"].record(1, started)
+            if movie is not None and (keep is None or keep(movie)):
+                await _put(detail_queue, movie, stats["details"])
+
+    async def detail_stage():
+        await asyncio.gather(*(detail_worker() for _ in range(TMDB_MAX_CONCURRENCY)))
+        await detail_queue.put(None)
+
+    async def score_batch(batch):
+        started = time.perf_counter()
+        stored = await asyncio.to_thread(load_stored_movies, [movie["id"] for movie in batch])
+        # เรื่องที่ synopsis เหมือนเดิมใช้ค่า emotion เดิม ไม่ต้องวิเคราะห์ใหม่
+        emotions = {}
+        to_analyze = []
+        for movie in batch:
+            stored_synopsis, stored_emotion = stored.get(movie["id"], (None, None))
+            if stored_emotion is not None and stored_synopsis == movie["synopsis"]:
+                emotions[movie["id"]] = stored_emotion
+            else:
+                to_analyze.append(movie)
+        # แบ่ง synopsis ที่ต้องวิเคราะห์เป็นก้อนละ process แต่ละก้อนคิดด้วย analyze_va_batch ครั้งเดียว
+        chunk_size = max(1, -(-len(to_analyze) // VA_WORKERS))
+        chunks = [to_analyze[i:i + chunk_size] for i in range(0, len(to_analyze), chunk_size)]
+        scores = await asyncio.gather(
+            *(loop.run_in_executor(va_pool, analyze_va_batch, [movie["synopsis"] for movie in chunk]) for chunk in chunks)
+        )
+        for chunk, chunk_scores in zip(chunks, scores):
+            for movie, emotion_va in zip(chunk, chunk_scores):
+                emotions[movie["id"]] = emotion_va
+        result["analyzed"] += len(to_analyze)
+        stats["va"].record(len(batch), started)
+        await _put(row_queue, [movie_row(movie, emotions[movie["id"]]) for movie in batch], stats["va"])
+
+    async def va_stage():
+        # score หลาย batch ซ้อนกัน (ค้างได้ไม่เกิน VA_WORKERS batch) process pool จะไม่ว่างระหว่างโหลดข้อมูลเดิมหรือรอคิว
+        pending = set()
+
+        async def submit(batch):
+            if len(pending) >= VA_WORKERS:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                pending.difference_update(done)
+                for task in done:
+                    task.result()
+            pending.add(asyncio.create_task(score_batch(batch)))
+
+        try:
+            batch = []
+            while (movie := await detail_queue.get()) is not None:
+                batch.append(movie)
+                if len(batch) >= INGEST_BATCH_SIZE:
+                    await submit(batch)
+                    batch = []
+            if batch:
+                await submit(batch)
+            await asyncio.gather(*pending)
+        finally:
+            for task in pending:
+                task.cancel()
+        await row_queue.put(None)
+
+    def load_stored_movies(movie_ids):
+        with db_connection() as pgconn:
+            stored = get_stored_movies(pgconn, movie_ids)
+            pgconn.rollback()
+        return stored
+
+    def write_batch(rows):
+        with db_connection() as pgconn:
+            try:
+                return upsert_movies(pgconn, rows)
+            except Exception:
+                pgconn.rollback()
+                raise
+
+    async def write_stage():
+        while (rows := await row_queue.get()) is not None:
+            started = time.perf_counter()
+            try:
+                result["written"] += await asyncio.to_thread(write_batch, rows)
+            except Exception as e:
+                result["failed_batches"] += 1
+                print(f"Error saving movies: {e}")
+                continue
+            stats["write"].record(len(rows), started)
+            print(f"Inserted {stats['write'].items} movies ({result['written']} changed)...")
+
+    stages = [asyncio.create_task(stage()) for stage in (source_stage, detail_stage, va_stage, write_stage)]
     try:
-        cur = pgconn.cursor()
-        insert_query = """
-            INSERT INTO movies (movie_id, movie_name, movie_genre, movie_rating, movie_synopsis,
-                                movie_link, movie_direct, movie_emotion, movie_poster)
-            VALUES %s
-            ON CONFLICT (movie_id) DO UPDATE SET
-                movie_name = EXCLUDED.movie_name,
-                movie_genre = EXCLUDED.movie_genre,
-                movie_rating = EXCLUDED.movie_rating,
-                movie_synopsis = EXCLUDED.movie_synopsis,
-                movie_link = EXCLUDED.movie_link,
-                movie_direct = EXCLUDED.movie_direct,
-                movie_emotion = EXCLUDED.movie_emotion,
-                movie_poster = EXCLUDED.movie_poster;
-        """
-        batch_size = 100
-        for i in range(0, len(data_list), batch_size):
-            batch = data_list[i:i + batch_size]
-            execute_values(cur, insert_query, batch)
-            pgconn.commit()
-            print(f"Inserted {i + len(batch)} / {len(data_list)} movies...")
+        await asyncio.gather(*stages)
+    finally:
+        # stage หนึ่งล้ม stage อื่นจะรอคิวไปตลอด ต้อง cancel ทิ้ง
+        for task in stages:
+            task.cancel()
+        va_pool.shutdown(cancel_futures=True)
+    print(f"Analyzed VA for {result['analyzed']} synopses ({stats['va'].items - result['analyzed']} unchanged).")
+    return stats["details"].items, result, stats
+
 
+def update_watermark(pgconn, run_started_at, failed_batches=0):
+    # รอบ incremental ถัดไปเริ่มจากเวลาที่รอบนี้เริ่ม ถ้ามีอะไรดึงหรือเขียนไม่สำเร็จให้รอบหน้าถามช่วงเดิมซ้ำ
+    if request_stats["failures"] or failed_batches:
+        print(
+            f"Watermark not advanced: {request_stats['failures']} TMDB requests failed, "
+            f"{failed_batches} batches not saved"
+        )
+        return
+    set_watermark(pgconn, run_started_at)
+
+
+def print_run_summary(mode, started, fetched, written, stages=None):
+    elapsed = time.perf_counter() - started
+    print(
+        f"{mode} ingestion: {request_stats['requests']} TMDB requests "
+        f"({request_stats['requests'] / elapsed if elapsed else 0:.1f} req/s), "
+        f"{response_cache.stats['hits']} served from cache, {fetched} movies fetched, "
+        f"{written} rows written, {elapsed:.1f}s"
+    )
+    print(
+        f"Retries: {request_stats['retries']}, throttled (429): {limiter.stats['throttled']}, "
+        f"failed requests: {request_stats['failures']}, skipped pages: {request_stats['skipped_pages']}, "
+        f"skipped movies: {request_stats['skipped_movies']}, "
+        f"final rate {limiter.rate:.1f} req/s (min {limiter.stats['min_rate']:.1f}), "
+        f"concurrency {limiter.concurrency} (min {limiter.stats['min_concurrency']})"
+    )
+    for stage in (stages or {}).values():
+        print(f"  {stage.summary(elapsed)}")
+    # ru_maxrss บน Linux เป็น KB
+    print(f"Peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    print(f"Pruned {response_cache.prune()} expired cached responses.")
+
+
+async def main_async():
+    started = time.perf_counter()
+    run_started_at = datetime.now(timezone.utc)
+    print("Fetching movies, directors and streaming links from TMDB...")
+    async with aiohttp.ClientSession() as session:
+        try:
+            genre_map = await get_genre_map(session)
+        except TMDBRequestFailed as e:
+            print(f"Error fetching TMDB genres: {e}")
+            print_run_summary("Full", started, 0, 0)
+            return
+        fetched, result, stages = await run_ingest_pipeline(
+            lambda queue: produce_discover_movies(session, queue),
+            lambda movie: process_movie(movie, session, genre_map)
+        )
+
+    with db_connection() as pgconn:
+        update_watermark(pgconn, run_started_at, result["failed_batches"])
+    if not result["failed_batches"]:
         print("All movies saved successfully.")
-    except Exception as e:
-        print(f"Error saving movies: {e}")
+    print_run_summary("Full", started, fetched, result["written"], stages)
+
+
+async def main_incremental_async():
+    """ดึงเฉพาะหนังใหม่และหนังที่ TMDB รายงานว่าเปลี่ยนตั้งแต่รอบที่แล้ว (watermark)
+
+    ถ้ายังไม่เคยมี watermark จะทำ full ingestion แทน
+    """
+    started = time.perf_counter()
+    run_started_at = datetime.now(timezone.utc)
+    with db_connection() as pgconn:
+        watermark = get_watermark(pgconn)
+        with pgconn.cursor() as cur:
+            cur.execute("SELECT movie_id FROM movies")
+            known_ids = {row[0] for row in cur.fetchall()}
         pgconn.rollback()
-    finally:
-        pgconn.close()
+
+    if watermark is None:
+        print("No ingestion watermark yet, running full ingestion")
+        await main_async()
+        return
+
+    print(f"Fetching TMDB changes since {watermark.isoformat()}...")
+    async with aiohttp.ClientSession() as session:
+        try:
+            changed_ids = await get_changed_movie_ids(session, watermark, run_started_at)
+            recent_ids = await get_recent_movie_ids(session, run_started_at - timedelta(days=NEW_RELEASE_LOOKBACK_DAYS))
+        except TMDBRequestFailed as e:
+            # รายการเปลี่ยนแปลงไม่ครบ ไม่ upsert และไม่เลื่อน watermark
+            print(f"Error fetching TMDB changes: {e}")
+            print_run_summary("Incremental", started, 0, 0)
+            return
+        # หนังที่ยังไม่อยู่ใน catalog เพิ่มเฉพาะที่ผ่านเกณฑ์ discover, หนังเดิมอัปเดตเมื่อมีการเปลี่ยนแปลง
+        new_ids = recent_ids - known_ids
+        updated_ids = changed_ids & known_ids
+        print(f"{len(new_ids)} new movies, {len(updated_ids)} changed movies ({len(changed_ids)} changes reported)")
+
+        async def produce_ids(queue):
+            for movie_id in sorted(new_ids | updated_ids):
+                await queue.put(movie_id)
+
+        fetched, result, stages = await run_ingest_pipeline(
+            produce_ids,
+            lambda movie_id: get_movie_details(movie_id, session),
+            keep=lambda movie: movie["id"] in known_ids
+            or ((movie["rating"] or 0) >= MIN_VOTE_AVERAGE and movie["vote_count"] >= MIN_VOTE_COUNT)
+        )
+
+    with db_connection() as pgconn:
+        update_watermark(pgconn, run_started_at, result["failed_batches"])
+    if not result["failed_batches"]:
+        print("All movies saved successfully.")
+    print_run_summary("Incremental", started, fetched, result["written"], stages)
 
 if __name__ == "__main__":
-    asyncio.run(main_async())
\ No newline at end of file
+    asyncio.run(main_incremental_async() if '--incremental' in sys.argv else main_async())
@@ -0,0 +1,117 @@
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor, ExtraTreesRegressor
+from sklearn.tree import DecisionTreeRegressor
+
+# sklearn ใช้ -1 เป็น child ของ leaf
+TREE_LEAF = -1
+
+
+class FlatForest:
+    """RandomForestRegressor ที่แปลงเป็น numpy array ของ node ทุก tree ต่อกัน
+
+    ทำนายทั้ง batch แบบ vectorized โดยเดินทุก (แถว, tree) พร้อมกันทีละชั้น
+    ผลลัพธ์ตรงกับ sklearn (เปรียบเทียบ X แบบ float32 และบวกค่าทีละ tree ตามลำดับเหมือน sklearn)
+    """
+
+    def __init__(self, feature, threshold, left, right, value, roots, max_depth):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.max_depth = int(max_depth)
+
+        # children[2*i] = right, children[2*i+1] = left จะได้เลือกด้วย index เดียว (2*node + go_left)
+        self.children = np.empty(2 * len(left), dtype=np.int32)
+        self.children[0::2] = right
+        self.children[1::2] = left
+        self.is_leaf = left == np.arange(len(left))
+
+    @classmethod
+    def from_sklearn(cls, model):
+        estimators = getattr(model, "estimators_", None)
+        if estimators is None:
+            estimators = [model]
+
+        features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+        offset = 0
+        max_depth = 0
+        for estimator in estimators:
+            tree = estimator.tree_
+            n_nodes = tree.node_count
+            node_ids = np.arange(offset, offset + n_nodes, dtype=np.int32)
+            is_leaf = tree.children_left == TREE_LEAF
+
+            # leaf ให้ child ชี้กลับมาที่ตัวเอง ใช้เช็ค is_leaf ได้จาก array เดียว
+            lefts.append(np.where(is_leaf, node_ids, tree.children_left + offset).astype(np.int32))
+            rights.append(np.where(is_leaf, node_ids, tree.children_right + offset).astype(np.int32))
+            features.append(np.where(is_leaf, 0, tree.feature).astype(np.int32))
+            thresholds.append(tree.threshold.astype(np.float64))
+            values.append(tree.value[:, 0, 0].astype(np.float64))
+            roots.append(offset)
+            max_depth = max(max_depth, tree.max_depth)
+            offset += n_nodes
+
+        return cls(
+            np.concatenate(features), np.concatenate(thresholds),
+            np.concatenate(lefts), np.concatenate(rights),
+            np.concatenate(values), np.array(roots, dtype=np.int32), max_depth
+        )
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def predict(self, X):
+        # sklearn แปลง X เป็น float32 ก่อนเทียบกับ threshold
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n, n_features = X.shape
+        n_trees = self.n_trees
+        x_flat = X.ravel()
+
+        # node ปัจจุบันของทุกคู่ (แถว, tree) เรียงแถวละ n_trees ช่อง
+        node = np.tile(self.roots, n)
+        row_offset = np.repeat(np.arange(n, dtype=np.int64) * n_features, n_trees)
+
+        # เดินเฉพาะคู่ที่ยังไม่ถึง leaf ทีละชั้น
+        active = np.flatnonzero(~self.is_leaf[node])
+        current = node[active]
+        offset = row_offset[active]
+        while current.size:
+            go_left = x_flat[offset + self.feature[current]] <= self.threshold[current]
+            current = self.children[2 * current + go_left]
+            done = self.is_leaf[current]
+            node[active[done]] = current[done]
+            keep = ~done
+            active, current, offset = active[keep], current[keep], offset[keep]
+
+        # บวกค่าทีละ tree ตามลำดับเหมือน sklearn ผลจะตรงกันทุก bit
+        leaf_values = self.value[node].reshape(n, n_trees)
+        out = np.zeros(n, dtype=np.float64)
+        for t in range(n_trees):
+            out += leaf_values[:, t]
+        out /= n_trees
+        return out
+
+    def save(self, path):
+        np.savez(
+            path, feature=self.feature, threshold=self.threshold, left=self.left,
+            right=self.right, value=self.value, roots=self.roots, max_depth=self.max_depth
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(
+                data["feature"], data["threshold"], data["left"], data["right"],
+                data["value"], data["roots"], data["max_depth"]
+            )
+
+
+def export_forest(model):
+    """แปลง model เป็น FlatForest ถ้าเป็น tree/forest regressor ที่รองรับ ไม่งั้นคืน None"""
+    if isinstance(model, (RandomForestRegressor, ExtraTreesRegressor, DecisionTreeRegressor)):
+        if getattr(model, "n_outputs_", 1) == 1:
+            return FlatForest.from_sklearn(model)
+    return None
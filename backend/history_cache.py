@@ -0,0 +1,132 @@
+import os
+import json
+import secrets
+import threading
+import logging
+import redis
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+HISTORY_CACHE_TTL_SECONDS = int(os.getenv("HISTORY_CACHE_TTL_SECONDS", 300))
+# hash ของทุกหน้าที่ cache ไว้ของ user (field = "cursor:limit" หน้าแรกใช้ cursor = "first") ลบทีเดียวได้ทั้ง user
+HISTORY_KEY_PREFIX = "history:"
+# version ของประวัติแต่ละ user (key history:{user_id}:version) เปลี่ยนเป็นค่าสุ่มใหม่ทุกครั้งที่ /vote เขียนลง watched
+# อยู่นานกว่าหน้าที่ cache ไว้ แล้วหมดอายุตาม user ที่ไม่ active (ไม่มี hash กลางที่โตตามจำนวน user)
+HISTORY_VERSION_TTL_SECONDS = HISTORY_CACHE_TTL_SECONDS * 2
+
+redis_config = {
+    'host': os.getenv("REDIS_HOST", "localhost"),
+    'port': int(os.getenv("REDIS_PORT", 6379)),
+    'db': int(os.getenv("REDIS_DB", 0)),
+    'password': os.getenv("REDIS_PASSWORD", None)
+}
+
+r = redis.Redis(**redis_config, decode_responses=True)
+ar = aioredis.Redis(**redis_config, decode_responses=True)
+
+_stats_lock = threading.Lock()
+stats = {"hits": 0, "misses": 0, "invalidations": 0, "errors": 0}
+
+
+def _count(name, n=1):
+    with _stats_lock:
+        stats[name] += n
+
+
+def _page_key(user_id):
+    return f"{HISTORY_KEY_PREFIX}{user_id}"
+
+
+def _version_key(user_id):
+    return f"{HISTORY_KEY_PREFIX}{user_id}:version"
+
+
+def _page_field(cursor, limit):
+    # ?cursor=0 เป็นหน้าว่างคนละหน้ากับหน้าแรก ห้ามใช้ field ร่วมกัน
+    return f"{'first' if cursor is None else cursor}:{limit}"
+
+
+async def get_page(user_id, cursor, limit):
+    """คืน (หน้าที่ cache ไว้ หรือ None, version ปัจจุบัน)
+
+    ส่ง version ที่ได้ไปให้ put_page ตอนเขียน ถ้ามี vote ใหม่เข้ามาระหว่างนั้นหน้าที่เขียนจะไม่ถูกใช้
+    """
+    try:
+        pipe = ar.pipeline()
+        pipe.get(_version_key(user_id))
+        pipe.hget(_page_key(user_id), _page_field(cursor, limit))
+        version, cached = await pipe.execute()
+    except redis.exceptions.RedisError as e:
+        log.warning(f"History cache read failed: {e}")
+        _count("errors")
+        return None, None
+
+    if cached:
+        entry = json.loads(cached)
+        if entry["version"] == version:
+            _count("hits")
+            return entry["page"], version
+    _count("misses")
+    return None, version
+
+
+async def put_page(user_id, cursor, limit, version, page):
+    try:
+        key = _page_key(user_id)
+        pipe = ar.pipeline()
+        pipe.hset(key, _page_field(cursor, limit), json.dumps({"version": version, "page": page}))
+        pipe.expire(key, HISTORY_CACHE_TTL_SECONDS)
+        # version ต้องอยู่นานกว่าหน้าที่อ้างถึงมัน (ถ้ายังไม่มี key คำสั่งนี้ไม่ทำอะไร)
+        pipe.expire(_version_key(user_id), HISTORY_VERSION_TTL_SECONDS)
+        await pipe.execute()
+    except redis.exceptions.RedisError as e:
+        log.warning(f"History cache write failed: {e}")
+        _count("errors")
+
+
+def _invalidate(pipe, user_ids):
+    # ค่าสุ่มไม่ซ้ำกับ version ที่ request อื่นอ่านไปก่อนหน้า แม้ key เดิมจะหมดอายุไปแล้ว
+    for user_id in user_ids:
+        pipe.set(_version_key(user_id), secrets.token_hex(8), ex=HISTORY_VERSION_TTL_SECONDS)
+        pipe.unlink(_page_key(user_id))
+
+
+async def invalidate(user_id):
+    """เรียกหลัง commit การเขียน watched ของ user นี้"""
+    try:
+        pipe = ar.pipeline()
+        _invalidate(pipe, [user_id])
+        await pipe.execute()
+        _count("invalidations")
+    except redis.exceptions.RedisError as e:
+        # หน้าที่ cache ไว้จะเก่าได้นานสุด HISTORY_CACHE_TTL_SECONDS
+        log.warning(f"History cache invalidation failed for user {user_id}: {e}")
+        _count("errors")
+
+
+def invalidate_many(user_ids):
+    """invalidate หลาย user พร้อมกัน สำหรับโค้ด sync (เช่น vote flusher)"""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    try:
+        pipe = r.pipeline()
+        _invalidate(pipe, user_ids)
+        pipe.execute()
+        _count("invalidations", len(user_ids))
+    except redis.exceptions.RedisError as e:
+        log.warning(f"History cache invalidation failed for {len(user_ids)} users: {e}")
+        _count("errors")
+
+
+def get_stats():
+    with _stats_lock:
+        result = dict(stats)
+    lookups = result["hits"] + result["misses"]
+    result["hit_rate"] = result["hits"] / lookups if lookups else 0.0
+    result["ttl_seconds"] = HISTORY_CACHE_TTL_SECONDS
+    return result
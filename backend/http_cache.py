@@ -0,0 +1,133 @@
+import os
+import json
+import asyncio
+import time
+import hashlib
+import tempfile
+from urllib.parse import urlsplit
+
+# cache response ของ TMDB บน disk รันซ้ำหรือรันต่อจากรอบที่ล่มจะอ่านจาก disk แทน network
+TMDB_CACHE_DIR = os.getenv('TMDB_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.tmdb_cache'))
+TMDB_CACHE_ENABLED = os.getenv('TMDB_CACHE_ENABLED', '1') == '1'
+
+DAY = 24 * 3600
+# อายุของ response แต่ละ endpoint (วินาที) ข้อมูลที่ไม่ค่อยเปลี่ยนเก็บได้นาน
+CACHE_TTLS = {
+    'genres': 30 * DAY,
+    'credits': 30 * DAY,
+    'providers': DAY,
+    'details': DAY,
+    'discover': DAY,
+    # changes feed ขึ้นกับเวลาที่ถาม (params เป็นแค่วันที่) cache ไว้จะพลาดหนังที่เปลี่ยนระหว่างวัน
+    'changes': 0,
+}
+
+
+def endpoint_kind(url):
+    path = urlsplit(url).path.rstrip('/')
+    if path.endswith('/genre/movie/list'):
+        return 'genres'
+    if path.endswith('/credits'):
+        return 'credits'
+    if path.endswith('/watch/providers'):
+        return 'providers'
+    if path.endswith('/movie/changes'):
+        return 'changes'
+    if path.endswith('/discover/movie'):
+        return 'discover'
+    return 'details'
+
+
+def cache_key(url, params=None):
+    """key ของ response = sha256 ของ URL + params (เรียงแล้ว) ไม่รวม header เช่น API key"""
+    items = sorted((str(k), str(v)) for k, v in (params or {}).items())
+    payload = json.dumps([url, items], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """cache JSON response ไว้ใน directory ไฟล์ละ response (<dir>/<2 ตัวแรกของ key>/<key>.json)"""
+
+    def __init__(self, directory, ttls, enabled=True):
+        self.directory = directory
+        self.ttls = ttls
+        self.enabled = enabled
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'stores': 0}
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.json')
+
+    def cacheable(self, url):
+        return self.enabled and self.ttls[endpoint_kind(url)] > 0
+
+    def get(self, url, params=None):
+        """body ที่ cache ไว้และยังไม่หมดอายุ หรือ None"""
+        if not self.cacheable(url):
+            return None
+        try:
+            with open(self._path(cache_key(url, params)), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.stats['misses'] += 1
+            return None
+        if time.time() - entry['fetched_at'] > self.ttls[endpoint_kind(url)]:
+            self.stats['expired'] += 1
+            return None
+        self.stats['hits'] += 1
+        return entry['body']
+
+    def put(self, url, params, body):
+        if not self.cacheable(url):
+            return
+        path = self._path(cache_key(url, params))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {'url': url, 'params': params or {}, 'fetched_at': time.time(), 'body': body}
+        # เขียนไฟล์ชั่วคราวแล้ว rename ไฟล์ที่อ่านจะไม่มีทางเป็นไฟล์ที่เขียนไม่ครบ
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.stats['stores'] += 1
+
+    async def get_async(self, url, params=None):
+        """get สำหรับ coroutine อ่านไฟล์ใน thread แยก ไม่ block event loop"""
+        if not self.cacheable(url):
+            return None
+        return await asyncio.to_thread(self.get, url, params)
+
+    async def put_async(self, url, params, body):
+        if self.cacheable(url):
+            await asyncio.to_thread(self.put, url, params, body)
+
+    def prune(self):
+        """ลบ response ที่หมดอายุแล้ว คืนจำนวนไฟล์ที่ลบ"""
+        if not self.enabled or not os.path.isdir(self.directory):
+            return 0
+        removed = 0
+        now = time.time()
+        max_ttl = max(self.ttls.values())
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    # ดูจาก mtime ก่อน ใหม่กว่า TTL ที่สั้นที่สุด = ยังไม่หมดอายุ, เก่ากว่า TTL ที่ยาวที่สุด = หมดอายุแน่นอน
+                    if now - os.path.getmtime(path) <= min(ttl for ttl in self.ttls.values() if ttl > 0):
+                        continue
+                    if name.endswith('.json') and now - os.path.getmtime(path) <= max_ttl:
+                        with open(path, 'r', encoding='utf-8') as f:
+                            entry = json.load(f)
+                        if now - entry['fetched_at'] <= self.ttls[endpoint_kind(entry['url'])]:
+                            continue
+                    os.remove(path)
+                    removed += 1
+                except (OSError, ValueError, KeyError):
+                    continue
+        return removed
+
+
+response_cache = ResponseCache(TMDB_CACHE_DIR, CACHE_TTLS, TMDB_CACHE_ENABLED)
@@ -1,21 +1,34 @@
-from fastapi import FastAPI, HTTPException, Cookie
+from fastapi import FastAPI, HTTPException, Cookie, Query
 from fastapi.responses import JSONResponse
 import os
 from dotenv import load_dotenv
 from pydantic import BaseModel
-import bcrypt 
-from db import get_connection
-from password_utills import hash_password
+from fastapi.concurrency import run_in_threadpool
+from db import db_connection, get_pool, close_pool, async_db_connection, close_async_pool, get_async_pool_stats
+from password_pool import password_pool, PasswordPoolBusy, PasswordPoolUnavailable
+from username_index import username_index, USERNAME_INDEX_REFRESH_SECONDS
+import history_cache
+from vote_queue import (
+    VOTE_WRITE_MODE, VOTE_FLUSH_SECONDS, VoteQueueFull, enqueue_vote, flush_votes, get_queue_stats, check_schema
+)
 from fastapi.middleware.cors import CORSMiddleware
-import joblib
 import numpy as np
-import pandas as pd
 from typing import Optional
-from session import create_session, get_session, delete_session, update_session_data
+from session import (
+    get_session, delete_session, cleanup_expired_sessions,
+    create_session_async, get_session_async, update_session_data_async
+)
+from catalog import MovieCatalog, get_catalog, get_catalog_async, current_catalog, fetch_movie_async, fetch_synopses_async
+from model_registry import ModelHolder
+from recommender import (
+    mood_to_va, resolve_user_genre, genre_candidates,
+    rank_movies, rec_table_field, get_recommendation_table_async, resolve_feedback_genre
+)
 import redis
-import json
+import redis.asyncio as aioredis
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 import subprocess
 import logging
 from datetime import datetime
@@ -24,28 +37,17 @@ from pytz import timezone
 
 load_dotenv()
 
-EXPECTED_COLS = [
-    'user_valence', 'user_arousal', 'movie_valence', 'movie_arousal',
-    'user_genre_Action', 'user_genre_Comedy', 'user_genre_Documentary', 
-    'user_genre_Drama', 'user_genre_Horror', 'user_genre_Romance', 'user_genre_Sci-Fi', 
-    'movie_genre_Action', 'movie_genre_Comedy', 'movie_genre_Documentary', 
-    'movie_genre_Drama', 'movie_genre_Horror', 'movie_genre_Romance', 'movie_genre_Sci-Fi'
-]
-
-
+# model ที่ใช้อยู่ใน worker นี้ (สลับ version ใหม่ได้โดยไม่ต้อง restart)
+model_holder = ModelHolder()
 try:
-    model = joblib.load("./nlp_ml/ml_model/cinesense_model.pkl")
-    encoder = joblib.load("./nlp_ml/ml_model/encoder.pkl")
-    
-    ENCODER_KNOWN_GENRES = set(encoder.categories_[1]) 
-    DEFAULT_GENRE = 'drama' 
-    if DEFAULT_GENRE not in ENCODER_KNOWN_GENRES:
-        DEFAULT_GENRE = list(ENCODER_KNOWN_GENRES)[0] if ENCODER_KNOWN_GENRES else 'unknown'
-
+    model_holder.reload_if_changed()
 except Exception as e:
     print(f"ERROR LOADING ML FILES: {e}")
-    model = None
-    encoder = None
+
+MODEL_RELOAD_SECONDS = int(os.getenv("MODEL_RELOAD_SECONDS", 30))
+SESSION_CLEANUP_MINUTES = int(os.getenv("SESSION_CLEANUP_MINUTES", 10))
+# ตรวจ catalog:version เป็นระยะ ให้ /vote ใช้ catalog ล่าสุดได้โดยไม่ต้องถาม Redis ทุกครั้ง
+CATALOG_POLL_SECONDS = int(os.getenv("CATALOG_POLL_SECONDS", 30))
 
 
 app = FastAPI()
@@ -61,6 +63,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# client สำหรับงานใน scheduler
 r = redis.Redis(
     host=os.getenv("REDIS_HOST", "localhost"),
     port=int(os.getenv("REDIS_PORT", 6379)),
@@ -69,6 +72,15 @@ r = redis.Redis(
     decode_responses=True
 )
 
+# client สำหรับ endpoint ที่เป็น async def (ไม่ block event loop)
+ar = aioredis.Redis(
+    host=os.getenv("REDIS_HOST", "localhost"),
+    port=int(os.getenv("REDIS_PORT", 6379)),
+    db=int(os.getenv("REDIS_DB", 0)),
+    password=os.getenv("REDIS_PASSWORD", None),
+    decode_responses=True
+)
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -83,7 +95,7 @@ def scheduled_movie_update_and_retrain():
     try:
         logger.info("Running fetch_movie.py...")
         result_fetch = subprocess.run(
-            [python_executable, "fetch_movie.py"], 
+            [python_executable, "fetch_movie.py", "--incremental"], 
             capture_output=True, 
             text=True, 
             cwd=script_dir,
@@ -94,7 +106,7 @@ def scheduled_movie_update_and_retrain():
 
         logger.info("Running sync_db.py...")
         result_sync = subprocess.run(
-            [python_executable, "sync_db.py"], 
+            [python_executable, "sync_db.py", "--diff"], 
             capture_output=True, 
             text=True, 
             cwd=script_dir,
@@ -102,6 +114,8 @@ def scheduled_movie_update_and_retrain():
         )
         logger.info("sync_db.py completed successfully")
         logger.info(f"sync_db output: {result_sync.stdout}")
+        # โหลด catalog ใหม่ทันทีหลัง sync (worker อื่นจะตามมาใน CATALOG_POLL_SECONDS)
+        refresh_catalog()
 
         logger.info("Retraining model (feedbackloop.py)...")
         result_loop = subprocess.run(
@@ -113,6 +127,17 @@ def scheduled_movie_update_and_retrain():
         )
         logger.info("feedbackloop.py completed successfully")
         logger.info(f"feedbackloop output: {result_loop.stdout}")
+
+        logger.info("Precomputing recommendation table (precompute_recommendations.py)...")
+        result_precompute = subprocess.run(
+            [python_executable, "precompute_recommendations.py"], 
+            capture_output=True, 
+            text=True, 
+            cwd=script_dir,
+            check=True
+        )
+        logger.info("precompute_recommendations.py completed successfully")
+        logger.info(f"precompute_recommendations output: {result_precompute.stdout}")
         
         logger.info("Scheduled movie update completed successfully")
 
@@ -133,13 +158,105 @@ scheduler.add_job(
     replace_existing=True
 )
 
+def reload_model_if_changed():
+    try:
+        model_holder.reload_if_changed()
+    except Exception as e:
+        logger.error(f"Model reload failed, keeping current version: {e}")
+
+scheduler.add_job(
+    reload_model_if_changed,
+    trigger=IntervalTrigger(seconds=MODEL_RELOAD_SECONDS),
+    id='model_hot_reload',
+    name='Model Hot Reload',
+    replace_existing=True
+)
+
+def refresh_catalog():
+    try:
+        get_catalog(r)
+    except Exception as e:
+        logger.error(f"Catalog refresh failed: {e}")
+
+scheduler.add_job(
+    refresh_catalog,
+    trigger=IntervalTrigger(seconds=CATALOG_POLL_SECONDS),
+    id='catalog_refresh',
+    name='Movie Catalog Refresh',
+    replace_existing=True
+)
+
+def refresh_username_index():
+    try:
+        with db_connection() as conn:
+            synced = username_index.sync(conn)
+        if synced is not None:
+            logger.info(f"Username index: synced {synced} usernames")
+    except Exception as e:
+        logger.error(f"Username index refresh failed: {e}")
+
+scheduler.add_job(
+    refresh_username_index,
+    trigger=IntervalTrigger(seconds=USERNAME_INDEX_REFRESH_SECONDS),
+    id='username_index_refresh',
+    name='Username Index Refresh',
+    replace_existing=True
+)
+
+def flush_vote_queue():
+    try:
+        flushed = flush_votes()
+        if flushed:
+            logger.info(f"Flushed {flushed} queued votes to the database")
+    except Exception as e:
+        logger.error(f"Vote flush failed, will retry: {e}")
+
+if VOTE_WRITE_MODE == "queue":
+    scheduler.add_job(
+        flush_vote_queue,
+        trigger=IntervalTrigger(seconds=VOTE_FLUSH_SECONDS),
+        id='vote_flush',
+        name='Queued Vote Flush',
+        replace_existing=True
+    )
+
+def cleanup_sessions():
+    removed = cleanup_expired_sessions()
+    if removed:
+        logger.info(f"Removed {removed} expired sessions")
+
+scheduler.add_job(
+    cleanup_sessions,
+    trigger=IntervalTrigger(minutes=SESSION_CLEANUP_MINUTES),
+    id='session_cleanup',
+    name='Expired Session Cleanup',
+    replace_existing=True
+)
+
 scheduler.start()
 logger.info("Scheduler started - Movie update and retrain will run every Sunday at midnight")
 
+@app.on_event("startup")
+def load_username_index():
+    refresh_username_index()
+
+@app.on_event("startup")
+def check_vote_queue_schema():
+    # flusher เขียน voted_at ถ้ายังไม่ได้รัน migration ทุก batch จะล้ม ให้รู้ตั้งแต่ start
+    if VOTE_WRITE_MODE == "queue":
+        check_schema()
+
 @app.on_event("shutdown")
 def shutdown_scheduler():
     scheduler.shutdown()
     logger.info("Scheduler stopped")
+    close_pool()
+    password_pool.shutdown()
+
+@app.on_event("shutdown")
+async def shutdown_async_clients():
+    await close_async_pool()
+    await ar.aclose()
 
 @app.get("/")
 def read_root():
@@ -161,6 +278,41 @@ def get_scheduler_status():
         ]
     }
 
+@app.get("/model/status")
+def get_model_status():
+    """ตรวจสอบ model version ที่ worker นี้ใช้อยู่"""
+    active = model_holder.active
+    previous = model_holder.previous
+    return {
+        "active": active.meta if active else None,
+        "previous_id": previous.model_id if previous else None
+    }
+
+@app.get("/db/pool-stats")
+def get_db_pool_stats():
+    """สถิติของ connection pool (จำนวนที่ใช้อยู่, เวลารอ connection) แยก asyncpg (endpoint หลัก) กับ psycopg2"""
+    return {"async": get_async_pool_stats(), "sync": get_pool().get_stats()}
+
+@app.get("/watch-history/cache-stats")
+def get_history_cache_stats():
+    """hit/miss ของ cache ประวัติการรับชม (นับต่อ worker)"""
+    return history_cache.get_stats()
+
+@app.get("/votes/queue-stats")
+def get_vote_queue_stats():
+    """จำนวน vote ที่รอเขียนลง database (โหมด queue)"""
+    return get_queue_stats()
+
+@app.get("/auth/username-index-stats")
+def get_username_index_stats():
+    """จำนวนครั้งที่ /check-username ตอบได้จาก index เทียบกับที่ต้องถาม database"""
+    return username_index.get_stats()
+
+@app.get("/auth/pool-stats")
+def get_auth_pool_stats():
+    """สถิติของ password pool (คิวที่รอ, จำนวนที่ถูกปฏิเสธ, เวลา hash/verify)"""
+    return password_pool.get_stats()
+
 @app.post("/scheduler/trigger-update")
 def trigger_manual_update():
     try:
@@ -173,32 +325,41 @@ class UserRegister(BaseModel):
     username: str
     password: str
 
-@app.post("/register")
-def register(user: UserRegister):
-    conn = get_connection()
-    cur = conn.cursor()
-
-    hashed_pw = hash_password(user.password)
-
+async def run_password_task(task, *args):
+    """ส่งงาน bcrypt เข้า password pool แปลงคิวเต็ม/pool เสียเป็น 429/503"""
     try:
-        cur.execute(
-            "INSERT INTO users (user_name, password_hash) VALUES (%s, %s) RETURNING user_id",
-            (user.username, hashed_pw)
+        return await task(*args)
+    except PasswordPoolBusy:
+        raise HTTPException(
+            status_code=429, detail="Too many authentication requests, please retry",
+            headers={"Retry-After": "1"}
         )
-        user_id = cur.fetchone()[0]
-        conn.commit()
-        return{
-            "message": "User registered successfully!",
-            "user_registered": user.username,
-            "password_hash": hashed_pw,
-            "user id" : user_id
-        }
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=400, detail=f"Register failed: {e}")
-    finally:
-        cur.close()
-        conn.close()
+    except PasswordPoolUnavailable:
+        raise HTTPException(
+            status_code=503, detail="Authentication is temporarily unavailable",
+            headers={"Retry-After": "5"}
+        )
+
+@app.post("/register")
+async def register(user: UserRegister):
+    # hash ก่อนยืม connection จะได้ไม่ถือ connection ไว้ระหว่าง bcrypt
+    hashed_pw = await run_password_task(password_pool.hash, user.password)
+
+    async with async_db_connection() as conn:
+        try:
+            user_id = await conn.fetchval(
+                "INSERT INTO users (user_name, password_hash) VALUES ($1, $2) RETURNING user_id",
+                user.username, hashed_pw
+            )
+            await username_index.add_async(user.username)
+            return{
+                "message": "User registered successfully!",
+                "user_registered": user.username,
+                "password_hash": hashed_pw,
+                "user id" : user_id
+            }
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Register failed: {e}")
 
 
 class UserLogin(BaseModel):
@@ -206,24 +367,23 @@ class UserLogin(BaseModel):
     password: str
 
 @app.post("/login")
-def login(user: UserLogin):
-    conn = get_connection()
-    cur = conn.cursor()
+async def login(user: UserLogin):
     try:
-        cur.execute(
-            "SELECT user_id, user_name, password_hash FROM users WHERE user_name = %s",
-            (user.username,)
-        )
-        db_user = cur.fetchone()
+        async with async_db_connection() as conn:
+            db_user = await conn.fetchrow(
+                "SELECT user_id, user_name, password_hash FROM users WHERE user_name = $1",
+                user.username
+            )
 
         if not db_user:
             return JSONResponse(status_code=404, content={"error": "ไม่มีผู้ใช้"})
 
         user_id, user_name, hashed_password = db_user
 
-        if bcrypt.checkpw(user.password.encode("utf-8"), hashed_password.encode("utf-8")):
+        # bcrypt กิน CPU หลายร้อย ms ทำใน password pool จะได้ไม่แย่ง thread ของ /submit, /vote
+        if await run_password_task(password_pool.verify, user.password, hashed_password):
             # ← สร้าง session
-            session_id = create_session(user_id, user_name)
+            session_id = await create_session_async(user_id, user_name)
             
             response = JSONResponse(content={
                 "message": "Login successful!",
@@ -245,11 +405,10 @@ def login(user: UserLogin):
         else:
             return JSONResponse(status_code=401, content={"error": "รหัสผ่านไม่ถูกต้อง"})
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Login failed: {e}")
-    finally:
-        cur.close()
-        conn.close()
 
 
 # ← เพิ่ม endpoint สำหรับ logout
@@ -286,53 +445,54 @@ class UsernameCheckRequest(BaseModel):
 
 @app.post("/check-username")
 def check_username(request: UsernameCheckRequest):
-    conn = get_connection()
-    cur = conn.cursor()
-    
-    try:
-        # ตรวจสอบว่า username เป็นภาษาอังกฤษหรือตัวเลขเท่านั้น (ไม่รองรับอักขระอื่น)
-        if not request.username.isalnum():
-            return {
-                "available": False,
-                "message": "ชื่อผู้ใช้ต้องเป็นภาษาอังกฤษและตัวเลขเท่านั้น"
-            }
-        
-        # ตรวจสอบความยาว
-        if len(request.username) < 3:
-            return {
-                "available": False,
-                "message": "ชื่อผู้ใช้ต้องมีอย่างน้อย 3 ตัวอักษร"
-            }
-        
-        if len(request.username) > 20:
-            return {
-                "available": False,
-                "message": "ชื่อผู้ใช้ต้องไม่เกิน 20 ตัวอักษร"
-            }
-        
-        # ตรวจสอบใน database
-        cur.execute(
-            "SELECT user_id FROM users WHERE user_name = %s",
-            (request.username,)
-        )
-        existing_user = cur.fetchone()
-        
-        if existing_user:
-            return {
-                "available": False,
-                "message": "ชื่อผู้ใช้นี้ถูกใช้งานแล้ว"
-            }
-        
+    # ตรวจสอบว่า username เป็นภาษาอังกฤษหรือตัวเลขเท่านั้น (ไม่รองรับอักขระอื่น)
+    if not request.username.isalnum():
         return {
-            "available": True,
-            "message": "ชื่อผู้ใช้พร้อมใช้งาน"
+            "available": False,
+            "message": "ชื่อผู้ใช้ต้องเป็นภาษาอังกฤษและตัวเลขเท่านั้น"
+        }
+
+    # ตรวจสอบความยาว
+    if len(request.username) < 3:
+        return {
+            "available": False,
+            "message": "ชื่อผู้ใช้ต้องมีอย่างน้อย 3 ตัวอักษร"
+        }
+
+    if len(request.username) > 20:
+        return {
+            "available": False,
+            "message": "ชื่อผู้ใช้ต้องไม่เกิน 20 ตัวอักษร"
         }
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error checking username: {e}")
-    finally:
-        cur.close()
-        conn.close()
+
+    # ตรวจสอบใน index ก่อน ถาม database เฉพาะกรณีที่ index ยังไม่พร้อม
+    taken = username_index.lookup(request.username)
+    if taken is None:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(
+                    "SELECT user_id FROM users WHERE user_name = %s",
+                    (request.username,)
+                )
+                taken = cur.fetchone() is not None
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"Error checking username: {e}")
+            finally:
+                cur.close()
+        if taken:
+            username_index.add(request.username)
+
+    if taken:
+        return {
+            "available": False,
+            "message": "ชื่อผู้ใช้นี้ถูกใช้งานแล้ว"
+        }
+
+    return {
+        "available": True,
+        "message": "ชื่อผู้ใช้พร้อมใช้งาน"
+    }
 
 
 # API สำหรับบันทึกโหวต (เพิ่มการตรวจสอบ session)
@@ -351,16 +511,17 @@ class VoteRequest(BaseModel):
     
 
 @app.post("/vote")
-def vote_movie(vote_req: VoteRequest, session_id: Optional[str] = Cookie(None)):
+async def vote_movie(vote_req: VoteRequest, session_id: Optional[str] = Cookie(None)):
     # 1. ตรวจสอบ session
     if not session_id:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    session = get_session(session_id)
+    session = await get_session_async(session_id)
     if not session:
         raise HTTPException(status_code=401, detail="Invalid or expired session")
     
     user_id = session["user_id"]
+    DEFAULT_GENRE = model_holder.default_genre
     
     # --- BEGIN MODIFICATION FOR FEEDBACK ---
     
@@ -383,49 +544,20 @@ def vote_movie(vote_req: VoteRequest, session_id: Optional[str] = Cookie(None)):
             user_valence = float(user_valence)
             user_arousal = float(user_arousal)
             
-            # 3. ดึงข้อมูลหนัง (valence, arousal, genre) จาก Redis
-            movie_key = f"movie:{vote_req.movie_id}"
-            movie_data = r.hgetall(movie_key)
-            
-            if not movie_data:
-                logger.warning(f"Skipping feedback for user {user_id}, movie {vote_req.movie_id}: Movie data not found in Redis.")
+            # 3. ดึงข้อมูลหนัง (valence, arousal, genre) จาก catalog ใน memory (parse ไว้แล้วตอนโหลด)
+            catalog = current_catalog()
+            if catalog is None or str(vote_req.movie_id) not in catalog.index_of:
+                # หนังที่ยังไม่อยู่ใน catalog ของ worker นี้ อ่านจาก Redis แทน
+                movie_data = await fetch_movie_async(ar, vote_req.movie_id)
+                catalog = MovieCatalog(None, [str(vote_req.movie_id)], [movie_data]) if movie_data else None
+
+            features = catalog.movie_features(vote_req.movie_id) if catalog else None
+            if features is None:
+                logger.warning(f"Skipping feedback for user {user_id}, movie {vote_req.movie_id}: Movie emotion data not found.")
                 log_feedback = False
             else:
-                # 3.1. ดึง movie_valence, movie_arousal
-                emotion_str = movie_data.get("emotion")
-                if emotion_str:
-                    emotion_data = json.loads(emotion_str)
-                    movie_valence = float(emotion_data[0])
-                    movie_arousal = float(emotion_data[1])
-                else:
-                    log_feedback = False
-                    logger.warning(f"Skipping feedback: Movie {vote_req.movie_id} missing 'emotion' data in Redis.")
-
-                # 3.2. ดึง movie_genre
-                # หมายเหตุ: ใน /submit ใช้ 'gerne' (มี typo)
-                genre_str = movie_data.get("gerne") 
-                
-                if genre_str and log_feedback:
-                    try:
-                        # e.g., ["Action", "Thriller"]
-                        movie_genres_list_original = json.loads(genre_str) 
-                        
-                        if user_genre in movie_genres_list_original:
-                            # ถ้า genre ที่ user เลือก (e.g., "Action") อยู่ใน list ของหนัง
-                            movie_genre_to_log = user_genre
-                        elif movie_genres_list_original:
-                            # ถ้าไม่ตรง ให้ใช้ค่าแรกใน list
-                            movie_genre_to_log = movie_genres_list_original[0]
-                        else:
-                            # ถ้า list ว่างเปล่า
-                            movie_genre_to_log = DEFAULT_GENRE
-                    except Exception as e:
-                        logger.warning(f"Error processing movie genre for feedback: {e}. Using default.")
-                        movie_genre_to_log = DEFAULT_GENRE
-                elif log_feedback:
-                    # ถ้ามี emotion แต่ไม่มี genre
-                    logger.warning(f"Skipping feedback: Movie {vote_req.movie_id} missing 'gerne' data. Using default.")
-                    movie_genre_to_log = DEFAULT_GENRE
+                movie_valence, movie_arousal, movie_genres = features
+                movie_genre_to_log = resolve_feedback_genre(user_genre, movie_genres, DEFAULT_GENRE)
                 
         except Exception as e:
             # หากเกิด Error ระหว่างเตรียมข้อมูล
@@ -434,73 +566,102 @@ def vote_movie(vote_req: VoteRequest, session_id: Optional[str] = Cookie(None)):
 
     # --- END MODIFICATION FOR FEEDBACK ---
 
-    # 4. บันทึกข้อมูลลง Database (Watched และ Feedback)
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
-        # 4.1. บันทึกลงตาราง 'watched' (เหมือนเดิม)
-        cur.execute(
-            """
-            INSERT INTO watched (user_id, movie_id, vote, movie_poster, movie_name)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (user_id, movie_id)
-            DO UPDATE SET vote = EXCLUDED.vote, movie_poster = EXCLUDED.movie_poster, movie_name = EXCLUDED.movie_name
-            RETURNING watch_id
-            """,
-            (user_id, vote_req.movie_id, vote_req.vote, vote_req.movie_poster, vote_req.movie_name)
-        )
-
-        watch_id = cur.fetchone()[0]
-
-        # 4.2. บันทึกลงตาราง 'feedback' (ถ้าข้อมูลพร้อม)
-        if log_feedback:
-            cur.execute(
-                """
-                INSERT INTO feedback (
-                    user_id, user_valence, user_arousal, user_genre,
-                    movie_valence, movie_arousal, movie_genre,
-                    vote, movie_id
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (user_id, movie_id)
-                DO UPDATE SET
-                    user_valence = EXCLUDED.user_valence,
-                    user_arousal = EXCLUDED.user_arousal,
-                    user_genre = EXCLUDED.user_genre,
-                    movie_valence = EXCLUDED.movie_valence,
-                    movie_arousal = EXCLUDED.movie_arousal,
-                    movie_genre = EXCLUDED.movie_genre,
-                    vote = EXCLUDED.vote
-                """,
-                (
-                    user_id, user_valence, user_arousal, user_genre,
-                    movie_valence, movie_arousal, movie_genre_to_log,
-                    vote_req.vote, # ส่งค่า float ไป, DB จะแปลงเป็น integer
-                    vote_req.movie_id
-                )
-            )
-            logger.info(f"Feedback logged for user {user_id}, movie {vote_req.movie_id}")
-
-
-        conn.commit() # Commit ทั้ง 2 inserts พร้อมกัน
+    # โหมด write-behind: ตอบทันทีหลังเข้าคิว flusher จะเขียนลง database เป็น batch
+    if VOTE_WRITE_MODE == "queue":
+        vote = {
+            "user_id": user_id,
+            "movie_id": vote_req.movie_id,
+            "vote": vote_req.vote,
+            "movie_poster": vote_req.movie_poster,
+            "movie_name": vote_req.movie_name,
+            "feedback": {
+                "user_valence": user_valence,
+                "user_arousal": user_arousal,
+                "user_genre": user_genre,
+                "movie_valence": movie_valence,
+                "movie_arousal": movie_arousal,
+                "movie_genre": movie_genre_to_log
+            } if log_feedback else None
+        }
+        try:
+            await enqueue_vote(vote)
+        except VoteQueueFull as e:
+            raise HTTPException(status_code=503, detail=f"Vote failed: {e}", headers={"Retry-After": "5"})
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Vote failed: {e}")
 
         return {
             "message": "Vote saved successfully!",
-            "watch_id": watch_id,
+            "watch_id": None, # ยังไม่รู้จนกว่า flusher จะเขียนลง database
             "user_id": user_id,
             "movie_id": vote_req.movie_id,
             "vote": vote_req.vote,
             "movie_poster": vote_req.movie_poster,
             "movie_name": vote_req.movie_name,
-            "feedback_logged": log_feedback # ส่งสถานะการ log feedback กลับไปด้วย
+            "feedback_logged": log_feedback,
+            "queued": True
         }
 
-    except Exception as e:
-        conn.rollback() # Rollback ทั้ง 2 inserts หากเกิดปัญหา
-        raise HTTPException(status_code=400, detail=f"Vote failed: {e}")
-    finally:
-        cur.close()
-        conn.close()
+    # 4. บันทึกข้อมูลลง Database (Watched และ Feedback)
+    async with async_db_connection() as conn:
+        try:
+            # Commit ทั้ง 2 inserts พร้อมกัน / Rollback อัตโนมัติหากเกิดปัญหา
+            async with conn.transaction():
+                # 4.1. บันทึกลงตาราง 'watched' (เหมือนเดิม)
+                watch_id = await conn.fetchval(
+                    """
+                    INSERT INTO watched (user_id, movie_id, vote, movie_poster, movie_name)
+                    VALUES ($1, $2, $3::numeric, $4, $5)
+                    ON CONFLICT (user_id, movie_id)
+                    DO UPDATE SET vote = EXCLUDED.vote, movie_poster = EXCLUDED.movie_poster, movie_name = EXCLUDED.movie_name
+                    RETURNING watch_id
+                    """,
+                    user_id, vote_req.movie_id, vote_req.vote, vote_req.movie_poster, vote_req.movie_name
+                )
+
+                # 4.2. บันทึกลงตาราง 'feedback' (ถ้าข้อมูลพร้อม)
+                if log_feedback:
+                    await conn.execute(
+                        """
+                        INSERT INTO feedback (
+                            user_id, user_valence, user_arousal, user_genre,
+                            movie_valence, movie_arousal, movie_genre,
+                            vote, movie_id
+                        )
+                        VALUES ($1, $2, $3, $4, $5, $6, $7, $8::numeric, $9)
+                        ON CONFLICT (user_id, movie_id)
+                        DO UPDATE SET
+                            user_valence = EXCLUDED.user_valence,
+                            user_arousal = EXCLUDED.user_arousal,
+                            user_genre = EXCLUDED.user_genre,
+                            movie_valence = EXCLUDED.movie_valence,
+                            movie_arousal = EXCLUDED.movie_arousal,
+                            movie_genre = EXCLUDED.movie_genre,
+                            vote = EXCLUDED.vote
+                        """,
+                        user_id, user_valence, user_arousal, user_genre,
+                        movie_valence, movie_arousal, movie_genre_to_log,
+                        vote_req.vote, # ส่งค่า float ไป, DB จะแปลงเป็น integer
+                        vote_req.movie_id
+                    )
+                    logger.info(f"Feedback logged for user {user_id}, movie {vote_req.movie_id}")
+
+            # commit แล้ว ล้าง cache ประวัติของ user ให้ /watch-history อ่านค่าใหม่
+            await history_cache.invalidate(user_id)
+
+            return {
+                "message": "Vote saved successfully!",
+                "watch_id": watch_id,
+                "user_id": user_id,
+                "movie_id": vote_req.movie_id,
+                "vote": vote_req.vote,
+                "movie_poster": vote_req.movie_poster,
+                "movie_name": vote_req.movie_name,
+                "feedback_logged": log_feedback # ส่งสถานะการ log feedback กลับไปด้วย
+            }
+
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Vote failed: {e}")
 
 '''
 # Prediction part
@@ -541,68 +702,35 @@ class SubmitRequest(BaseModel):
     q3: int
     genre: str
 
-def safe_parse_genre(x):
-    """แปลง Genre จาก Redis ให้เป็น lowercase และใช้ค่า default หากไม่รู้จัก"""
-    try:
-        genres_list = json.loads(x)
-        if genres_list:
-            genre = genres_list[0].lower()
-            if genre in ENCODER_KNOWN_GENRES:
-                return genre
-            else:
-                return DEFAULT_GENRE
-        return DEFAULT_GENRE
-    except:
-        return DEFAULT_GENRE
-
 @app.post("/submit")
-def submit_mood(submit: SubmitRequest, session_id: Optional[str] = Cookie(None)):
+async def submit_mood(submit: SubmitRequest, session_id: Optional[str] = Cookie(None)):
 
-    if model is None or encoder is None:
+    # ใช้ model version เดียวกันตลอด request แม้จะมีการสลับ version ระหว่างทาง
+    active = model_holder.active
+    if active is None:
         raise HTTPException(status_code=503, detail="ML Model or Encoder not loaded.")
+    ENCODER_KNOWN_GENRES, DEFAULT_GENRE = active.known_genres, active.default_genre
 
     try:
         # 1. Authentication & User Input Pre-processing
         if not session_id:
             raise HTTPException(status_code=401, detail="Not authenticated")
-        session = get_session(session_id)
+        session = await get_session_async(session_id)
         if not session:
             raise HTTPException(status_code=401, detail="Invalid or expired session")
         
         user_id = session["user_id"]
-        user_valence = (submit.q1) / 5
-        user_arousal = ((submit.q2+submit.q3) /2 )/ 5
-        
-        # Map form genre to encoder format (case-sensitive)
-        genre_mapping = {
-            "action": "Action",
-            "comedy": "Comedy", 
-            "drama": "Drama",
-            "documentary": "Documentary",
-            "horror": "Horror",
-            "romance": "Romance",
-            "sci-fi": "Sci-Fi", # ใช้ 'Sci-Fi' เป็นค่าหลักที่ map จาก input
-            "random": "random"
-        }
+        user_valence, user_arousal = mood_to_va(submit.q1, submit.q2, submit.q3)
         
         user_genre_input = submit.genre.lower()
         
-        # ตรวจสอบว่าเป็น Sci-Fi หรือไม่ เพื่อกำหนดค่าค้นหาใน Redis
-        is_sci_fi = (user_genre_input == "sci-fi")
-        
-        # 1. กำหนด user_genre สำหรับการทำนาย/Feedback: 
-        if is_sci_fi:
-            user_genre_for_ml = "Sci-Fi"
-            user_genre_for_log = "Sci-Fi" 
-            redis_search_genre = "science fiction" 
-        else:
-            # General Case:
-            user_genre_for_log = genre_mapping.get(user_genre_input, submit.genre)
-            user_genre_for_ml = user_genre_for_log 
-            redis_search_genre = user_genre_input
+        # 1. กำหนด user_genre สำหรับการทำนาย/Feedback และ genre ที่ใช้ค้นหาใน catalog
+        user_genre_for_ml, user_genre_for_log, redis_search_genre = resolve_user_genre(
+            submit.genre, ENCODER_KNOWN_GENRES, DEFAULT_GENRE
+        )
 
         
-        print(f"DEBUG: Original genre from form = '{submit.genre}'")
+        logger.debug("Original genre from form = %r", submit.genre)
         
         # ตรวจสอบและจัดการ 'random'
         if user_genre_input == "random":
@@ -622,16 +750,10 @@ def submit_mood(submit: SubmitRequest, session_id: Optional[str] = Cookie(None))
                  user_genre_for_log = "Sci-Fi" # ใช้ 'Sci-Fi' ในการ log
                  redis_search_genre = "science fiction" # ใช้ 'science fiction' ในการ search
             
-            print(f"DEBUG: Selected 'random' genre: '{user_genre_for_log}' (ML: '{user_genre_for_ml}')")
-
-        # ตรวจสอบว่า Genre ที่จะใช้ทำนาย (ML) เป็นที่รู้จักของ Encoder หรือไม่
-        elif user_genre_for_ml not in ENCODER_KNOWN_GENRES:
-             print(f"DEBUG: Genre '{user_genre_for_log}' (ML: '{user_genre_for_ml}') not in known genres, using DEFAULT_GENRE '{DEFAULT_GENRE}'")
-             user_genre_for_ml = DEFAULT_GENRE
-             user_genre_for_log = DEFAULT_GENRE
-             redis_search_genre = DEFAULT_GENRE.lower()
+            logger.debug("Selected 'random' genre: %r (ML: %r)", user_genre_for_log, user_genre_for_ml)
+
         else:
-             print(f"DEBUG: Genre '{user_genre_for_log}' (ML: '{user_genre_for_ml}') found in known genres")
+            logger.debug("Genre %r resolved to %r (ML: %r)", submit.genre, user_genre_for_log, user_genre_for_ml)
         
         
         # 2. Update Session (ใช้ค่า log/feedback)
@@ -641,11 +763,11 @@ def submit_mood(submit: SubmitRequest, session_id: Optional[str] = Cookie(None))
                 "user_arousal": user_arousal,
                 "user_genre": user_genre_for_log 
             }
-            # ใช้ฟังก์ชันใหม่เพื่ออัปเดต in-memory session
-            success = update_session_data(session_id, mood_data) 
+            # เก็บลง session store (Redis/in-memory) ให้ /vote ใช้ log feedback
+            success = await update_session_data_async(session_id, mood_data) 
 
             if success:
-                logger.info(f"User mood cached in IN-MEMORY session {session_id} for feedback.")
+                logger.info(f"User mood cached in session {session_id} for feedback.")
             else:
                 # This might happen if session expired between /submit auth and this point
                 logger.warning(f"Could not cache user mood in session: Session {session_id} not found or expired.")
@@ -653,108 +775,48 @@ def submit_mood(submit: SubmitRequest, session_id: Optional[str] = Cookie(None))
             logger.warning(f"Could not cache user mood in session: {e}")
         
 
-        # 3. ดึงข้อมูลจาก Redis
-        all_keys = list(r.scan_iter("movie:*"))
-        pipe = r.pipeline()
-        for key in all_keys:
-            pipe.hgetall(key)
-        results = pipe.execute()
-        movies_list = [movie for movie in results if movie]
-        if not movies_list:
+        # 3. ดึงข้อมูลหนังจาก catalog ใน memory (rebuild เฉพาะตอน sync_db เปลี่ยน version)
+        catalog = await get_catalog_async(ar)
+        if len(catalog) == 0:
             raise HTTPException(status_code=404, detail="No valid movie data in Redis")
 
-        df_movies = pd.DataFrame(movies_list)
-        df_movies["movie_id"] = [key.split(":")[1] for key in all_keys]
-
-        # 4. Data Pre-processing
-        df_movies = df_movies.rename(columns={
-            "name": "movie_name", "emotion": "movie_emotion", 
-            "gerne": "movie_genre", "poster": "movie_poster",
-            "link": "movie_links", "synopsis": "movie_synopsis"
-        })
-
-        emotion_data = df_movies["movie_emotion"].apply(json.loads)
-        df_movies[["movie_valence", "movie_arousal"]] = pd.DataFrame(emotion_data.tolist(), index=df_movies.index)
-        # Keep a list of genres for filtering, then derive a single genre for the encoder
-        try:
-            # สร้าง list ของ genres ทั้งหมดในรูปแบบ lowercase เพื่อใช้ในการกรอง
-            df_movies["movie_genres_list"] = df_movies["movie_genre"].apply(lambda s: [g.lower() for g in json.loads(s)] if s else [])
-        except Exception:
-            df_movies["movie_genres_list"] = [[] for _ in range(len(df_movies))]
-        df_movies["movie_genre"] = df_movies["movie_genre"].apply(safe_parse_genre)
-        
-        df_movies["user_valence"] = user_valence
-        df_movies["user_arousal"] = user_arousal
-        df_movies["user_genre"] = user_genre_for_ml # ใช้ค่า ML/OHE ('Science Fiction')
-
-        #Filter by selected genre first with fallback
-        print(f"DEBUG: redis_search_genre = '{redis_search_genre}'")
-        
-        # Filter by any matching genre in the list (ใช้ redis_search_genre ที่เป็น lower case)
-        df_movies_filtered = df_movies[df_movies["movie_genres_list"].apply(lambda gs: redis_search_genre in gs)].copy()
-        print(f"DEBUG: Movies after filtering = {len(df_movies_filtered)}")
-        
-        if df_movies_filtered.empty:
-            # Fallback to all movies if no movies in selected genre
-            print("DEBUG: No movies in selected genre, using fallback to all movies")
-            df_movies_filtered = df_movies.copy()
-        df_movies = df_movies_filtered
-
-        # 5. Feature Selection, OHE, and Prediction
-        
-        numerical_cols = ["user_valence", "user_arousal", "movie_valence", "movie_arousal"]
-        genre_cols = ["user_genre", "movie_genre"]
-        
-        # เลือกเฉพาะ Features ที่จะใช้ในการสร้าง processed_df
-        df_features = df_movies[numerical_cols + genre_cols].copy() 
-
-        # One-hot Encoding (OHE)
-        encoded_genres = encoder.transform(df_features[genre_cols])
-        encoded_cols = encoder.get_feature_names_out(genre_cols)
-        encoded_df = pd.DataFrame(encoded_genres, columns=encoded_cols, index=df_features.index)
-
-        # รวม Features ตัวเลขเข้ากับ OHE Features
-        processed_df = pd.concat([df_features.drop(columns=genre_cols), encoded_df], axis=1)
-
-        try:
-            processed_df = processed_df.reindex(columns=EXPECTED_COLS, fill_value=0)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to reindex features: {e}. Check EXPECTED_COLS.")
-
-
-        preds = model.predict(processed_df)
-        df_movies["matching_rate"] = preds
-
-
-        top_10 = df_movies.sort_values(by="matching_rate", ascending=False).head(10)
+        # 4. ใช้ผลที่ precompute ไว้ถ้ามี (ตารางต้องสร้างจาก catalog version เดียวกัน)
+        ranked = None
+        rec_table = await get_recommendation_table_async(ar)
+        if rec_table and rec_table[0] == {
+            "catalog_version": catalog.version, "model_id": active.model_id, "default_genre": DEFAULT_GENRE
+        }:
+            field = rec_table_field(submit.q1, submit.q2, submit.q3, user_genre_for_ml, redis_search_genre)
+            entries = rec_table[1].get(field)
+            if entries is not None:
+                top_idx = [catalog.index_of.get(movie_id) for movie_id, _ in entries]
+                if None not in top_idx:
+                    ranked = (top_idx, [rate for _, rate in entries])
+                    logger.debug("Using precomputed recommendations %r", field)
+
+        if ranked is None:
+            # 5. Filter by selected genre first with fallback, then predict
+            logger.debug("redis_search_genre = %r", redis_search_genre)
+            candidate_idx = genre_candidates(catalog, redis_search_genre)
+            logger.debug("Movies after filtering = %d", len(candidate_idx))
+            # การทำนายใช้ CPU จึงย้ายไปทำใน threadpool
+            ranked = await run_in_threadpool(
+                rank_movies, active, catalog, candidate_idx, user_valence, user_arousal, user_genre_for_ml
+            )
 
+        synopses = await fetch_synopses_async(ar, catalog, ranked[0])
         results = []
-        for _, row in top_10.iterrows():
-            # ดึงข้อมูล streaming จาก Redis
-            movie_links = []
-            try:
-                if row.get("movie_links") and row["movie_links"] != "[]":
-                    movie_links = json.loads(row["movie_links"])
-            except:
-                movie_links = []
-            
-
-            if not movie_links:
-                streaming_services = []
-            else:
-
-                streaming_services = movie_links
-            
+        for i, rate, synopsis in zip(*ranked, synopses):
             results.append({
-                "movie_id": str(row["movie_id"]),
-                "title": str(row.get("movie_name", "Unknown")),
-                "genres": list(row.get("movie_genres_list", [])),
-                "poster": str(row.get("movie_poster", "")),
-                "matching_rate": float(row["matching_rate"]),
-                "streaming_services": streaming_services,
-                "synopsis": str(row.get("movie_synopsis", ""))
+                "movie_id": str(catalog.movie_ids[i]),
+                "title": str(catalog.names[i]),
+                "genres": list(catalog.genres_list[i]),
+                "poster": str(catalog.posters[i]),
+                "matching_rate": float(rate),
+                "streaming_services": list(catalog.links[i]),
+                "synopsis": synopsis
             })
-        print(user_id,results)
+        logger.debug("Recommendations for user %s: %s", user_id, results)
         return {
             "message": "Prediction successful!",
             "user_id": user_id,
@@ -762,75 +824,95 @@ def submit_mood(submit: SubmitRequest, session_id: Optional[str] = Cookie(None))
         }
 
     except Exception as e:
-        print(f"--- ERROR IN /submit ENDPOINT ---: {e}") 
-        if 'processed_df' in locals():
-             print(f"DEBUG: Current columns in processed_df: {processed_df.columns.tolist()}")
-
+        logger.error(f"Error in /submit endpoint: {e}")
 
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
+WATCH_HISTORY_PAGE_SIZE = 50
+WATCH_HISTORY_MAX_PAGE_SIZE = 200
+
 @app.get("/watch-history")
-def get_watch_history(session_id: Optional[str] = Cookie(None)):
-    """ดึงประวัติการรับชมภาพยนตร์ของผู้ใช้"""
+async def get_watch_history(
+    session_id: Optional[str] = Cookie(None),
+    cursor: Optional[int] = None,
+    limit: int = Query(WATCH_HISTORY_PAGE_SIZE, ge=1, le=WATCH_HISTORY_MAX_PAGE_SIZE)
+):
+    """ดึงประวัติการรับชมภาพยนตร์ของผู้ใช้ทีละหน้า (ส่ง next_cursor กลับมาเป็น cursor เพื่อขอหน้าถัดไป)"""
     if not session_id:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    session = get_session(session_id)
+    session = await get_session_async(session_id)
     if not session:
         raise HTTPException(status_code=401, detail="Invalid or expired session")
     
     user_id = session.get("user_id")
     if not user_id:
         raise HTTPException(status_code=401, detail="User not found in session")
+
+    # keyset pagination บน watch_id (ใช้ index (user_id, watch_id DESC) ไม่ต้อง OFFSET)
+    # แยก query ตามว่ามี cursor หรือไม่ เพื่อให้ plan เป็น index range scan เสมอ
+    cached_page, cache_version = await history_cache.get_page(user_id, cursor, limit)
+    if cached_page is not None:
+        return cached_page
+
+    page_filter = "w.user_id = $1 AND w.watch_id < $3" if cursor is not None else "w.user_id = $1"
+    params = (user_id, limit + 1, cursor) if cursor is not None else (user_id, limit + 1)
     
-    conn = get_connection()
-    cur = conn.cursor()
-    
-    try:
-        # ดึงประวัติการรับชม
-        cur.execute("""
-            SELECT 
-                w.watch_id,
-                w.movie_id,
-                w.vote,
-                w.movie_poster,
-                w.movie_name
-            FROM watched w
-            WHERE w.user_id = %s
-            ORDER BY w.watch_id DESC
-        """, (user_id,))
-        
-        watch_history = cur.fetchall()
-        
-        # นับจำนวนภาพยนตร์ที่ดูแล้ว
-        cur.execute("""
-            SELECT COUNT(*) as total_watched
-            FROM watched w
-            WHERE w.user_id = %s
-        """, (user_id,))
-        
-        total_watched = cur.fetchone()[0]
+    async with async_db_connection() as conn:
+        try:
+            # ดึงประวัติการรับชมหน้านี้ พร้อมจำนวนทั้งหมดและคะแนนเฉลี่ยใน statement เดียว
+            rows = await conn.fetch(f"""
+                WITH page AS (
+                    SELECT 
+                        w.watch_id,
+                        w.movie_id,
+                        w.vote,
+                        w.movie_poster,
+                        w.movie_name
+                    FROM watched w
+                    WHERE {page_filter}
+                    ORDER BY w.watch_id DESC
+                    LIMIT $2
+                )
+                SELECT s.total_watched, s.average_vote, p.*
+                FROM (
+                    SELECT COUNT(*) AS total_watched, AVG(vote) AS average_vote
+                    FROM watched
+                    WHERE user_id = $1
+                ) s
+                LEFT JOIN page p ON true
+                ORDER BY p.watch_id DESC
+            """, *params)
         
-        # แปลงข้อมูลเป็น format ที่เหมาะสม
-        history_data = []
-        for record in watch_history:
-            history_data.append({
-                "watch_id": record[0],
-                "movie_id": record[1],
-                "vote": float(record[2]),
-                "movie_poster": record[3],
-                "movie_name": record[4]
-            })
+            total_watched = rows[0]["total_watched"]
+            average_vote = rows[0]["average_vote"]
+            records = [record for record in rows if record["watch_id"] is not None]
+            next_cursor = None
+            if len(records) > limit:
+                records = records[:limit]
+                next_cursor = records[-1]["watch_id"]
+
+            # แปลงข้อมูลเป็น format ที่เหมาะสม
+            history_data = []
+            for record in records:
+                history_data.append({
+                    "watch_id": record["watch_id"],
+                    "movie_id": record["movie_id"],
+                    "vote": float(record["vote"]),
+                    "movie_poster": record["movie_poster"],
+                    "movie_name": record["movie_name"]
+                })
         
-        return {
-            "message": "Watch history retrieved successfully",
-            "total_watched": total_watched,
-            "watch_history": history_data
-        }
+            page = {
+                "message": "Watch history retrieved successfully",
+                "total_watched": total_watched,
+                "average_vote": float(average_vote) if average_vote is not None else 0.0,
+                "watch_history": history_data,
+                "next_cursor": next_cursor
+            }
         
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=400, detail=f"Failed to get watch history: {e}")
-    finally:
-        cur.close()
-        conn.close()
\ No newline at end of file
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Failed to get watch history: {e}")
+
+    await history_cache.put_page(user_id, cursor, limit, cache_version, page)
+    return page
\ No newline at end of file
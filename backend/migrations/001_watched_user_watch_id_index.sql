@@ -0,0 +1,8 @@
+-- /watch-history อ่านทีละหน้าด้วย keyset บน (user_id, watch_id DESC)
+-- INCLUDE คอลัมน์ที่ endpoint ใช้ ทำให้ทั้งหน้าและ COUNT/AVG เป็น index-only scan (PostgreSQL 11+)
+-- CONCURRENTLY ไม่ lock ตาราง watched ระหว่างสร้าง (ต้องรันนอก transaction: psql -f ได้เลย)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS watched_user_id_watch_id_idx
+    ON watched (user_id, watch_id DESC)
+    INCLUDE (movie_id, vote, movie_poster, movie_name);
+
+ANALYZE watched;
@@ -0,0 +1,5 @@
+-- เวลาที่ ingestion แต่ละแบบทำสำเร็จล่าสุด (fetch_movie.py --incremental ดึงเฉพาะสิ่งที่เปลี่ยนหลังเวลานี้)
+CREATE TABLE IF NOT EXISTS ingest_state (
+    name TEXT PRIMARY KEY,
+    watermark TIMESTAMPTZ NOT NULL
+);
@@ -0,0 +1,4 @@
+-- เวลาที่ vote เกิดขึ้น (โหมด queue = เวลาใน stream id) flusher จะไม่เขียน vote ที่เก่ากว่าทับ vote ที่ใหม่กว่า
+-- แถวเดิมเป็น NULL = เก่ากว่าทุก vote
+ALTER TABLE watched ADD COLUMN IF NOT EXISTS voted_at TIMESTAMPTZ;
+ALTER TABLE feedback ADD COLUMN IF NOT EXISTS voted_at TIMESTAMPTZ;
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import logging
+import joblib
+import pandas as pd
+from datetime import datetime
+from recommender import EXPECTED_COLS, encoder_genres
+from forest_engine import FlatForest, export_forest
+
+log = logging.getLogger(__name__)
+
+MODEL_DIR = "./nlp_ml/ml_model"
+REGISTRY_DIR = os.path.join(MODEL_DIR, "versions")
+# ไฟล์ pointer เก็บ id ของ version ที่ใช้งานอยู่ (เขียนแบบ atomic ด้วย os.replace)
+CURRENT_POINTER = os.path.join(REGISTRY_DIR, "CURRENT")
+# ใช้ตอนที่ registry ยังไม่มี version ใดเลย
+LEGACY_MODEL_PATH = os.path.join(MODEL_DIR, "cinesense_model.pkl")
+LEGACY_ENCODER_PATH = os.path.join(MODEL_DIR, "encoder.pkl")
+LEGACY_MODEL_ID = "legacy"
+
+KEEP_VERSIONS = 5
+# batch ที่เล็กกว่านี้ใช้ FlatForest (เลี่ยง overhead ต่อ call ของ sklearn), batch ใหญ่ใช้ sklearn
+FLAT_FOREST_MAX_ROWS = int(os.getenv("FLAT_FOREST_MAX_ROWS", 256))
+
+
+class ModelVersion:
+    """model + encoder ที่โหลดแล้วของ version หนึ่ง"""
+
+    def __init__(self, model_id, model, encoder, meta, forest=None):
+        self.model_id = model_id
+        self.model = model
+        self.encoder = encoder
+        self.meta = meta
+        self.forest = forest
+        self.known_genres, self.default_genre = encoder_genres(encoder)
+
+    def predict(self, X):
+        """ทำนายจาก feature matrix (numpy) ที่เรียง column ตาม EXPECTED_COLS"""
+        if self.forest is not None and len(X) <= FLAT_FOREST_MAX_ROWS:
+            return self.forest.predict(X)
+        return self.model.predict(pd.DataFrame(X, columns=EXPECTED_COLS))
+
+
+def _write_atomic(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def list_versions():
+    """id ของทุก version ใน registry เรียงจากเก่าไปใหม่"""
+    if not os.path.isdir(REGISTRY_DIR):
+        return []
+    return sorted(
+        name for name in os.listdir(REGISTRY_DIR)
+        if not name.startswith(".") and os.path.exists(os.path.join(REGISTRY_DIR, name, "meta.json"))
+    )
+
+
+def current_version_id():
+    try:
+        with open(CURRENT_POINTER, encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def set_current(model_id):
+    if model_id not in list_versions():
+        raise ValueError(f"Unknown model version: {model_id}")
+    _write_atomic(CURRENT_POINTER, model_id)
+    log.info(f"Model pointer -> {model_id}")
+
+
+def publish_model(model, encoder_path, feature_names, report=None, **extra_meta):
+    """บันทึก model เป็น version ใหม่ แล้วสลับ pointer ไปที่ version นั้น
+
+    report (ถ้ามี) จะถูกเขียนเป็น selection_report.json ไว้ข้างไฟล์ model
+    """
+    feature_names = list(feature_names)
+    if feature_names != EXPECTED_COLS:
+        raise ValueError(f"Feature list does not match EXPECTED_COLS: {feature_names}")
+
+    trained_at = datetime.now()
+    # ละเอียดถึง microsecond: publish ซ้ำในวินาทีเดียวกัน (เช่น retrain ใหม่หลังล้ม) ต้องได้ id คนละตัว
+    # id เก่าที่มีแค่วินาทีเป็น prefix ของ id ใหม่ จึงยังเรียงตามเวลาได้ถูกต้อง
+    model_id = trained_at.strftime("%Y%m%dT%H%M%S%f")
+    version_dir = os.path.join(REGISTRY_DIR, model_id)
+    if os.path.exists(version_dir):
+        raise FileExistsError(f"Model version already exists: {model_id}")
+    os.makedirs(REGISTRY_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=f".tmp-{model_id}-", dir=REGISTRY_DIR)
+    os.chmod(tmp_dir, 0o755)
+
+    joblib.dump(model, os.path.join(tmp_dir, "model.pkl"))
+    forest = export_forest(model)
+    if forest is not None:
+        forest.save(os.path.join(tmp_dir, "forest.npz"))
+    shutil.copyfile(encoder_path, os.path.join(tmp_dir, "encoder.pkl"))
+    meta = {
+        "id": model_id,
+        "trained_at": trained_at.isoformat(timespec="seconds"),
+        "features": feature_names,
+        **extra_meta,
+    }
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    if report is not None:
+        with open(os.path.join(tmp_dir, "selection_report.json"), "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    # rename ทั้ง directory ทีเดียว worker จะไม่เห็น version ที่เขียนไม่เสร็จ
+    os.rename(tmp_dir, version_dir)
+    set_current(model_id)
+    _prune_versions()
+    return model_id
+
+
+def _prune_versions():
+    current = current_version_id()
+    old_versions = [v for v in list_versions() if v != current][:-(KEEP_VERSIONS - 1) or None]
+    for model_id in old_versions:
+        shutil.rmtree(os.path.join(REGISTRY_DIR, model_id), ignore_errors=True)
+        log.info(f"ลบ model version เก่า: {model_id}")
+
+
+def rollback_version():
+    """ย้าย pointer กลับไป version ก่อนหน้า คืน id ใหม่ หรือ None ถ้าไม่มีให้ย้อน"""
+    current = current_version_id()
+    older = [v for v in list_versions() if current is None or v < current]
+    if not older:
+        return None
+    set_current(older[-1])
+    return older[-1]
+
+
+def load_version(model_id=None):
+    """โหลด version ที่ระบุ (default = version ปัจจุบัน) และตรวจ feature list"""
+    model_id = model_id or current_version_id() or LEGACY_MODEL_ID
+    if model_id == LEGACY_MODEL_ID:
+        model = joblib.load(LEGACY_MODEL_PATH)
+        encoder = joblib.load(LEGACY_ENCODER_PATH)
+        meta = {"id": LEGACY_MODEL_ID, "trained_at": None, "features": EXPECTED_COLS}
+        forest = export_forest(model)
+    else:
+        version_dir = os.path.join(REGISTRY_DIR, model_id)
+        with open(os.path.join(version_dir, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("features") != EXPECTED_COLS:
+            raise ValueError(f"Model {model_id} features do not match EXPECTED_COLS")
+        model = joblib.load(os.path.join(version_dir, "model.pkl"))
+        encoder = joblib.load(os.path.join(version_dir, "encoder.pkl"))
+        forest_path = os.path.join(version_dir, "forest.npz")
+        forest = FlatForest.load(forest_path) if os.path.exists(forest_path) else export_forest(model)
+    return ModelVersion(model_id, model, encoder, meta, forest)
+
+
+class ModelHolder:
+    """model ที่ worker ใช้อยู่ โหลด version ใหม่นอก request แล้วสลับ reference ทีเดียว
+
+    request ควรอ่าน holder.active ครั้งเดียวตอนเริ่ม เพื่อใช้ version เดียวกันตลอด request
+    """
+
+    def __init__(self):
+        self.active = None
+        self.previous = None
+        self._lock = threading.Lock()
+
+    @property
+    def default_genre(self):
+        active = self.active
+        return active.default_genre if active else 'drama'
+
+    def reload_if_changed(self):
+        """โหลด version ตาม pointer ถ้าต่างจากที่ใช้อยู่ คืน True ถ้ามีการสลับ"""
+        target = current_version_id() or LEGACY_MODEL_ID
+        with self._lock:
+            active = self.active
+            if active is not None and active.model_id == target:
+                return False
+            if self.previous is not None and self.previous.model_id == target:
+                new_version = self.previous
+            else:
+                new_version = load_version(target)
+            self.previous, self.active = active, new_version
+        log.info(
+            f"Model swapped: {active.model_id if active else None} -> {new_version.model_id}"
+        )
+        return True
+
+
+if __name__ == "__main__":
+    # ย้อน model ของทุก worker: python model_registry.py rollback (รันจาก backend/)
+    # worker แต่ละตัวสลับตาม pointer เองภายใน MODEL_RELOAD_SECONDS
+    if sys.argv[1:] == ["rollback"]:
+        model_id = rollback_version()
+        if model_id is None:
+            sys.exit("No previous model version to roll back to")
+        print(f"Model rolled back to {model_id}")
+    else:
+        current = current_version_id()
+        for model_id in list_versions():
+            print(f"{'*' if model_id == current else ' '} {model_id}")
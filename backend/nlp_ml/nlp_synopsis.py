@@ -1,37 +1,189 @@
-import nltk
-from nltk.tokenize import word_tokenize, sent_tokenize
-nltk.download('punkt')
-nltk.download('punkt_tab')
+import os
+import re
+import tempfile
+from pathlib import Path
+import numpy as np
 
+# nltk (import ช้า และ word_tokenize ต้องใช้ punkt_tab) กับ scipy import ตอนใช้ครั้งแรก ไม่ต่อ network ตอน import
+LEXICON_DIR = Path(__file__).resolve().parent
+LEXICON_TXT = LEXICON_DIR / 'NRC-VAD-Lexicon-v2.1.txt'
+# NRC-VAD ที่ compile แล้ว: structured array (word, valence, arousal) เรียงตาม word เก็บเป็น .npy เปิดด้วย mmap
+# สร้างครั้งเดียวด้วย python nlp_ml/nlp_synopsis.py (หรือสร้างเองตอนใช้ครั้งแรกถ้ายังไม่มี)
+LEXICON_COMPILED = Path(os.getenv('VAD_LEXICON_PATH', LEXICON_DIR / 'NRC-VAD-Lexicon-v2.1.npy'))
 
-vad_lexicon ={}
-try:
-    with open('nlp_ml/NRC-VAD-Lexicon-v2.1.txt' , 'r' , encoding='utf-8') as f:
+
+def parse_lexicon(path=LEXICON_TXT):
+    # เก็บเฉพาะคำเดี่ยว (ไม่มีช่องว่าง) token จาก word_tokenize ไม่มีทางตรงกับวลีหลายคำ
+    entries = []
+    with open(path, 'r', encoding='utf-8') as f:
         next(f)
         for line in f:
             parts = line.strip().split('\t')
             if len(parts) == 4:
                 word , valence , arousal , dominance = parts
-                v, a = float(valence), float(arousal)
-                v = (v + 1) / 2
-                a = (a + 1) / 2
-                vad_lexicon[word.lower()]= (v,a)
-except FileNotFoundError:
+                word = word.lower()
+                if ' ' not in word:
+                    entries.append((word, float(valence), float(arousal)))
+    return entries
+
+
+def lexicon_table(entries):
+    entries = sorted(entries)
+    width = max((len(word) for word, _, _ in entries), default=1)
+    return np.array(entries, dtype=[('word', f'<U{width}'), ('valence', '<f4'), ('arousal', '<f4')])
+
+
+def compile_lexicon(src=LEXICON_TXT, dst=LEXICON_COMPILED):
+    table = lexicon_table(parse_lexicon(src))
+    dst = Path(dst)
+    # เขียนไฟล์ชั่วคราวแล้ว rename process อื่นจะไม่เห็นไฟล์ที่เขียนไม่ครบ
+    fd, tmp_path = tempfile.mkstemp(dir=dst.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, table)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, dst)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return table
+
+
+def load_lexicon():
+    """คืน structured array (word, valence, arousal) ที่เรียงตาม word
+
+    ใช้ไฟล์ compile แล้ว (mmap ไม่ copy เข้าหน่วยความจำ) ถ้ามีและใหม่กว่าไฟล์ text
+    ไม่อย่างนั้น compile ใหม่ (เขียนไม่ได้ก็ใช้ในหน่วยความจำ)
+    """
+    if LEXICON_COMPILED.exists() and (
+        not LEXICON_TXT.exists() or LEXICON_COMPILED.stat().st_mtime >= LEXICON_TXT.stat().st_mtime
+    ):
+        return np.load(LEXICON_COMPILED, mmap_mode='r')
+    if LEXICON_TXT.exists():
+        try:
+            return compile_lexicon()
+        except OSError as e:
+            print(f"Cannot write compiled NRC-VAD lexicon: {e}")
+            return lexicon_table(parse_lexicon())
     print("NRC-VAD file not found")
-    vad_lexicon = {}
+    return lexicon_table([])
+
+
+_vad_table = None
+
+
+def _vad_lexicon():
+    # lexicon โหลดครั้งแรกที่ใช้
+    global _vad_table
+    if _vad_table is None:
+        _vad_table = load_lexicon()
+    return _vad_table
+
+
+def _lookup(tokens):
+    """(row, mask): row ของแต่ละ token ใน lexicon หาด้วย binary search บน column word, mask = token ที่อยู่ใน lexicon"""
+    words = _vad_lexicon()['word']
+    # token ซ้ำกันมาก ค้นเฉพาะคำที่ไม่ซ้ำแล้วกระจายผลกลับ
+    unique = {}
+    inverse = np.array([unique.setdefault(token, len(unique)) for token in tokens], dtype=np.intp)
+    unique = np.asarray(list(unique), dtype=str)
+    rows = np.searchsorted(words, unique, side='right') - 1
+    found = rows >= 0
+    if len(words):
+        found[found] = words[rows[found]] == unique[found]
+    return rows[inverse], found[inverse]
+
+
+def _vad_values(rows):
+    # float64 (len(rows), 2) ของ valence/arousal ที่ปรับเป็น 0..1 แล้ว แปลงเฉพาะ row ที่ใช้
+    # ค่าในไฟล์มีทศนิยม 3 ตำแหน่ง ปัดกลับจาก float32 จะได้ float ตัวเดียวกับที่ parse จาก text
+    table = _vad_lexicon()
+    raw = np.column_stack([table['valence'][rows], table['arousal'][rows]]).astype(np.float64).round(3)
+    return (raw + 1) / 2
+
+
+_punkt_ready = False
+
+
+def _word_tokenize(text):
+    global _punkt_ready
+    import nltk
+    from nltk.tokenize import word_tokenize
+    if not _punkt_ready:
+        try:
+            nltk.data.find('tokenizers/punkt_tab')
+        except LookupError:
+            nltk.download('punkt_tab')
+        _punkt_ready = True
+    return word_tokenize(text)
+
 
 def analyze_va(text):
-    tokens = word_tokenize(text.lower())
-    valences, arousals = [], []
-    for token in tokens:
-        if token in vad_lexicon:
-            v, a = vad_lexicon[token]
-            valences.append(v)
-            arousals.append(a)
+    rows, found = _lookup(_word_tokenize(text.lower()))
+    valences, arousals = _vad_values(rows[found]).T.tolist()
 
     if valences and arousals:
         avg_valence = round(sum(valences) / len(valences), 3)
         avg_arousal = round(sum(arousals) / len(arousals), 3)
         return [avg_valence, avg_arousal]
     else:
-        return [0.0, 0.0]
\ No newline at end of file
+        return [0.0, 0.0]
+
+
+# ตัวตัดคำแบบเร็วสำหรับ analyze_va_batch ให้คำเดียวกับ word_tokenize สำหรับคำที่อยู่ใน lexicon
+# เครื่องหมายที่ word_tokenize แยกออกจากคำ
+_PUNCT = r"\s«“‘„`\"”»’()\[\]{}<>;@#$%&?!*,:\u2012-\u2015"
+# คำที่ word_tokenize แยกเป็นสองคำ (cannot -> can not)
+_CONTRACTION_RE = re.compile(r"\b(?=[cglw])(?:(can)(not)|(gim|lem)(me)|(gon)(na)|(got)(ta))\b|\b(wan)(na)(?=\s)")
+# ส่วนที่ไม่ใช่ตัวคำ: -- และ ..., ' หน้าคำ, 's 'll n't ... และจุดท้ายคำ (lookahead แรกให้ข้ามตำแหน่งที่ไม่เกี่ยวได้เร็ว)
+_STRIP_RE = re.compile(rf"(?=[-.'n])(?:--|\.{{2,}}|(?<![^{_PUNCT}])'|(?:(?:n't|'[smd]|'ll|'re|'ve|')\.*|\.+)(?![^{_PUNCT}]))")
+_TOKEN_RE = re.compile(rf"[^{_PUNCT}]+")
+
+
+def fast_tokenize(text):
+    text = _CONTRACTION_RE.sub(lambda m: " %s " % " ".join(g for g in m.groups() if g), text.lower())
+    return _TOKEN_RE.findall(_STRIP_RE.sub(" ", text))
+
+
+def analyze_va_batch(texts):
+    """analyze_va ของ synopsis หลายเรื่องพร้อมกัน คืน list ของ [valence, arousal] ตามลำดับ texts
+
+    หา token ของทุกเรื่องใน lexicon ด้วย searchsorted ครั้งเดียว แล้วรวมค่าต่อเรื่องด้วย sparse matrix (เรื่อง x token)
+    """
+    from scipy.sparse import csr_matrix
+    tokens = []
+    token_ptr = [0]
+    for text in texts:
+        tokens.extend(fast_tokenize(text or ""))
+        token_ptr.append(len(tokens))
+    rows, found = _lookup(tokens)
+    # จำนวน token ที่อยู่ใน lexicon สะสมตามลำดับ ใช้เป็นขอบเขตของแต่ละเรื่อง
+    indptr = np.concatenate([[0], np.cumsum(found)])[token_ptr].astype(np.int64)
+    values = _vad_values(rows[found])
+    indices = np.arange(len(values), dtype=np.int64)
+    # คำที่ซ้ำในเรื่องเดียวกันเป็นคนละ entry ใน matrix ตอนคูณจะถูกนับทุกครั้งเหมือนใน analyze_va
+    counts_matrix = csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(texts), len(values)))
+    counts = np.diff(indptr)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = (counts_matrix @ values) / counts[:, None]
+
+    # ค่าเฉลี่ยที่ตกตรงกลางระหว่างทศนิยม 3 ตำแหน่ง ลำดับการบวกมีผลต่อการปัด คิดใหม่แบบเดียวกับ analyze_va
+    scaled = means * 1000
+    near_half = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    rounded = np.round(means, 3).tolist()
+    results = []
+    for row, (start, end) in enumerate(zip(indptr[:-1], indptr[1:])):
+        if start == end:
+            results.append([0.0, 0.0])
+        elif near_half[row].any():
+            valences, arousals = values[start:end].T.tolist()
+            results.append([round(sum(valences) / len(valences), 3), round(sum(arousals) / len(arousals), 3)])
+        else:
+            results.append(rounded[row])
+    return results
+
+
+if __name__ == '__main__':
+    table = compile_lexicon()
+    print(f"Compiled {len(table)} NRC-VAD terms to {LEXICON_COMPILED}")
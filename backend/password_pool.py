@@ -0,0 +1,131 @@
+import os
+import time
+import asyncio
+import threading
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from password_utills import hash_password, verify_password
+
+log = logging.getLogger(__name__)
+
+# bcrypt ใช้ CPU หลายร้อย ms ต่อครั้ง แยกไปทำใน process pool ขนาดจำกัด
+PASSWORD_POOL_WORKERS = int(os.getenv("PASSWORD_POOL_WORKERS", 2))
+# งานที่รอคิวได้สูงสุด (ไม่นับที่กำลังทำอยู่) เกินนี้ตอบ 429 ทันที
+PASSWORD_POOL_QUEUE = int(os.getenv("PASSWORD_POOL_QUEUE", 32))
+
+
+def _timed(fn, *args):
+    # รันใน worker process: จับเวลาเฉพาะงาน hash/verify จริง ไม่รวมเวลารอคิว
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+class PasswordPoolBusy(Exception):
+    """คิวเต็ม (ให้ตอบ 429)"""
+
+
+class PasswordPoolUnavailable(Exception):
+    """process pool ใช้งานไม่ได้ (ให้ตอบ 503)"""
+
+
+class PasswordPool:
+    """process pool สำหรับ hash/verify password พร้อมจำกัดจำนวนงานที่ค้างอยู่"""
+
+    def __init__(self, workers, max_queue):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "failed": 0,
+            "hash": {"count": 0, "ms_total": 0.0, "ms_max": 0.0},
+            "verify": {"count": 0, "ms_total": 0.0, "ms_max": 0.0},
+        }
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _admit(self):
+        with self._lock:
+            if self._in_flight >= self.workers + self.max_queue:
+                self.stats["rejected"] += 1
+                raise PasswordPoolBusy("Too many pending password operations")
+            self._in_flight += 1
+            self.stats["submitted"] += 1
+            return self._get_executor()
+
+    def _done(self, kind, future):
+        # เรียกเมื่องานใน process จบจริง (แม้ request ที่รออยู่จะถูก cancel ไปแล้ว) slot จึงนับตรงกับงานที่ค้างอยู่
+        with self._lock:
+            self._in_flight -= 1
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                self.stats["failed"] += 1
+                return
+            elapsed_ms = future.result()[1]
+            kind_stats = self.stats[kind]
+            kind_stats["count"] += 1
+            kind_stats["ms_total"] += elapsed_ms
+            kind_stats["ms_max"] = max(kind_stats["ms_max"], elapsed_ms)
+
+    def _broken(self, executor, e):
+        log.error(f"Password process pool broken, recreating: {e}")
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        return PasswordPoolUnavailable("Password worker pool unavailable")
+
+    async def _run(self, kind, fn, *args):
+        executor = self._admit()
+        try:
+            future = executor.submit(_timed, fn, *args)
+        except BrokenProcessPool as e:
+            with self._lock:
+                self._in_flight -= 1
+                self.stats["failed"] += 1
+            raise self._broken(executor, e) from e
+        future.add_done_callback(lambda f: self._done(kind, f))
+        try:
+            result, _ = await asyncio.wrap_future(future)
+            return result
+        except BrokenProcessPool as e:
+            raise self._broken(executor, e) from e
+
+    async def hash(self, plain_password):
+        return await self._run("hash", hash_password, plain_password)
+
+    async def verify(self, plain_password, hashed_password):
+        return await self._run("verify", verify_password, plain_password, hashed_password)
+
+    def get_stats(self):
+        with self._lock:
+            stats = {
+                **self.stats,
+                "hash": dict(self.stats["hash"]),
+                "verify": dict(self.stats["verify"]),
+                "in_flight": self._in_flight,
+            }
+        stats["queue_depth"] = max(0, stats["in_flight"] - self.workers)
+        stats["workers"] = self.workers
+        stats["max_queue"] = self.max_queue
+        for kind in ("hash", "verify"):
+            kind_stats = stats[kind]
+            kind_stats["ms_avg"] = kind_stats["ms_total"] / kind_stats["count"] if kind_stats["count"] else 0.0
+        return stats
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+password_pool = PasswordPool(PASSWORD_POOL_WORKERS, PASSWORD_POOL_QUEUE)
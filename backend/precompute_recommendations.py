@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import redis
+from dotenv import load_dotenv
+from catalog import CATALOG_VERSION_KEY, load_catalog_from_redis
+from model_registry import load_version
+from recommender import (
+    GENRE_MAPPING, MOOD_SCALE, RECOMMEND_TOP_N, REC_TABLE_POINTER_KEY,
+    mood_to_va, resolve_user_genre, genre_candidates, rank_movies, rec_table_field
+)
+
+load_dotenv()
+
+# ตารางเก่าเก็บไว้อีกสักพักให้ worker ที่กำลังอ่านอยู่ใช้ต่อได้
+OLD_TABLE_TTL_SECONDS = 3600
+
+redis_config = {
+    'host': os.getenv('REDIS_HOST'),
+    'port': os.getenv('REDIS_PORT'),
+    'db': os.getenv('REDIS_DB', 0),
+    'password': os.getenv('REDIS_PASSWORD')
+}
+
+
+def genre_pairs(known_genres, default_genre):
+    """(genre สำหรับ ML, genre ที่ใช้ค้นหา) ทุกแบบที่ /submit สร้างได้"""
+    pairs = set()
+    for genre in GENRE_MAPPING:
+        if genre != "random":
+            user_genre_for_ml, _, search_genre = resolve_user_genre(genre, known_genres, default_genre)
+            pairs.add((user_genre_for_ml, search_genre))
+    # กรณี 'random' จะสุ่มจาก genre ที่ encoder รู้จัก
+    for genre in known_genres:
+        pairs.add((genre, genre.lower()))
+    return sorted(pairs)
+
+
+def precompute_recommendations(top_n=RECOMMEND_TOP_N):
+    try:
+        redisconn = redis.Redis(**redis_config, decode_responses=True)
+        redisconn.ping()
+        # ใช้ model version ปัจจุบันจาก registry (version เดียวกับที่ worker จะสลับไปใช้)
+        model_version = load_version()
+    except (redis.exceptions.ConnectionError, FileNotFoundError, ValueError) as e:
+        print(f'Error loading redis/model : {e}')
+        return
+
+    catalog_version = redisconn.get(CATALOG_VERSION_KEY)
+    if catalog_version is None:
+        print('No catalog version in Redis, run sync_db.py first')
+        return
+
+    catalog = load_catalog_from_redis(redisconn, catalog_version)
+    if len(catalog) == 0:
+        print('No movie data in Redis')
+        return
+
+    start = time.perf_counter()
+    known_genres, default_genre = model_version.known_genres, model_version.default_genre
+    table = {'_catalog_version': catalog_version, '_model_id': model_version.model_id, '_default_genre': default_genre}
+    for user_genre_for_ml, search_genre in genre_pairs(known_genres, default_genre):
+        candidate_idx = genre_candidates(catalog, search_genre)
+        for q1 in MOOD_SCALE:
+            for q_sum in range(2 * MOOD_SCALE[0], 2 * MOOD_SCALE[-1] + 1):
+                # arousal ขึ้นกับผลรวม q2+q3 เท่านั้น
+                q2 = min(q_sum - MOOD_SCALE[0], MOOD_SCALE[-1])
+                q3 = q_sum - q2
+                user_valence, user_arousal = mood_to_va(q1, q2, q3)
+                top_idx, top_rates = rank_movies(
+                    model_version, catalog, candidate_idx, user_valence, user_arousal, user_genre_for_ml,
+                    top_n
+                )
+                field = rec_table_field(q1, q2, q3, user_genre_for_ml, search_genre)
+                table[field] = json.dumps(
+                    [[str(catalog.movie_ids[i]), float(rate)] for i, rate in zip(top_idx, top_rates)]
+                )
+
+    table_key = f'rectable:{int(time.time())}'
+    old_table_key = redisconn.get(REC_TABLE_POINTER_KEY)
+    pipeline = redisconn.pipeline()
+    pipeline.hset(table_key, mapping=table)
+    pipeline.set(REC_TABLE_POINTER_KEY, table_key)
+    if old_table_key and old_table_key != table_key:
+        pipeline.expire(old_table_key, OLD_TABLE_TTL_SECONDS)
+    pipeline.execute()
+    print(
+        f'Precomputed {len(table) - 2} mood combinations for {len(catalog)} movies '
+        f'(catalog version {catalog_version}, model {model_version.model_id}) in {time.perf_counter() - start:.1f}s -> {table_key}'
+    )
+
+
+if __name__ == '__main__':
+    precompute_recommendations()
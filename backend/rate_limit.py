@@ -0,0 +1,108 @@
+import time
+import random
+import asyncio
+from email.utils import parsedate_to_datetime
+
+
+class AdaptiveRateLimiter:
+    """token bucket + จำกัดจำนวน request ที่ค้างอยู่ ปรับตัวเองแบบ AIMD
+
+    โดน 429 ลด rate และ concurrency ลงครึ่งหนึ่ง (และหยุดทั้งหมดตาม Retry-After)
+    สำเร็จจะค่อย ๆ เพิ่มกลับ: rate ประมาณ +1 req/s ต่อวินาที, concurrency +1 ต่อ concurrency request ที่สำเร็จ
+    """
+
+    def __init__(self, rate, min_rate, max_rate, max_concurrency):
+        self.rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.tokens = 1.0
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.stats = {"throttled": 0, "decreases": 0, "min_rate": self.rate, "min_concurrency": self.concurrency}
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._successes = 0
+        self._cond = None
+        self._cond_loop = None
+
+    def _condition(self):
+        # asyncio primitive ผูกกับ event loop ที่ใช้ครั้งแรก สร้างใหม่ถ้าถูกเรียกจาก loop อื่น (asyncio.run รอบใหม่)
+        loop = asyncio.get_running_loop()
+        if self._cond_loop is not loop:
+            self._cond = asyncio.Condition()
+            self._cond_loop = loop
+        return self._cond
+
+    def _refill(self, now):
+        # เก็บ token ได้ไม่เกิน 1 วินาทีของ rate ปัจจุบัน (burst)
+        self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        cond = self._condition()
+        async with cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    timeout = self.paused_until - now
+                elif self.in_flight >= self.concurrency:
+                    timeout = None
+                elif self.tokens < 1:
+                    timeout = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                try:
+                    await asyncio.wait_for(cond.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, throttled=False, retry_after=None):
+        cond = self._condition()
+        async with cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.stats["throttled"] += 1
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+                # 429 หลายตัวจากช่วงเดียวกันนับเป็นการลดครั้งเดียว
+                if now - self._last_decrease >= 1.0:
+                    self._last_decrease = now
+                    self.rate = max(self.min_rate, self.rate / 2)
+                    self.concurrency = max(1, self.concurrency // 2)
+                    self.tokens = 0.0
+                    self._successes = 0
+                    self.stats["decreases"] += 1
+                    self.stats["min_rate"] = min(self.stats["min_rate"], self.rate)
+                    self.stats["min_concurrency"] = min(self.stats["min_concurrency"], self.concurrency)
+            else:
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+                self._successes += 1
+                if self._successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                    self.concurrency += 1
+                    self._successes = 0
+            cond.notify_all()
+
+
+def parse_retry_after(value):
+    """Retry-After เป็นวินาทีหรือ HTTP date คืนจำนวนวินาที หรือ None ถ้าอ่านไม่ได้"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base, cap):
+    """exponential backoff แบบ full jitter: สุ่มระหว่าง 0 ถึง min(cap, base * 2^attempt)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
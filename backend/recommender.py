@@ -0,0 +1,173 @@
+import json
+import numpy as np
+
+EXPECTED_COLS = [
+    'user_valence', 'user_arousal', 'movie_valence', 'movie_arousal',
+    'user_genre_Action', 'user_genre_Comedy', 'user_genre_Documentary',
+    'user_genre_Drama', 'user_genre_Horror', 'user_genre_Romance', 'user_genre_Sci-Fi',
+    'movie_genre_Action', 'movie_genre_Comedy', 'movie_genre_Documentary',
+    'movie_genre_Drama', 'movie_genre_Horror', 'movie_genre_Romance', 'movie_genre_Sci-Fi'
+]
+
+FEATURE_INDEX = {col: i for i, col in enumerate(EXPECTED_COLS)}
+
+# Map form genre to encoder format (case-sensitive)
+GENRE_MAPPING = {
+    "action": "Action",
+    "comedy": "Comedy",
+    "drama": "Drama",
+    "documentary": "Documentary",
+    "horror": "Horror",
+    "romance": "Romance",
+    "sci-fi": "Sci-Fi", # ใช้ 'Sci-Fi' เป็นค่าหลักที่ map จาก input
+    "random": "random"
+}
+
+# ค่าที่ form ส่งมาได้ (1-5 ทุกข้อ)
+MOOD_SCALE = range(1, 6)
+
+RECOMMEND_TOP_N = 10
+# key ที่ชี้ไปยังตาราง recommendation ชุดล่าสุด (เขียนโดย precompute_recommendations.py)
+REC_TABLE_POINTER_KEY = "rectable:current"
+
+
+def encoder_genres(encoder):
+    """คืน (genre ที่ encoder รู้จัก, default genre)"""
+    known_genres = set(encoder.categories_[1])
+    # ต้องได้ค่าเดียวกันทุก process (ตาราง precompute สร้างใน process อื่น) ห้ามขึ้นกับลำดับของ set
+    matches = sorted(g for g in known_genres if str(g).lower() == 'drama')
+    if matches:
+        default_genre = matches[0]
+    else:
+        default_genre = sorted(known_genres, key=str)[0] if known_genres else 'unknown'
+    return known_genres, default_genre
+
+
+def mood_to_va(q1, q2, q3):
+    user_valence = (q1) / 5
+    user_arousal = ((q2+q3) /2 )/ 5
+    return user_valence, user_arousal
+
+
+def resolve_user_genre(genre, known_genres, default_genre):
+    """แปลง genre จาก form เป็น (genre สำหรับ ML, genre สำหรับ log, genre สำหรับค้นหาใน catalog)
+
+    ไม่รวมกรณี 'random' ซึ่งต้องสุ่มต่อที่ฝั่ง endpoint
+    """
+    user_genre_input = genre.lower()
+
+    # ตรวจสอบว่าเป็น Sci-Fi หรือไม่ เพื่อกำหนดค่าค้นหาใน Redis
+    if user_genre_input == "sci-fi":
+        user_genre_for_ml = "Sci-Fi"
+        user_genre_for_log = "Sci-Fi"
+        search_genre = "science fiction"
+    else:
+        # General Case:
+        user_genre_for_log = GENRE_MAPPING.get(user_genre_input, genre)
+        user_genre_for_ml = user_genre_for_log
+        search_genre = user_genre_input
+
+    # ตรวจสอบว่า Genre ที่จะใช้ทำนาย (ML) เป็นที่รู้จักของ Encoder หรือไม่
+    if user_genre_for_ml not in known_genres:
+        return default_genre, default_genre, default_genre.lower()
+    return user_genre_for_ml, user_genre_for_log, search_genre
+
+
+def resolve_feedback_genre(user_genre, movie_genres, default_genre):
+    """genre ของหนังที่ใช้ log feedback: genre ที่ user เลือกถ้าหนังมี genre นั้น ไม่งั้นใช้ genre แรก"""
+    if user_genre in movie_genres:
+        return user_genre
+    if movie_genres:
+        return movie_genres[0]
+    return default_genre
+
+
+def build_feature_matrix(user_valence, user_arousal, user_genre, movie_valence, movie_arousal, movie_genres):
+    """สร้าง feature (numeric + one-hot genre) ตาม EXPECTED_COLS สำหรับหนังหลายเรื่องพร้อมกัน"""
+    n = len(movie_valence)
+    X = np.zeros((n, len(EXPECTED_COLS)), dtype=np.float64)
+    X[:, FEATURE_INDEX['user_valence']] = user_valence
+    X[:, FEATURE_INDEX['user_arousal']] = user_arousal
+    X[:, FEATURE_INDEX['movie_valence']] = movie_valence
+    X[:, FEATURE_INDEX['movie_arousal']] = movie_arousal
+
+    user_col = FEATURE_INDEX.get(f"user_genre_{user_genre}")
+    if user_col is not None:
+        X[:, user_col] = 1.0
+    movie_cols = np.array([FEATURE_INDEX.get(f"movie_genre_{g}", -1) for g in movie_genres], dtype=np.intp)
+    has_col = movie_cols >= 0
+    X[np.nonzero(has_col)[0], movie_cols[has_col]] = 1.0
+
+    return X
+
+
+def genre_candidates(catalog, search_genre):
+    """index ของหนังใน genre ที่ค้นหา ถ้าไม่มีเลยใช้หนังทั้งหมดแทน"""
+    candidate_idx = catalog.movies_in_genre(search_genre)
+    if len(candidate_idx) == 0:
+        candidate_idx = np.arange(len(catalog))
+    return candidate_idx
+
+
+def rank_movies(model_version, catalog, candidate_idx, user_valence, user_arousal, user_genre_for_ml,
+                top_n=RECOMMEND_TOP_N):
+    """ทำนาย matching rate ของหนังใน candidate_idx แล้วคืน (index หนัง top_n, คะแนน)"""
+    movie_genres_ml = catalog.map_genres(model_version.known_genres, model_version.default_genre)[candidate_idx]
+    X = build_feature_matrix(
+        user_valence, user_arousal, user_genre_for_ml,
+        catalog.valence[candidate_idx], catalog.arousal[candidate_idx], movie_genres_ml
+    )
+    preds = model_version.predict(X)
+    order = np.argsort(-preds, kind="stable")[:top_n]
+    return candidate_idx[order], preds[order]
+
+
+def rec_table_field(q1, q2, q3, user_genre_for_ml, search_genre):
+    # valence/arousal ขึ้นกับ q1 และ q2+q3 เท่านั้น
+    return f"{q1}:{q2 + q3}:{user_genre_for_ml}:{search_genre}"
+
+
+_rec_table = None
+_rec_table_key = None
+
+
+def _parse_rec_table(raw):
+    meta = {
+        "catalog_version": raw.pop("_catalog_version", None),
+        "model_id": raw.pop("_model_id", None),
+        "default_genre": raw.pop("_default_genre", None)
+    }
+    return (meta, {field: json.loads(value) for field, value in raw.items()})
+
+
+def get_recommendation_table(r):
+    """โหลดตาราง recommendation ที่ precompute ไว้ (cache ใน worker จนกว่า pointer จะเปลี่ยน)
+
+    คืน ({catalog_version, model_id, default_genre}, {field: [(movie_id, matching_rate), ...]}) หรือ None ถ้ายังไม่มีตาราง
+    """
+    global _rec_table, _rec_table_key
+    table_key = r.get(REC_TABLE_POINTER_KEY)
+    if not table_key:
+        return None
+    if table_key != _rec_table_key:
+        raw = r.hgetall(table_key)
+        if not raw:
+            return None
+        _rec_table = _parse_rec_table(raw)
+        _rec_table_key = table_key
+    return _rec_table
+
+
+async def get_recommendation_table_async(r):
+    """get_recommendation_table สำหรับ redis.asyncio client"""
+    global _rec_table, _rec_table_key
+    table_key = await r.get(REC_TABLE_POINTER_KEY)
+    if not table_key:
+        return None
+    if table_key != _rec_table_key:
+        raw = await r.hgetall(table_key)
+        if not raw:
+            return None
+        _rec_table = _parse_rec_table(raw)
+        _rec_table_key = table_key
+    return _rec_table
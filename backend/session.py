@@ -1,61 +1,364 @@
-from datetime import datetime, timedelta
-from typing import Optional, Dict
+from typing import Optional
+from collections import OrderedDict
+import os
+import json
+import time
+import heapq
 import secrets
+import threading
+import redis
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
 
-# In-memory session store (ในการใช้งานจริงควรใช้ Redis)
-sessions: Dict[str, dict] = {}
+load_dotenv()
 
 SESSION_EXPIRE_MINUTES = 600
+# "redis" = ใช้ session ร่วมกันทุก worker/เครื่อง, "memory" = เก็บใน process (worker เดียว)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "redis")
+SESSION_KEY_PREFIX = "session:"
+# near-cache ใน worker กันไม่ให้ get_session ต้องไป Redis ทุก request
+SESSION_NEAR_CACHE_SIZE = int(os.getenv("SESSION_NEAR_CACHE_SIZE", 1024))
+# worker อื่นจะเห็นการเปลี่ยนแปลง (logout / mood ใหม่) ช้าสุดเท่านี้
+SESSION_NEAR_CACHE_SECONDS = float(os.getenv("SESSION_NEAR_CACHE_SECONDS", 2))
+# จำนวน session สูงสุดของ memory store (เกินแล้วทิ้ง session ที่ไม่ได้ใช้นานสุด)
+SESSION_MEMORY_MAX = int(os.getenv("SESSION_MEMORY_MAX", 100000))
+
+redis_config = {
+    'host': os.getenv("REDIS_HOST", "localhost"),
+    'port': int(os.getenv("REDIS_PORT", 6379)),
+    'db': int(os.getenv("REDIS_DB", 0)),
+    'password': os.getenv("REDIS_PASSWORD", None)
+}
+
+
+_MISSING = object()
+
+
+class _SessionRecord:
+    """ข้อมูล session แบบประหยัด memory (ใช้ได้เหมือน dict: record["user_id"], record.get(...))"""
+
+    __slots__ = ("user_id", "username", "expires", "data")
+
+    def __init__(self, user_id, username, expires):
+        self.user_id = user_id
+        self.username = username
+        self.expires = expires
+        self.data = None # mood ที่ /submit เก็บไว้ (สร้างเมื่อมีการ update เท่านั้น)
+
+    def get(self, key, default=None):
+        if key == "user_id":
+            return self.user_id
+        if key == "username":
+            return self.username
+        return self.data.get(key, default) if self.data else default
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+
+class MemorySessionStore:
+    """session ใน process (ใช้ได้เฉพาะตอนรัน worker เดียว)
+
+    - OrderedDict เรียงตามการใช้งานล่าสุด เกิน max_sessions จะทิ้ง session ที่ไม่ได้ใช้นานสุด (LRU)
+    - heap ของ (เวลาหมดอายุ, session_id) ไว้หา session ที่หมดอายุโดยไม่ต้อง scan ทั้งหมด
+      ต่ออายุ session ไม่ต้องแก้ heap: ตอน pop ถ้า record ถูกต่ออายุแล้วค่อยใส่กลับด้วยเวลาใหม่
+    """
+
+    # จำนวน entry ที่หมดอายุที่ลบเพิ่มในแต่ละการเรียก
+    EVICT_PER_CALL = 8
+
+    def __init__(self, expire_minutes, max_sessions):
+        self.sessions = OrderedDict()
+        self.expire_seconds = expire_minutes * 60
+        self.max_sessions = max_sessions
+        self._expiry_heap = []
+        self._lock = threading.Lock()
+
+    def _evict_expired(self, now, limit=None):
+        heap = self._expiry_heap
+        evicted = 0
+        while heap and heap[0][0] <= now and (limit is None or evicted < limit):
+            _, session_id = heapq.heappop(heap)
+            record = self.sessions.get(session_id)
+            if record is None:
+                continue # ถูกลบหรือโดน LRU ทิ้งไปแล้ว
+            if record.expires > now:
+                heapq.heappush(heap, (record.expires, session_id))
+            else:
+                del self.sessions[session_id]
+                evicted += 1
+        # entry ของ session ที่ถูกลบไปแล้วค้างใน heap ได้ สร้าง heap ใหม่ถ้าค้างเยอะเกิน
+        if len(heap) > 2 * len(self.sessions) + 64:
+            self._expiry_heap = [(record.expires, sid) for sid, record in self.sessions.items()]
+            heapq.heapify(self._expiry_heap)
+        return evicted
+
+    def _live_record(self, session_id, now):
+        record = self.sessions.get(session_id)
+        if record is None:
+            return None
+        if record.expires <= now:
+            # Session หมดอายุ ลบออก
+            del self.sessions[session_id]
+            return None
+        # Refresh session expiry และย้ายไปท้าย LRU
+        record.expires = now + self.expire_seconds
+        self.sessions.move_to_end(session_id)
+        return record
+
+    def create(self, user_id: int, username: str) -> str:
+        session_id = secrets.token_urlsafe(32)
+        now = time.monotonic()
+        record = _SessionRecord(user_id, username, now + self.expire_seconds)
+        with self._lock:
+            self._evict_expired(now, self.EVICT_PER_CALL)
+            self.sessions[session_id] = record
+            heapq.heappush(self._expiry_heap, (record.expires, session_id))
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return session_id
+
+    def get(self, session_id: str) -> Optional[_SessionRecord]:
+        now = time.monotonic()
+        with self._lock:
+            self._evict_expired(now, self.EVICT_PER_CALL)
+            return self._live_record(session_id, now)
+
+    def update(self, session_id: str, data: dict) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            record = self._live_record(session_id, now)
+            if record is None:
+                return False
+            if record.data is None:
+                record.data = {}
+            record.data.update(data)
+            return True
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def cleanup_expired(self) -> int:
+        with self._lock:
+            return self._evict_expired(time.monotonic())
+
+    def __len__(self):
+        return len(self.sessions)
+
+    # store นี้ไม่มี I/O จึงเรียกตรง ๆ ได้จาก async endpoint
+    async def create_async(self, user_id: int, username: str) -> str:
+        return self.create(user_id, username)
+
+    async def get_async(self, session_id: str) -> Optional[_SessionRecord]:
+        return self.get(session_id)
+
+    async def update_async(self, session_id: str, data: dict) -> bool:
+        return self.update(session_id, data)
+
+
+# ต่ออายุและเขียน field เฉพาะตอน session ยังอยู่ ทำใน Redis คำสั่งเดียว
+# (ถ้าแยก EXPIRE กับ HSET key อาจหมดอายุระหว่างกลาง แล้ว HSET สร้าง hash ใหม่ที่ไม่มี user_id และไม่มี TTL)
+_UPDATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if #ARGV > 1 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+class RedisSessionStore:
+    """session เป็น hash session:{id} ใน Redis ใช้ TTL ของ key ทำ sliding expiry
+
+    ค่าแต่ละ field เก็บเป็น JSON เพื่อให้ int/float กลับมาเป็น type เดิม
+    """
+
+    def __init__(self, client, async_client, expire_minutes, cache_size, cache_seconds):
+        self.r = client
+        self.ar = async_client
+        self.ttl = expire_minutes * 60
+        self.cache_size = cache_size
+        self.cache_seconds = cache_seconds
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._update_script = client.register_script(_UPDATE_SCRIPT)
+        self._update_script_async = async_client.register_script(_UPDATE_SCRIPT)
+
+    @staticmethod
+    def _key(session_id):
+        return f"{SESSION_KEY_PREFIX}{session_id}"
+
+    @staticmethod
+    def _encode(data):
+        return {field: json.dumps(value) for field, value in data.items()}
+
+    def _update_args(self, data):
+        args = [self.ttl]
+        for field, value in self._encode(data).items():
+            args.extend((field, value))
+        return args
+
+    @staticmethod
+    def _decode(raw):
+        return {field: json.loads(value) for field, value in raw.items()}
+
+    def _cache_get(self, session_id):
+        with self._cache_lock:
+            entry = self._cache.get(session_id)
+            if entry is None:
+                return None
+            session, cached_at = entry
+            if time.monotonic() - cached_at > self.cache_seconds:
+                del self._cache[session_id]
+                return None
+            self._cache.move_to_end(session_id)
+            return session
+
+    def _cache_put(self, session_id, session):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[session_id] = (session, time.monotonic())
+            self._cache.move_to_end(session_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_drop(self, session_id):
+        with self._cache_lock:
+            self._cache.pop(session_id, None)
+
+    def _new_session(self, user_id, username):
+        return secrets.token_urlsafe(32), {"user_id": user_id, "username": username}
+
+    def _fetched(self, session_id, raw):
+        if not raw:
+            self._cache_drop(session_id)
+            return None
+        session = self._decode(raw)
+        self._cache_put(session_id, session)
+        return session
+
+    def _updated(self, session_id, data, exists):
+        if not exists:
+            self._cache_drop(session_id)
+            return False
+        cached = self._cache_get(session_id)
+        if cached is not None:
+            self._cache_put(session_id, {**cached, **data})
+        return True
+
+    def create(self, user_id: int, username: str) -> str:
+        session_id, session = self._new_session(user_id, username)
+        key = self._key(session_id)
+        pipe = self.r.pipeline()
+        pipe.hset(key, mapping=self._encode(session))
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+        self._cache_put(session_id, session)
+        return session_id
+
+    def get(self, session_id: str) -> Optional[dict]:
+        session = self._cache_get(session_id)
+        if session is not None:
+            return session
+        # อ่านและต่ออายุใน round-trip เดียว
+        pipe = self.r.pipeline()
+        pipe.hgetall(self._key(session_id))
+        pipe.expire(self._key(session_id), self.ttl)
+        raw, _ = pipe.execute()
+        return self._fetched(session_id, raw)
+
+    def update(self, session_id: str, data: dict) -> bool:
+        # session ที่หมดอายุไปแล้วจะไม่ถูกสร้างใหม่ด้วย field ใหม่อย่างเดียว
+        exists = self._update_script(keys=[self._key(session_id)], args=self._update_args(data))
+        return self._updated(session_id, data, bool(exists))
+
+    def delete(self, session_id: str) -> bool:
+        self._cache_drop(session_id)
+        return self.r.delete(self._key(session_id)) > 0
+
+    def cleanup_expired(self) -> int:
+        # Redis ลบ key ที่หมด TTL เอง เหลือแค่ล้าง near-cache ที่เก่าแล้ว
+        now = time.monotonic()
+        with self._cache_lock:
+            expired = [sid for sid, (_, cached_at) in self._cache.items() if now - cached_at > self.cache_seconds]
+            for sid in expired:
+                del self._cache[sid]
+        return len(expired)
+
+    async def create_async(self, user_id: int, username: str) -> str:
+        session_id, session = self._new_session(user_id, username)
+        key = self._key(session_id)
+        pipe = self.ar.pipeline()
+        pipe.hset(key, mapping=self._encode(session))
+        pipe.expire(key, self.ttl)
+        await pipe.execute()
+        self._cache_put(session_id, session)
+        return session_id
+
+    async def get_async(self, session_id: str) -> Optional[dict]:
+        session = self._cache_get(session_id)
+        if session is not None:
+            return session
+        pipe = self.ar.pipeline()
+        pipe.hgetall(self._key(session_id))
+        pipe.expire(self._key(session_id), self.ttl)
+        raw, _ = await pipe.execute()
+        return self._fetched(session_id, raw)
+
+    async def update_async(self, session_id: str, data: dict) -> bool:
+        exists = await self._update_script_async(keys=[self._key(session_id)], args=self._update_args(data))
+        return self._updated(session_id, data, bool(exists))
+
+
+if SESSION_BACKEND == "memory":
+    store = MemorySessionStore(SESSION_EXPIRE_MINUTES, SESSION_MEMORY_MAX)
+else:
+    store = RedisSessionStore(
+        redis.Redis(**redis_config, decode_responses=True),
+        aioredis.Redis(**redis_config, decode_responses=True),
+        SESSION_EXPIRE_MINUTES, SESSION_NEAR_CACHE_SIZE, SESSION_NEAR_CACHE_SECONDS
+    )
+
 
 def create_session(user_id: int, username: str) -> str:
     """สร้าง session ใหม่สำหรับ user"""
-    session_id = secrets.token_urlsafe(32)
-    sessions[session_id] = {
-        "user_id": user_id,
-        "username": username,
-        "expires": datetime.now() + timedelta(minutes=SESSION_EXPIRE_MINUTES)
-    }
-    return session_id
+    return store.create(user_id, username)
 
 def get_session(session_id: str) -> Optional[dict]:
     """ดึงข้อมูล session และ refresh expire time"""
     if not session_id:
         return None
-    
-    session = sessions.get(session_id)
-    if session and session["expires"] > datetime.now():
-        # Refresh session expiry
-        session["expires"] = datetime.now() + timedelta(minutes=SESSION_EXPIRE_MINUTES)
-        return session
-    elif session:
-        # Session หมดอายุ ลบออก
-        del sessions[session_id]
-    return None
+    return store.get(session_id)
 
 def update_session_data(session_id: str, data: dict) -> bool:
     """อัปเดตข้อมูลเพิ่มเติมใน session ที่มีอยู่"""
-    session = sessions.get(session_id)
-    
-    if session and session["expires"] > datetime.now():
-        session.update(data) # อัปเดต dictionary ใน in-memory store
-        return True
-    elif session:
-        # Session หมดอายุ
-        del sessions[session_id]
-        return False
-    return False
+    return store.update(session_id, data)
 
 def delete_session(session_id: str) -> bool:
     """ลบ session (สำหรับ logout)"""
-    if session_id in sessions:
-        del sessions[session_id]
-        return True
-    return False
+    return store.delete(session_id)
 
 def cleanup_expired_sessions():
     """ลบ session ที่หมดอายุทั้งหมด"""
-    now = datetime.now()
-    expired = [sid for sid, data in sessions.items() if data["expires"] <= now]
-    for sid in expired:
-        del sessions[sid]
-    return len(expired)
\ No newline at end of file
+    return store.cleanup_expired()
+
+
+# สำหรับ async endpoint (ไม่ block event loop ระหว่างรอ Redis)
+async def create_session_async(user_id: int, username: str) -> str:
+    return await store.create_async(user_id, username)
+
+async def get_session_async(session_id: str) -> Optional[dict]:
+    if not session_id:
+        return None
+    return await store.get_async(session_id)
+
+async def update_session_data_async(session_id: str, data: dict) -> bool:
+    return await store.update_async(session_id, data)
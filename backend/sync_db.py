@@ -1,8 +1,14 @@
 import os
+import sys
+import time
+import json
+import resource
+import hashlib
 import psycopg2
 import redis
-import json
 from dotenv import load_dotenv
+from catalog import CATALOG_VERSION_KEY, CATALOG_VERSION_SEQ_KEY, manifest_key, movie_key
+from catalog_snapshot import SnapshotBuilder, snapshot_key, SNAPSHOT_CHUNK_BYTES
 
 load_dotenv()
 
@@ -21,22 +27,123 @@ redis_config = {
     'password': os.getenv('REDIS_PASSWORD')
 }
 
-def sync_movie_data_to_redis():
+# จำนวน key ต่อรอบของ SCAN/UNLINK ตอนลบ generation เก่า
+SCAN_COUNT = 1000
+# จำนวนหนังที่ดึงจาก server-side cursor และเขียนลง Redis ต่อหนึ่ง pipeline
+SYNC_CHUNK_SIZE = int(os.getenv('SYNC_CHUNK_SIZE', 2000))
+# ค่า string ใหญ่สุดที่ Redis เก็บได้ snapshot ที่ใหญ่กว่านี้จะไม่ publish (worker อ่านจาก manifest แทน)
+SNAPSHOT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def movie_mapping(movie):
+    (movie_id, movie_name, movie_genre, movie_rating, movie_synopsis,
+        movie_link, movie_direct, movie_emotion , movie_poster) = movie
+    return {
+        'name': movie_name if movie_name is not None else '',
+        'gerne': json.dumps(movie_genre) if movie_genre is not None else '[]', 
+        'rating': movie_rating if movie_rating is not None else 0.0,
+        'synopsis': movie_synopsis if movie_synopsis is not None else '',
+        'link': json.dumps(movie_link) if movie_link is not None else '[]',
+        'direct': movie_direct if movie_direct is not None else '',
+        'emotion': json.dumps(movie_emotion) if movie_emotion is not None else '[]',
+        'poster': movie_poster if movie_poster is not None else ''
+    }
+
+
+def content_hash(mapping):
+    payload = json.dumps({k: str(v) for k, v in mapping.items()}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def next_version(redisconn):
+    # เริ่มนับต่อจาก catalog:version เดิม (sync_db รุ่นเก่าใช้ INCR ตรง ๆ) จะได้ไม่ชนกับค่าเดิม
+    current = redisconn.get(CATALOG_VERSION_KEY)
+    redisconn.set(CATALOG_VERSION_SEQ_KEY, int(current) if current and current.isdigit() else 0, nx=True)
+    return str(redisconn.incr(CATALOG_VERSION_SEQ_KEY))
+
+
+def peak_rss_mb():
+    # ru_maxrss บน Linux เป็น KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _stale_movie_keys(redisconn, keys, live_manifests, keep_legacy):
+    # เทียบ key ทีละ batch กับ manifest ด้วย HMGET ไม่ต้องโหลด manifest ทั้งก้อนเข้าหน่วยความจำ
+    ids = [key.split(':')[1] for key in keys]
+    live_hashes = [redisconn.hmget(manifest, ids) for manifest in live_manifests]
+    stale = []
+    for i, key in enumerate(keys):
+        parts = key.split(':')
+        if len(parts) == 2:
+            if not keep_legacy:
+                stale.append(key)
+        elif all(hashes[i] != parts[2] for hashes in live_hashes):
+            stale.append(key)
+    return stale
+
+
+def publish_snapshot(redisconn, version, snapshot):
+    """เขียน snapshot ลง key ชั่วคราวทีละ chunk (APPEND) แล้ว RENAME ทีเดียว
+
+    ไม่มีคำสั่งไหนส่งข้อมูลทั้งก้อน และ worker ไม่เห็น snapshot ที่เขียนไม่ครบ
+    """
+    partial_key = f"{snapshot_key(version)}:partial"
+    redisconn.unlink(partial_key)
+    for chunk in snapshot.chunks(SNAPSHOT_CHUNK_BYTES):
+        redisconn.append(partial_key, chunk)
+    redisconn.rename(partial_key, snapshot_key(version))
+
+
+def collect_garbage(redisconn, live_versions):
+    """ลบ manifest/snapshot ของ generation ที่ไม่ใช้แล้ว และ movie key ที่ไม่มี generation ไหนอ้างถึง (SCAN + UNLINK ไม่ block Redis)"""
+    live_versions = {version for version in live_versions if version is not None}
+    live_manifests = [manifest_key(version) for version in live_versions]
+    # generation จาก sync_db รุ่นเก่าไม่มี manifest (key เป็น movie:{id}) เก็บไว้ก่อนจนกว่าจะไม่ถูกใช้
+    keep_legacy = any(not redisconn.exists(manifest) for manifest in live_manifests)
+    live_manifests = [manifest for manifest in live_manifests if redisconn.exists(manifest)]
+    # key ของแต่ละ generation: catalog:{version}:movies, catalog:{version}:snapshot และ catalog:{version}:snapshot:partial
+    stale_catalog_keys = [
+        key for key in redisconn.scan_iter('catalog:*:*', count=SCAN_COUNT) if key.split(':')[1] not in live_versions
+    ]
+
+    removed = 0
+    batch = []
+    for key in redisconn.scan_iter('movie:*', count=SCAN_COUNT):
+        batch.append(key)
+        if len(batch) >= SCAN_COUNT:
+            stale = _stale_movie_keys(redisconn, batch, live_manifests, keep_legacy)
+            removed += redisconn.unlink(*stale) if stale else 0
+            batch = []
+    if batch:
+        stale = _stale_movie_keys(redisconn, batch, live_manifests, keep_legacy)
+        removed += redisconn.unlink(*stale) if stale else 0
+    if stale_catalog_keys:
+        redisconn.unlink(*stale_catalog_keys)
+    return removed, len({key.split(':')[1] for key in stale_catalog_keys})
+
+
+def sync_movie_data_to_redis(diff=False):
+    """เขียน catalog เป็น generation ใหม่ แล้วสลับ catalog:version ไปที่ generation นั้นทีเดียว
+
+    diff=True จะเขียนเฉพาะหนังที่ข้อมูล (content hash) เปลี่ยนจาก generation ปัจจุบัน
+    """
     try:
         pgconn = psycopg2.connect(**postgres_config)
-        redisconn = redis.Redis(**redis_config)
+        redisconn = redis.Redis(**redis_config, decode_responses=True)
         redisconn.ping()
         print('Success connecting to database')
     except (psycopg2.OperationalError , redis.exceptions.ConnectionError) as e:
         print(f'Error connecting to database : {e}')
         return
     try:
-        delete_key = redisconn.keys('movie:*')
-        if delete_key:
-            redisconn.delete(*delete_key)
-        print(f"Cleared {len(delete_key)} old movie keys from Redis.")
-    
-        cur = pgconn.cursor()
+        old_version = redisconn.get(CATALOG_VERSION_KEY)
+        old_manifest_key = manifest_key(old_version) if diff and old_version else None
+        version = next_version(redisconn)
+        new_manifest_key = manifest_key(version)
+
+        # named cursor = server-side cursor ดึงทีละ chunk หน่วยความจำไม่โตตามขนาด catalog
+        cur = pgconn.cursor(name='sync_movies')
+        cur.itersize = SYNC_CHUNK_SIZE
         cur.execute("""
                 SELECT
                     movie_id,
@@ -51,34 +158,54 @@ def sync_movie_data_to_redis():
                 FROM movies
             """)
 
-        movies = cur.fetchall()
+        start = time.perf_counter()
+        total = 0
+        written = 0
+        snapshot = SnapshotBuilder()
+        while True:
+            movies = cur.fetchmany(SYNC_CHUNK_SIZE)
+            if not movies:
+                break
+            ids = [str(movie[0]) for movie in movies]
+            old_hashes = redisconn.hmget(old_manifest_key, ids) if old_manifest_key else [None] * len(ids)
+
+            manifest = {}
+            pipeline = redisconn.pipeline(transaction=False)
+            for movie_id, movie, old_hash in zip(ids, movies, old_hashes):
+                mapping = movie_mapping(movie)
+                h = content_hash(mapping)
+                snapshot.add(movie[0], movie[1], movie[2], movie[5], movie[7], movie[8])
+                manifest[movie_id] = h
+                # หนังที่ hash เท่าเดิมมี key อยู่แล้ว ไม่ต้องเขียนซ้ำ
+                if old_hash != h:
+                    pipeline.hset(movie_key(movie_id, h), mapping=mapping)
+                    written += 1
+            pipeline.hset(new_manifest_key, mapping=manifest)
+            pipeline.execute()
+            total += len(movies)
         cur.close()
+        elapsed = time.perf_counter() - start
 
-        if not movies:
+        if not total:
             print('No movie data to sync')
             return
-        
-        pipeline = redisconn.pipeline()
-        for movie in movies:
-            (movie_id, movie_name, movie_genre, movie_rating, movie_synopsis, 
-                movie_link, movie_direct, movie_emotion , movie_poster) = movie
-        
-            pipeline.hset(
-                f'movie:{movie_id}',
-                mapping={
-                    'name': movie_name if movie_name is not None else '',
-                    'gerne': json.dumps(movie_genre) if movie_genre is not None else '[]', 
-                    'rating': movie_rating if movie_rating is not None else 0.0,
-                    'synopsis': movie_synopsis if movie_synopsis is not None else '',
-                    'link': json.dumps(movie_link) if movie_link is not None else '[]',
-                    'direct': movie_direct if movie_direct is not None else '',
-                    'emotion': json.dumps(movie_emotion) if movie_emotion is not None else '[]',
-                    'poster': movie_poster if movie_poster is not None else ''
-                }
-            )
-        
-        pipeline.execute()
-        print(f"Successfully synced {len(movies)} movies to Redis.")
+
+        # snapshot ต้องอยู่ก่อนสลับ pointer เหมือน manifest
+        with snapshot:
+            snapshot_bytes = snapshot.nbytes
+            if snapshot_bytes <= SNAPSHOT_MAX_BYTES:
+                publish_snapshot(redisconn, version, snapshot)
+                print(f"Published catalog snapshot ({snapshot_bytes / 1024 / 1024:.1f} MB).")
+            else:
+                print(f"Catalog snapshot is {snapshot_bytes} bytes, larger than Redis allows, skipped.")
+
+        # สลับ pointer ทีเดียว worker จะเห็น catalog ครบทั้ง generation (ไม่มีช่วงที่ catalog ว่าง)
+        redisconn.set(CATALOG_VERSION_KEY, version)
+        print(f"Successfully synced {total} movies to Redis as version {version} ({written} written, {total - written} unchanged).")
+        print(f"Synced at {total / elapsed if elapsed else 0:.0f} rows/sec in {elapsed:.2f}s, peak RSS {peak_rss_mb():.1f} MB.")
+
+        removed_keys, removed_versions = collect_garbage(redisconn, [version, old_version])
+        print(f"Removed {removed_keys} old movie keys and {removed_versions} old catalog versions.")
 
     except (psycopg2.Error, redis.exceptions.RedisError) as e:
         print(f'Sync error : {e}')
@@ -92,4 +219,4 @@ def sync_movie_data_to_redis():
 
 
 if __name__ == '__main__':
-    sync_movie_data_to_redis()
+    sync_movie_data_to_redis(diff='--diff' in sys.argv)
@@ -0,0 +1,116 @@
+import os
+import threading
+import logging
+import redis
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+# username ทั้งหมดเก็บใน Redis set เดียว ทุก worker เห็นชื่อที่ register ผ่าน worker อื่นทันที
+USERNAMES_KEY = "usernames"
+# ตั้งหลังโหลด users จาก Postgres ครบหนึ่งรอบ ถ้ายังไม่มี (หรือไม่ได้ sync นานเกินไป) lookup จะให้ถาม database
+USERNAMES_READY_KEY = "usernames:ready"
+# กันไม่ให้หลาย worker sync พร้อมกัน (มีอายุเท่ารอบ sync)
+USERNAMES_SYNC_LOCK_KEY = "usernames:sync"
+# sync ทั้งตารางเป็นระยะ เก็บชื่อที่ถูกเพิ่มนอก /register (ไม่อิง user_id จึงไม่พลาด transaction ที่ commit ไม่ตามลำดับ)
+USERNAME_INDEX_REFRESH_SECONDS = int(os.getenv("USERNAME_INDEX_REFRESH_SECONDS", 600))
+USERNAME_SYNC_BATCH = 5000
+
+redis_config = {
+    'host': os.getenv("REDIS_HOST", "localhost"),
+    'port': int(os.getenv("REDIS_PORT", 6379)),
+    'db': int(os.getenv("REDIS_DB", 0)),
+    'password': os.getenv("REDIS_PASSWORD", None)
+}
+
+
+class UsernameIndex:
+    """username ที่มีอยู่แล้ว (Redis set) ใช้ตอบ /check-username โดยไม่ต้องถาม Postgres
+
+    lookup คืน False = ว่าง, True = ถูกใช้แล้ว, None = ไม่แน่ใจ ต้องถาม database
+    unique constraint ยังกันชื่อซ้ำตอน register เสมอ
+    """
+
+    def __init__(self, client, async_client):
+        self.r = client
+        self.ar = async_client
+        self._lock = threading.Lock()
+        self.stats = {"taken": 0, "available": 0, "db_fallback": 0, "errors": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def add(self, username):
+        try:
+            self.r.sadd(USERNAMES_KEY, username)
+        except redis.exceptions.RedisError as e:
+            log.warning(f"Username index add failed: {e}")
+            self._count("errors")
+
+    async def add_async(self, username):
+        try:
+            await self.ar.sadd(USERNAMES_KEY, username)
+        except redis.exceptions.RedisError as e:
+            log.warning(f"Username index add failed: {e}")
+            self._count("errors")
+
+    def sync(self, conn):
+        """เพิ่ม username ทุกคนจาก Postgres ลง set คืนจำนวนที่อ่าน หรือ None ถ้า worker อื่นเพิ่ง sync ไป"""
+        if not self.r.set(USERNAMES_SYNC_LOCK_KEY, 1, nx=True, ex=USERNAME_INDEX_REFRESH_SECONDS):
+            return None
+        total = 0
+        try:
+            # server-side cursor อ่านทีละ batch ไม่โหลดทั้งตารางเข้าหน่วยความจำ
+            with conn.cursor(name='username_index_sync') as cur:
+                cur.itersize = USERNAME_SYNC_BATCH
+                cur.execute("SELECT user_name FROM users")
+                while True:
+                    rows = cur.fetchmany(USERNAME_SYNC_BATCH)
+                    if not rows:
+                        break
+                    self.r.sadd(USERNAMES_KEY, *(username for (username,) in rows))
+                    total += len(rows)
+            conn.rollback()
+        except Exception:
+            # sync ไม่ครบ ให้ worker ถัดไปลองใหม่โดยไม่ต้องรอจนหมดอายุ
+            self.r.delete(USERNAMES_SYNC_LOCK_KEY)
+            raise
+        self.r.set(USERNAMES_READY_KEY, 1, ex=USERNAME_INDEX_REFRESH_SECONDS * 3)
+        return total
+
+    def lookup(self, username):
+        try:
+            pipe = self.r.pipeline(transaction=False)
+            pipe.exists(USERNAMES_READY_KEY)
+            pipe.sismember(USERNAMES_KEY, username)
+            ready, taken = pipe.execute()
+        except redis.exceptions.RedisError as e:
+            log.warning(f"Username index lookup failed: {e}")
+            self._count("errors")
+            return None
+        if not ready:
+            self._count("db_fallback")
+            return None
+        self._count("taken" if taken else "available")
+        return bool(taken)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        try:
+            stats["usernames"] = self.r.scard(USERNAMES_KEY)
+            stats["ready"] = bool(self.r.exists(USERNAMES_READY_KEY))
+        except redis.exceptions.RedisError:
+            stats["usernames"] = None
+            stats["ready"] = False
+        return stats
+
+
+username_index = UsernameIndex(
+    redis.Redis(**redis_config, decode_responses=True),
+    aioredis.Redis(**redis_config, decode_responses=True)
+)
@@ -0,0 +1,246 @@
+import os
+import json
+import socket
+import logging
+from datetime import datetime, timedelta, timezone
+import redis
+import psycopg2
+import redis.asyncio as aioredis
+from psycopg2.extras import execute_values
+from db import db_connection
+import history_cache
+from dotenv import load_dotenv
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+# "direct" = เขียน Postgres ใน request, "queue" = ตอบทันทีหลังเข้าคิวใน Redis แล้วให้ flusher เขียนเป็น batch
+VOTE_WRITE_MODE = os.getenv("VOTE_WRITE_MODE", "direct")
+VOTE_STREAM_KEY = "votes:pending"
+VOTE_CONSUMER_GROUP = "vote-flusher"
+VOTE_BATCH_SIZE = int(os.getenv("VOTE_BATCH_SIZE", 500))
+VOTE_FLUSH_SECONDS = float(os.getenv("VOTE_FLUSH_SECONDS", 2))
+# vote ที่ค้างในคิวเกินนี้ /vote จะตอบ 503 ให้ client ลองใหม่
+VOTE_QUEUE_MAX = int(os.getenv("VOTE_QUEUE_MAX", 100000))
+# entry ที่ consumer อื่นอ่านไปแล้วไม่ ack นานเกินนี้ (เช่น worker ตาย) จะถูกดึงมาเขียนใหม่
+VOTE_CLAIM_IDLE_MS = int(os.getenv("VOTE_CLAIM_IDLE_MS", 60000))
+
+CONSUMER_NAME = f"{socket.gethostname()}-{os.getpid()}"
+
+redis_config = {
+    'host': os.getenv("REDIS_HOST", "localhost"),
+    'port': int(os.getenv("REDIS_PORT", 6379)),
+    'db': int(os.getenv("REDIS_DB", 0)),
+    'password': os.getenv("REDIS_PASSWORD", None)
+}
+
+r = redis.Redis(**redis_config, decode_responses=True)
+ar = aioredis.Redis(**redis_config, decode_responses=True)
+
+
+class VoteQueueFull(Exception):
+    pass
+
+
+async def enqueue_vote(vote):
+    """เพิ่ม vote (dict ของ watched + feedback) เข้า Redis stream
+
+    vote ปลอดภัยเท่ากับการตั้งค่า persistence ของ Redis (AOF/RDB)
+    """
+    if await ar.xlen(VOTE_STREAM_KEY) >= VOTE_QUEUE_MAX:
+        raise VoteQueueFull(f"Vote queue has more than {VOTE_QUEUE_MAX} pending votes")
+    return await ar.xadd(VOTE_STREAM_KEY, {"vote": json.dumps(vote)})
+
+
+def ensure_consumer_group():
+    try:
+        r.xgroup_create(VOTE_STREAM_KEY, VOTE_CONSUMER_GROUP, id="0", mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _read_batch(batch_size):
+    # entry ที่ค้างจาก consumer ที่ตายไปก่อน แล้วค่อยอ่าน entry ใหม่
+    claimed = r.xautoclaim(
+        VOTE_STREAM_KEY, VOTE_CONSUMER_GROUP, CONSUMER_NAME,
+        min_idle_time=VOTE_CLAIM_IDLE_MS, start_id="0-0", count=batch_size
+    )[1]
+    entries = [entry for entry in claimed if entry[1]]
+    if len(entries) < batch_size:
+        result = r.xreadgroup(
+            VOTE_CONSUMER_GROUP, CONSUMER_NAME, {VOTE_STREAM_KEY: ">"}, count=batch_size - len(entries)
+        )
+        if result:
+            entries.extend(result[0][1])
+    return entries
+
+
+def _entry_order(entry_id):
+    ms, seq = entry_id.split("-")
+    return int(ms), int(seq)
+
+
+def voted_at(entry_id):
+    """เวลาที่ vote เข้าคิว จาก stream id ("ms-seq") ลำดับเดียวกับใน stream
+
+    seq ใช้เป็น microsecond ให้ vote ที่เข้ามาใน ms เดียวกันยังเรียงตามลำดับ
+    """
+    ms, seq = _entry_order(entry_id)
+    return datetime.fromtimestamp(ms / 1000, timezone.utc) + timedelta(microseconds=min(seq, 999))
+
+
+def _parse_batch(entries):
+    """คืน (entry_ids, watched rows, feedback rows) โดยเก็บ vote ล่าสุดของแต่ละ (user, movie)
+
+    ON CONFLICT DO UPDATE แก้แถวเดียวกันซ้ำใน statement เดียวไม่ได้ จึงต้อง dedupe ก่อน
+    entry ที่ถูก claim กลับมาอาจเก่ากว่า entry ใหม่ใน batch เดียวกัน จึงเทียบตาม stream id ไม่ใช่ลำดับที่อ่าน
+    """
+    entry_ids, watched, feedback, latest = [], {}, {}, {}
+    for entry_id, fields in entries:
+        entry_ids.append(entry_id)
+        try:
+            vote = json.loads(fields["vote"])
+            key = (vote["user_id"], vote["movie_id"])
+            order = _entry_order(entry_id)
+            if key in latest and latest[key] > order:
+                continue
+            latest[key] = order
+            at = voted_at(entry_id)
+            watched[key] = (
+                vote["user_id"], vote["movie_id"], vote["vote"], vote["movie_poster"], vote["movie_name"], at
+            )
+            feedback.pop(key, None)
+            if vote.get("feedback"):
+                fb = vote["feedback"]
+                feedback[key] = (
+                    vote["user_id"], fb["user_valence"], fb["user_arousal"], fb["user_genre"],
+                    fb["movie_valence"], fb["movie_arousal"], fb["movie_genre"],
+                    vote["vote"], vote["movie_id"], at
+                )
+        except (KeyError, TypeError, ValueError) as e:
+            log.error(f"Dropping malformed vote entry {entry_id}: {e}")
+    return entry_ids, watched, feedback
+
+
+def write_votes(conn, watched_rows, feedback_rows):
+    """upsert หลายแถวลง watched/feedback ใน transaction เดียว
+
+    เขียนทับเฉพาะแถวที่ voted_at ไม่ใหม่กว่า vote นี้ entry ที่ค้างจาก batch ที่ล้มแล้วถูก claim กลับมาทีหลัง
+    จะไม่ทับ vote ใหม่กว่าที่ flusher ตัวอื่นเขียนไปแล้ว
+    """
+    with conn.cursor() as cur:
+        if watched_rows:
+            execute_values(
+                cur,
+                """
+                INSERT INTO watched (user_id, movie_id, vote, movie_poster, movie_name, voted_at)
+                VALUES %s
+                ON CONFLICT (user_id, movie_id)
+                DO UPDATE SET vote = EXCLUDED.vote, movie_poster = EXCLUDED.movie_poster, movie_name = EXCLUDED.movie_name,
+                    voted_at = EXCLUDED.voted_at
+                WHERE watched.voted_at IS NULL OR watched.voted_at <= EXCLUDED.voted_at
+                """,
+                watched_rows, page_size=len(watched_rows)
+            )
+        if feedback_rows:
+            execute_values(
+                cur,
+                """
+                INSERT INTO feedback (
+                    user_id, user_valence, user_arousal, user_genre,
+                    movie_valence, movie_arousal, movie_genre,
+                    vote, movie_id, voted_at
+                )
+                VALUES %s
+                ON CONFLICT (user_id, movie_id)
+                DO UPDATE SET
+                    user_valence = EXCLUDED.user_valence,
+                    user_arousal = EXCLUDED.user_arousal,
+                    user_genre = EXCLUDED.user_genre,
+                    movie_valence = EXCLUDED.movie_valence,
+                    movie_arousal = EXCLUDED.movie_arousal,
+                    movie_genre = EXCLUDED.movie_genre,
+                    vote = EXCLUDED.vote,
+                    voted_at = EXCLUDED.voted_at
+                WHERE feedback.voted_at IS NULL OR feedback.voted_at <= EXCLUDED.voted_at
+                """,
+                feedback_rows, page_size=len(feedback_rows)
+            )
+    conn.commit()
+
+
+def _write_batch(watched, feedback):
+    try:
+        with db_connection() as conn:
+            write_votes(conn, list(watched.values()), list(feedback.values()))
+    except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+        # มีแถวเสียใน batch เขียนทีละ vote แทน เพื่อไม่ให้แถวเดียวทำให้ทั้ง batch ค้างในคิว
+        log.error(f"Batch vote write failed, retrying one by one: {e}")
+        with db_connection() as conn:
+            for key, watched_row in watched.items():
+                feedback_row = feedback.get(key)
+                try:
+                    write_votes(conn, [watched_row], [feedback_row] if feedback_row else [])
+                except (psycopg2.DataError, psycopg2.IntegrityError) as row_error:
+                    conn.rollback()
+                    log.error(f"Dropping vote user={key[0]} movie={key[1]}: {row_error}")
+
+
+def check_schema():
+    """โหมด queue ต้องมีคอลัมน์ voted_at (migrations/003_vote_voted_at.sql) ถ้าไม่มีให้ล้มตั้งแต่ start"""
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT table_name FROM information_schema.columns
+                WHERE table_schema = current_schema() AND column_name = 'voted_at'
+                    AND table_name IN ('watched', 'feedback')
+                """
+            )
+            found = {table for (table,) in cur.fetchall()}
+        conn.rollback()
+    missing = sorted({"watched", "feedback"} - found)
+    if missing:
+        raise RuntimeError(
+            f"VOTE_WRITE_MODE=queue needs column voted_at on {', '.join(missing)}: "
+            f"run migrations/003_vote_voted_at.sql first"
+        )
+
+
+def flush_votes(batch_size=VOTE_BATCH_SIZE):
+    """เขียน vote ในคิวลง Postgres ทีละ batch จนคิวว่าง คืนจำนวน entry ที่เขียน
+
+    ack ใน Redis หลัง commit เท่านั้น ถ้า database ล่ม entry จะค้างไว้ให้รอบหน้าดึงมาเขียนใหม่
+    """
+    ensure_consumer_group()
+    flushed = 0
+    while True:
+        entries = _read_batch(batch_size)
+        if not entries:
+            break
+        entry_ids, watched, feedback = _parse_batch(entries)
+        _write_batch(watched, feedback)
+        history_cache.invalidate_many(user_id for user_id, _ in watched)
+        pipe = r.pipeline()
+        pipe.xack(VOTE_STREAM_KEY, VOTE_CONSUMER_GROUP, *entry_ids)
+        pipe.xdel(VOTE_STREAM_KEY, *entry_ids)
+        pipe.execute()
+        flushed += len(entry_ids)
+        if len(entries) < batch_size:
+            break
+    return flushed
+
+
+def get_queue_stats():
+    ensure_consumer_group()
+    pending = r.xpending(VOTE_STREAM_KEY, VOTE_CONSUMER_GROUP)
+    return {
+        "mode": VOTE_WRITE_MODE,
+        "queued": r.xlen(VOTE_STREAM_KEY),
+        "unacked": pending["pending"],
+        "max_queue": VOTE_QUEUE_MAX,
+        "batch_size": VOTE_BATCH_SIZE,
+        "flush_seconds": VOTE_FLUSH_SECONDS,
+    }
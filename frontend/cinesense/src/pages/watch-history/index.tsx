@@ -17,7 +17,9 @@ interface WatchHistoryItem {
 interface WatchHistoryData {
   message: string;
   total_watched: number;
+  average_vote: number;
   watch_history: WatchHistoryItem[];
+  next_cursor: number | null;
 }
 
 export default function WatchHistoryPage() {
@@ -25,6 +27,7 @@ export default function WatchHistoryPage() {
   const [watchHistory, setWatchHistory] = useState<WatchHistoryData | null>(null);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState<string | null>(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const router = useRouter();
 
   useEffect(() => {
@@ -53,6 +56,23 @@ export default function WatchHistoryPage() {
     fetchData();
   }, [router]);
 
+  // โหลดประวัติหน้าถัดไปต่อท้ายรายการเดิม
+  const loadMore = async () => {
+    if (!watchHistory?.next_cursor) return;
+    setLoadingMore(true);
+    try {
+      const nextPage = await getWatchHistory(watchHistory.next_cursor);
+      setWatchHistory({
+        ...nextPage,
+        watch_history: [...watchHistory.watch_history, ...nextPage.watch_history],
+      });
+    } catch (err) {
+      console.error("Error loading more history:", err);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const renderStars = (rating: number) => {
     return Array.from({ length: 5 }, (_, index) => (
       <i
@@ -114,10 +134,7 @@ export default function WatchHistoryPage() {
               </div>
               <div className="stat-item">
                 <div className="stat-number">
-                  {watchHistory?.watch_history && watchHistory.watch_history.length > 0 
-                    ? (watchHistory.watch_history.reduce((sum, item) => sum + item.vote, 0) / watchHistory.watch_history.length).toFixed(1)
-                    : "0.0"
-                  }
+                  {(watchHistory?.average_vote || 0).toFixed(1)}
                 </div>
                 <div className="stat-label">คะแนนเฉลี่ยที่ให้</div>
               </div>
@@ -161,6 +178,11 @@ export default function WatchHistoryPage() {
                     </div>
                   ))}
                 </div>
+                {watchHistory?.next_cursor && (
+                  <button className="start-button" onClick={loadMore} disabled={loadingMore}>
+                    {loadingMore ? "กำลังโหลด..." : "โหลดเพิ่ม"}
+                  </button>
+                )}
               </div>
             )}
           </div>
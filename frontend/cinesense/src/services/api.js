@@ -133,9 +133,10 @@ export async function checkUsername(username) {
 }
 
 // ← เพิ่ม function สำหรับดึงประวัติการรับชม
-export async function getWatchHistory() {
+export async function getWatchHistory(cursor = null) {
   try {
-    const res = await fetch(`${BASE_URL}/watch-history`, {
+    const query = cursor ? `?cursor=${cursor}` : "";
+    const res = await fetch(`${BASE_URL}/watch-history${query}`, {
       method: "GET",
       credentials: "include",
     });